@@ -0,0 +1,173 @@
+# Blending planner for compiled motion plans
+# Transit waypoints get a rounding radius so the robot passes through them instead of stopping
+import numpy as np
+
+import offline_robodk as off
+import ur5_kinematics as ur
+from motion_plan import MOVEJ, MOVEL, PipelinedExecutor, load_or_compile
+import coffee_machine as cm
+
+MAX_RADIUS = 50.0       # mm, largest rounding radius assigned
+MIN_RADIUS = 1.0        # mm, smaller radii are not worth blending
+DEVIATION = 15.0        # mm, furthest the blended path may cut the corner at a waypoint
+SEGMENT_SHARE = 0.4     # Largest share of a neighbouring segment a blend may use, keeps blends from overlapping
+REVERSAL = 120.0        # degrees, direction changes above this are turning points and kept precise
+# Waypoints where the tool holds or pushes a station item and must arrive exactly
+PRECISE_LABELS = ["Move to lever", "Pull grinder lever", "Move to cup", "Move cup to underneath filter",
+                  "Place cup down"]
+
+
+def step_positions(plan, tool=ur.MASTER_TOOL):
+    """ TCP position of every step of a plan, joint targets are converted with forward kinematics.
+    plan: MotionPlan
+    tool: pose of the TCP relative to the robot flange
+    output: (N, 3) positions in mm, NaN for steps that are not moves or whose target is a named item
+    """
+    positions = np.full((len(plan), 3), np.nan)
+    poses = [i for i, step in enumerate(plan) if step.kind in (MOVEJ, MOVEL) and np.size(step.target) == 16]
+    joints = [i for i, step in enumerate(plan) if step.kind in (MOVEJ, MOVEL) and np.size(step.target) == 6]
+    if poses:
+        positions[poses] = np.array([plan.steps[i].target for i in poses])[:, :3, 3]
+    if joints:
+        positions[joints] = ur.forward(np.array([plan.steps[i].target for i in joints]), tool)[:, :3, 3]
+    return positions
+
+
+def turn_angles(positions, previous, following):
+    """ Change of direction at each waypoint in degrees, NaN where a segment has no length """
+    incoming = positions - previous
+    outgoing = following - positions
+    lengths = np.linalg.norm(incoming, axis=1) * np.linalg.norm(outgoing, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cosine = np.einsum("ij,ij->i", incoming, outgoing) / lengths
+    return np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0)))
+
+
+def neighbours(plan, positions):
+    """ Position the robot comes from and goes to at every step.
+    Barrier steps (programs, pauses) do not move the robot so the neighbours are the closest moves.
+    output: tuple ((N, 3) previous positions, (N, 3) following positions), NaN at the ends of the plan
+    """
+    previous = np.full_like(positions, np.nan)
+    following = np.full_like(positions, np.nan)
+    moves = [i for i, step in enumerate(plan) if step.kind in (MOVEJ, MOVEL)]
+    for before, current, after in zip([None] + moves[:-1], moves, moves[1:] + [None]):
+        if before is not None:
+            previous[current] = positions[before]
+        if after is not None:
+            following[current] = positions[after]
+    return previous, following
+
+
+def classify(plan, positions=None, reversal=REVERSAL):
+    """ Decide which waypoints of a plan the robot may blend through.
+    A waypoint is precise if it is the end of a linear (contact) move, the start of one, the last move before
+    a tool program or pause, a turning point, has an unknown position or is listed in PRECISE_LABELS.
+    plan: MotionPlan
+    positions: (N, 3) TCP positions from step_positions, computed if not given
+    reversal: direction change in degrees above which a waypoint is a turning point
+    output: boolean array, True for transit waypoints
+    """
+    positions = step_positions(plan) if positions is None else positions
+    previous, following = neighbours(plan, positions)
+    with np.errstate(invalid="ignore"):
+        turning = turn_angles(positions, previous, following) > reversal
+    transit = np.zeros(len(plan), dtype=bool)
+    for i, step in enumerate(plan):
+        following_step = plan.steps[i + 1] if i + 1 < len(plan) else None
+        transit[i] = step.kind == MOVEJ and following_step is not None and following_step.kind == MOVEJ \
+            and step.label not in PRECISE_LABELS and not turning[i] \
+            and not np.isnan(positions[i]).any() and not np.isnan(previous[i]).any() \
+            and not np.isnan(following[i]).any()
+    return transit
+
+
+def blend_radii(plan, deviation=DEVIATION, max_radius=MAX_RADIUS, positions=None, obstacles=None):
+    """ Rounding radius for every step of a plan.
+    A blend starts and ends a radius away from the waypoint along each segment, so the blended path passes
+    at most radius * sin(turn / 2) from the waypoint. Joint moves are not straight in Cartesian space, so
+    this is an estimate that is exact for linear segments. The blend stays inside the triangle of its start,
+    its end and the waypoint, so it never leaves a ball of one radius around the waypoint: a radius no larger
+    than the free distance around the waypoint keeps the TCP off every station item.
+    plan: MotionPlan
+    deviation: furthest the path may cut the corner in mm, scalar or one value per step
+    max_radius: largest radius assigned in mm
+    positions: (N, 3) TCP positions from step_positions, computed if not given
+    obstacles: optional (N,) free distance around each waypoint in mm, see obstacle_distances
+    output: (N,) radii in mm, 0 for precise steps
+    """
+    positions = step_positions(plan) if positions is None else positions
+    previous, following = neighbours(plan, positions)
+    transit = classify(plan, positions)
+    deviation = np.broadcast_to(np.asarray(deviation, dtype=np.float64), (len(plan),))
+    obstacles = np.full(len(plan), np.inf) if obstacles is None else obstacles
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        half_turn = np.sin(np.radians(turn_angles(positions, previous, following)) / 2)
+        radii = np.fmin.reduce([np.full(len(plan), max_radius),
+                                SEGMENT_SHARE * np.linalg.norm(positions - previous, axis=1),
+                                SEGMENT_SHARE * np.linalg.norm(following - positions, axis=1),
+                                np.where(half_turn > 0, deviation / half_turn, np.inf),
+                                obstacles])
+    return np.where(transit & (radii >= MIN_RADIUS), radii, 0.0)
+
+
+def obstacle_distances(plan, boxes=None, positions=None):
+    """ Free distance around every waypoint: distance to the nearest station keep-out box less its margin.
+    plan: MotionPlan
+    boxes: station keep-out boxes, read from the key points if not given
+    positions: (N, 3) TCP positions from step_positions, computed if not given
+    output: (N,) distances in mm, NaN for steps that are not moves
+    """
+    # preflight imports this module for the waypoint classification
+    import preflight
+    boxes = preflight.station_boxes(preflight.read_key_points()) if boxes is None else boxes
+    positions = step_positions(plan) if positions is None else positions
+    with np.errstate(invalid="ignore"):
+        return np.maximum(np.min(preflight.distances(positions, boxes), axis=1) - preflight.MARGIN, 0.0)
+
+
+def blend_plan(plan, deviation=DEVIATION, max_radius=MAX_RADIUS, boxes=None):
+    """ Attach rounding radii to a plan, see blend_radii.
+    boxes: station keep-out boxes limiting the radii, read from the key points if not given
+    output: the plan, with plan.rounding set
+    """
+    positions = step_positions(plan)
+    plan.rounding = blend_radii(plan, deviation, max_radius, positions, obstacle_distances(plan, boxes, positions))
+    return plan
+
+
+def compare(plan, **options):
+    """ Simulated cycle time of a plan with and without its rounding radii.
+    plan: MotionPlan with rounding set
+    options: keyword arguments for offline_robodk.OfflineRobolink
+    output: dictionary of stage -> (seconds without blending, seconds with blending), including "total"
+    """
+    rounding = plan.rounding
+    plan.rounding = None
+    try:
+        stopped = off.simulate_plan(plan, **options)
+    finally:
+        plan.rounding = rounding
+    blended = off.simulate_plan(plan, **options)
+    return dict((stage, (stopped[stage], blended[stage])) for stage in stopped)
+
+
+def main():
+    plan = blend_plan(load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv"))
+    for step, radius in zip(plan, plan.rounding):
+        if radius > 0:
+            print("{:<24}{:<48}{:>6.1f} mm".format(step.stage, step.label, radius))
+    print("{} of {} waypoints blended".format(np.count_nonzero(plan.rounding), len(plan)))
+    for stage, (stopped, blended) in compare(plan).items():
+        print("{:<24}{:>8.2f} s{:>8.2f} s{:>8.2f} s saved".format(stage, stopped, blended, stopped - blended))
+
+    RDK = cm.rl.Robolink()
+    robot, master_tool = cm.connect_robot(RDK)
+    executor = PipelinedExecutor(robot, master_tool, RDK)
+    executor.run(plan)
+    print(executor.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+# Checkpointed stage execution with resume after a failure
+import functools
+import json
+import os
+import time
+
+import numpy as np
+
+import coffee_machine as cm
+from blending import step_positions
+from coffee_machine import GLOBAL, GRINDER, FILTER, CUP, SILVIA, ENTRY, STAND, OPEN, CLOSE
+from motion_plan import CoffeePlanner, MOVEJ, MOVEL
+from poses import from_mat
+
+CHECKPOINT_FILENAME = "checkpoint.json"
+# Stages of one checkpointed coffee, the last one leaves the arm clear so a finished coffee starts the next afresh
+STAGES = cm.SEQUENCE + [cm.CLEAR]
+
+# Portafilter and cup locations
+ARM = "arm"
+STACK = "stack"
+SERVED = "served"
+
+# Tool a stage expects on the arm when it starts, the other stages start with the bare master tool and attach
+# their own tool at the stand
+STAGE_TOOLS = {"pull_lever_multiple": GRINDER, "tamp_filter": FILTER, "insert_filter_silvia": FILTER, "place_cup": CUP}
+
+# Ways out of each stage as lists of (label of a move of the stage, move type), innermost waypoint first. The
+# arm backs out from the waypoint nearest to where it stopped, through the rest of that list. An empty label
+# is the first unlabelled move of the stage.
+EXITS = {"insert_filter_grinder": [[("Return to filter entry point", MOVEJ)]],
+         "turn_on_grinder": [[("Release on button", MOVEL), ("Move away from grinder ready for lever movement", MOVEJ)],
+                             [("Release off button", MOVEL),
+                              ("Move away from grinder ready for lever movement", MOVEJ)]],
+         "pull_lever_multiple": [[("Release lever", MOVEJ)]],
+         "scrape_filter": [[("Lift filter off ball", MOVEL), ("Pull out filter tool", MOVEL)],
+                           [("Push through scraper", MOVEL), ("Pull through scraper", MOVEL)]],
+         "tamp_filter": [[("Compress coffee", MOVEL), ("Lower filter", MOVEL), ("Remove from tamper", MOVEJ)]],
+         "insert_filter_silvia": [[("Filter to silvia", MOVEL), ("", MOVEL)], [("Avoid silvia", MOVEJ)]],
+         "place_cup": [[("Move cup to underneath filter", MOVEJ), ("Intermediate point", MOVEJ),
+                        ("Remove tool from machine", MOVEJ)]],
+         "turn_on_silvia": [[("Move to button", MOVEL), ("Avoid tools", MOVEJ)],
+                            [("Move to off", MOVEL), ("Avoid tools", MOVEJ)]],
+         "pickup_coffee": [[("Move to cup", MOVEJ), ("Intermediate point", MOVEJ), ("Remove cup", MOVEJ)],
+                           [("Place cup down", MOVEJ), ("Position over silvia", MOVEJ), ("Lift cup up", MOVEL)]],
+         "clear_arm": [[("Back away from cup", MOVEL)]]}
+# cup_from_stack leaves upwards once it holds a cup and back the way it came otherwise
+CUP_EXITS = {True: [[("Slide to cup edge", MOVEL), ("Remove cup", MOVEL), ("Rotate cup", MOVEJ)]],
+             False: [[("Move to cup level", MOVEL), ("", MOVEL)]]}
+
+
+def initial_state(parameters=cm.PARAMETERS):
+    """ State of the station before a coffee is started """
+    return {"completed": [], "running": None, "mounted": None, "filter": STAND, "cup": STACK,
+            "parameters": dict(parameters), "updated": time.time()}
+
+
+def write_durable(filename, data):
+    """ Atomically replace a JSON file, the data is on disk when this returns.
+    filename: path of the JSON file
+    data: JSON serialisable object
+    """
+    path = os.path.abspath(filename)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(data, file, indent=1)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    # Sync the directory so the rename itself survives a power loss
+    directory = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class Checkpoint(object):
+    """ Durable record of the progress of one coffee.
+    filename: path of the JSON checkpoint file
+    state: dictionary, see initial_state
+    """
+
+    def __init__(self, filename=CHECKPOINT_FILENAME, state=None):
+        self.filename = filename
+        self.state = state if state is not None else initial_state()
+
+    @classmethod
+    def load(cls, filename=CHECKPOINT_FILENAME):
+        """ Read a checkpoint, a missing file is a fresh start """
+        if not os.path.exists(filename):
+            return cls(filename)
+        with open(filename, "r") as file:
+            return cls(filename, json.load(file))
+
+    def save(self, **changes):
+        """ Update the state and write it to disk """
+        self.state.update(changes, updated=time.time())
+        write_durable(self.filename, self.state)
+
+    def finished(self):
+        """ Whether every stage of the coffee has been completed """
+        return len(self.state["completed"]) == len(STAGES)
+
+    def attach(self, machine):
+        """ Wrap the tool methods of a machine instance so every tool change is checkpointed.
+        machine: CoffeeMachine, the class itself is left untouched
+        """
+        change_tool = machine.change_tool
+        cup_tool = machine.cup_tool
+
+        @functools.wraps(change_tool)
+        def tracked_change_tool(name, pickup=True, location=STAND):
+            change_tool(name, pickup, location)
+            changes = {"mounted": machine.mounted}
+            if name == FILTER:
+                changes["filter"] = ARM if pickup else location
+            self.save(**changes)
+
+        @functools.wraps(cup_tool)
+        def tracked_cup_tool(operation):
+            cup_tool(operation)
+            cup = self.state["cup"]
+            if operation == CLOSE and machine.stage in ("cup_from_stack", "pickup_coffee"):
+                cup = ARM
+            elif operation == OPEN and cup == ARM:
+                cup = SILVIA if machine.stage == "place_cup" else SERVED
+            self.save(cup=cup)
+
+        machine.change_tool = tracked_change_tool
+        machine.cup_tool = tracked_cup_tool
+
+    @staticmethod
+    def detach(machine):
+        """ Remove the checkpoint wrappers from a machine instance """
+        for name in ("change_tool", "cup_tool"):
+            machine.__dict__.pop(name, None)
+
+
+def return_filter(machine):
+    """ Put a portafilter held on the arm back into the grinder holder """
+    machine.MoveJ(machine.joint_angles[FILTER + ENTRY], "Filter entry point")
+    machine.MoveL(machine.frames.get(GLOBAL, FILTER + ENTRY), "Return filter to grinder")
+    machine.change_tool(FILTER, False, GRINDER)
+    machine.MoveJ(machine.joint_angles[FILTER + ENTRY], "Return to filter entry point")
+
+
+def exit_path(machine, stage, state):
+    """ Waypoints that take the arm out of the machine a stage was working on, from where the arm stopped.
+    The stage is compiled with the machine's frames and the checkpointed parameters to find its waypoints.
+    machine: CoffeeMachine
+    stage: name of the interrupted stage
+    state: checkpoint state
+    output: list of (move type, target, label)
+    """
+    parameter = dict(STAGES)[stage]
+    planner = CoffeePlanner(machine.frames, machine.joint_angles)
+    planner.entry_pitch, planner.entry_shift = machine.entry_pitch, machine.entry_shift
+    planner.mounted = state["mounted"]
+    planner.run_stage(stage, *(() if parameter is None else (state["parameters"][parameter],)))
+    positions = step_positions(planner.plan)
+    moves = {}
+    for i, step in enumerate(planner.plan):
+        if step.kind in (MOVEJ, MOVEL):
+            moves.setdefault(step.label, i)
+    paths = CUP_EXITS[state["cup"] == ARM] if stage == "cup_from_stack" else EXITS.get(stage, [])
+    # A way out the stage no longer plans from this state (clear_arm without a cup tool) is skipped
+    paths = [[(kind, moves[label]) for label, kind in path] for path in paths
+             if all(label in moves for label, kind in path)]
+    if not paths:
+        return []
+
+    # Back out from the waypoint nearest the TCP, the whole first way out if the robot cannot say where it is
+    pose = machine.robot.Pose() if machine.robot is not None else None
+    if pose is None:
+        path, start = paths[0], 0
+    else:
+        here = from_mat(pose)[:3, 3] if hasattr(pose, "rows") else np.asarray(pose)[:3, 3]
+        path, start = min(((path, n) for path in paths for n in range(len(path))),
+                          key=lambda choice: np.linalg.norm(positions[choice[0][choice[1]][1]] - here))
+    return [(kind, planner.plan.steps[i].target, planner.plan.steps[i].label) for kind, i in path[start:]]
+
+
+def back_out(machine, stage, state):
+    """ Retrace the exit waypoints of an interrupted stage, see exit_path """
+    for kind, target, label in exit_path(machine, stage, state):
+        move = machine.MoveL if kind == MOVEL else machine.MoveJ
+        move(target, "Recover: " + label if label else "Recover")
+
+
+def recover(machine, checkpoint):
+    """ Bring the station back to a state the sequence can continue from after a stage was interrupted.
+    The arm first backs out of the machine along the exit waypoints of the stage. A stage that got as far
+    as placing what it carries then counts as completed, otherwise the tool expected at the start of the
+    stage is attached and the stage is run again. Coffee in a portafilter on the arm is put back in the
+    grinder and scraped and tamped again.
+    machine: CoffeeMachine with the checkpoint attached
+    checkpoint: Checkpoint whose running stage failed
+    """
+    state = checkpoint.state
+    stage = state["running"]
+    machine.stage = stage
+    machine.log("Recovering from interrupted stage " + stage)
+    completed = list(state["completed"])
+    back_out(machine, stage, state)
+
+    if stage == "pickup_coffee" and state["cup"] == ARM:
+        # Holding the finished coffee and clear of the group head, carry on putting it down rather than moving
+        # it to the home position
+        machine.serve_cup(state["parameters"]["height"])
+        completed.append(stage)
+    else:
+        machine.MoveJ(machine.home, "Recover to home")
+        if state["filter"] == ARM and stage in ("scrape_filter", "tamp_filter"):
+            return_filter(machine)
+            completed = [name for name in completed if name not in ("scrape_filter", "tamp_filter")]
+        elif (stage == "insert_filter_grinder" and state["filter"] == GRINDER) or \
+                (stage == "cup_from_stack" and state["cup"] == ARM):
+            completed.append(stage)
+        elif stage == "place_cup" and state["cup"] == SILVIA:
+            machine.ensure_tool(None)
+            completed.append(stage)
+        else:
+            machine.ensure_tool(STAGE_TOOLS.get(stage))
+    checkpoint.save(completed=completed, running=None)
+
+
+def run_checkpointed(machine, checkpoint, parameters=cm.PARAMETERS):
+    """ Run the coffee sequence, skipping stages a previous run completed.
+    A checkpoint of a finished coffee starts a new one, its last stage has already returned the tool to the
+    stand. The parameters of an interrupted coffee are kept.
+    machine: CoffeeMachine
+    checkpoint: Checkpoint, from Checkpoint.load to resume
+    parameters: dictionary of stage parameters for a new coffee
+    """
+    if checkpoint.finished():
+        checkpoint.state = initial_state(parameters)
+    elif checkpoint.state["completed"] or checkpoint.state["running"]:
+        machine.log("Resuming after " + ", ".join(checkpoint.state["completed"]))
+    checkpoint.save()
+    machine.mounted = checkpoint.state["mounted"]
+    # The filter entry is calculated by insert_filter_grinder, which may have run in an earlier process
+    machine.set_filter_entry()
+    checkpoint.attach(machine)
+    try:
+        if checkpoint.state["running"] is not None:
+            recover(machine, checkpoint)
+        parameters = checkpoint.state["parameters"]
+        for stage, parameter in STAGES:
+            if stage in checkpoint.state["completed"]:
+                continue
+            checkpoint.save(running=stage)
+            machine.run_stage(stage, *(() if parameter is None else (parameters[parameter],)))
+            changes = {"completed": checkpoint.state["completed"] + [stage], "running": None,
+                       "mounted": machine.mounted}
+            if stage == "insert_filter_silvia":
+                # The TA takes the portafilter off the tool and puts it in the coffee machine
+                changes["filter"] = SILVIA
+            checkpoint.save(**changes)
+    finally:
+        checkpoint.detach(machine)
+
+
+def main():
+    machine = cm.station_machine(cm.rl.Robolink())
+    run_checkpointed(machine, Checkpoint.load())
+    machine.close_log()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,14 @@
 # Documentation: https://robodk.com/doc/en/RoboDK-API.html
 # Reference:     https://robodk.com/doc/en/PythonAPI/index.html
 import robolink as rl  # RoboDK API
-import robodk as rdk  # Robot toolbox
 import datetime
+import numpy as np
+from poses import transl, roty, rotz, compose, robodk_target
+from frame_graph import FrameGraph
+from waits import Waiter, run_program, station_flag
+import event_log as el
+import station_store
 
-STRIP = 10
 HALFPI = 1.570796326794897
 PI = HALFPI * 2
 
@@ -40,57 +44,69 @@ SCRAPER = "scraper"
 TAMPER = "tamper"
 BALL = "ball"
 ENTRY = "entry"
+AVOIDSILVIA = "avoidsilvia"
 SILVIAPOWERON = "silviapoweron"
 SILVIAPOWEROFF = "silviapoweroff"
 GRINDERPOWERON = "grinderpoweron"
 GRINDERPOWEROFF = "grinderpoweroff"
+CUPPLACE = CUP + "place"
+GRIND = "Grind"
+TAINSERT = "TA insert filter"
+BREW = "Brew"
+TAINSERTED = "TAInserted"   # Station parameter the TA sets to 1 once the portafilter is in the coffee machine
+
+# Coffee making sequence, each stage is a CoffeeMachine method and the name of its parameter (if any)
+SEQUENCE = [("insert_filter_grinder", None),
+            ("turn_on_grinder", None),
+            ("pull_lever_multiple", "N"),
+            ("scrape_filter", "scraper_height"),
+            ("tamp_filter", "tamp_height"),
+            ("insert_filter_silvia", None),
+            ("cup_from_stack", None),
+            ("place_cup", "height"),
+            ("turn_on_silvia", "time"),
+            ("pickup_coffee", "height")]
+# Stage ending a coffee that another follows, it leaves the served cup and returns the arm home without a tool
+CLEAR = ("clear_arm", "height")
+
+# Constants for operation
+PARAMETERS = {"N": 3,               # amount of times leaver needs to be pulled
+              "height": 98,         # cup height above base of coffee machine
+              "time": 12,           # Duration to press coffee machine button for
+              "scraper_height": 8,  # distance from scraper to coffee filter
+              "tamp_height": 15}    # depth to push filter into tamper
+ENTRY_PITCH = -0.04     # rad, tilt of the portafilter as it enters the grinder holder
+ENTRY_SHIFT = -2.0      # mm, offset of the portafilter along its x axis as it enters the grinder holder
+
+# Every named frame appearing in reference_frames.csv, used to split concatenated names into graph edges
+FRAMES = [GLOBAL, SILVIA, GRINDER, CUPSTACK, CUP, CROSS, TCP, TOOL, PUSHER, PULLER, LEVER, GRINDERMOUNT, FILTERMOUNT,
+          CUPMOUNT, FILTER, SCRAPER, TAMPER, BALL, FILTER + ENTRY, SILVIAPOWERON, SILVIAPOWEROFF, GRINDERPOWERON,
+          GRINDERPOWEROFF, CUPPLACE]
+
+
+def station_conditions(RDK):
+    """ Conditions that end pauses early on a connected station.
+    RDK: Robolink
+    output: dictionary of wait label -> condition, see CoffeeMachine.pause
+    """
+    return {TAINSERT: station_flag(RDK, TAINSERTED)}
 
 
 def read_frames(filename):
-    """ Read transformation matrices from CSV file and convert into dictionary of RoboDK matrices.
+    """ Read transformation matrices from CSV file and convert into dictionary of pose arrays.
     filename: file path to CSV file
-    output: dictionary of transformation matrices where key is a string
+    output: dictionary of (4, 4) float64 transformation matrices where key is a string
      composed of the first frame and second frame titles
     """
-    # Open file
-    file = open(filename, "r")
-    lines = file.readlines()
-    file.close()
-
-    # Read each line of file and convert into RoboDK matrix
-    frames = {}
-    for line in lines:
-        segments = line.rstrip().split(",")
-        name = segments[0]
-        values = [float(i) for i in segments[1:]]
-        # CSV file is formatted as each row sequentially separated by ','
-        transform = rdk.Mat([values[0:4],
-                             values[4:8],
-                             values[8:12],
-                             values[12:16]])
-        frames[name] = transform
-    return frames
+    return station_store.load_frames(filename).as_dict()
 
 
 def read_joint_angles(filename):
-    """ Read joint angles from CSV file and convert into dictionary of RoboDK matrices.
+    """ Read joint angles from CSV file and convert into dictionary of joint arrays.
     filename: file path to CSV file
     output: dictionary of joint angles  where key describing the final pose
     """
-    # Open file
-    file = open(filename, "r")
-    lines = file.readlines()
-    file.close()
-
-    # Read each line of file and convert into RoboDK matrix
-    joint_angles = {}
-    for line in lines:
-        segments = line.rstrip().split(",")
-        name = segments[0]
-        values = [float(i) for i in segments[1:]]
-        angles = rdk.Mat(values)
-        joint_angles[name] = angles
-    return joint_angles
+    return station_store.load_joint_angles(filename).as_dict()
 
 
 class CoffeeMachine(object):
@@ -98,44 +114,75 @@ class CoffeeMachine(object):
     as well as logging results.
     """
 
-    def __init__(self, robot, master_tool, RDK, frames, joint_angles, log_filename="~/log.txt"):
+    def __init__(self, robot, master_tool, RDK, frames, joint_angles, log_filename="~/log.jsonl"):
         self.robot = robot
         self.master_tool = master_tool
-        self.frames = frames
+        self.frames = frames    # FrameGraph of reference frames
+        self.home = HOME        # Home target, replaced by the station item when connected
         self.joint_angles = joint_angles
         self.RDK = RDK
         self.log_filename = log_filename
-
-        # Open log file and write current date and time
-        self.log_file = open(self.log_filename, "a")
-        self.log("\n\n")
+        self.stage = None       # Name of the stage currently running
+        self.waiter = Waiter()
+        # Wait label -> function returning True once the wait can finish early
+        self.conditions = station_conditions(RDK) if RDK is not None else {}
+        self.mounted = None     # Tool attached to the master tool
+        self.entry_pitch = ENTRY_PITCH
+        self.entry_shift = ENTRY_SHIFT
+
+        # Open event log and write current date and time, no log is kept without a filename
+        self.event_log = el.EventLog(self.log_filename) if self.log_filename else None
         self.log(datetime.datetime.now().ctime())
 
+    def record(self, kind, label="", target=None):
+        """ Add a structured record to the event log, serialisation happens on the log writer thread
+        kind: record kind from event_log.KINDS
+        label: description of the event
+        target: pose, joints or duration associated with the event
+        """
+        if self.event_log:
+            self.event_log.record(kind, label, target, self.stage)
+
     def log(self, message):
         """ Write message to log file
         message: message as a string
         """
-        self.log_file.write(message + "\n")
+        self.record(el.MESSAGE, message)
+
+    def log_stage(self, title):
+        """ Mark the start of a stage in the log
+        title: description of the stage
+        """
+        self.record(el.STAGE, title)
 
     def close_log(self):
-        """ Close log file """
-        self.log_file.close()
+        """ Flush and close log file """
+        if self.event_log:
+            self.event_log.close()
+
+    def run_stage(self, stage, *args, **kwargs):
+        """ Run one stage of the coffee making sequence
+        stage: name of the CoffeeMachine method for the stage
+        args, kwargs: parameters for the stage
+        """
+        self.stage = stage
+        getattr(self, stage)(*args, **kwargs)
 
     def MoveJ(self, matrix, pos=""):
         """ Perform joint move to new position and write message to log
         matrix: Either transform matrix describing TCP in global frame or joint angle configuration
         pos: message to be written to log file describing movement
         """
-        self.robot.MoveJ(matrix)
-        self.log("Joint move to new position: {}".format(pos))
+        self.robot.MoveJ(robodk_target(matrix))
+        self.record(el.MOVEJ, pos, matrix)
 
     def MoveL(self, matrix, pos=""):
         """ Perform linear move to new position and write message to log
         matrix: Either transform matrix describing TCP in global frame or joint angle configuration
         pos: message to be written to log file describing movement
         """
-        self.robot.MoveL(matrix)
-        self.log("Linear move to new position: {}".format(pos))
+        self.robot.MoveL(robodk_target(matrix))
+        self.record(el.MOVEL, pos, matrix)
 
     def tool_mount(self, name, pickup=True, location=STAND):
         """ General function for moving to and attaching/detaching tools.
@@ -143,6 +190,22 @@ class CoffeeMachine(object):
         pickup: boolean to determine whether to attach (True) or detach (False) tool
         location: location of tool as string, options are tool stand or grinder
         """
+        self.change_tool(name, pickup, location)
+
+    def ensure_tool(self, name):
+        """ Attach a tool from the stand unless it is already attached, returning any other tool first
+        name: name of tool as string, None for the bare master tool
+        """
+        if self.mounted == name:
+            return
+        if self.mounted is not None:
+            self.change_tool(self.mounted, False)
+        if name is not None:
+            self.change_tool(name, True)
+
+    def change_tool(self, name, pickup=True, location=STAND):
+        """ Move to and attach/detach a tool, see tool_mount """
+        self.mounted = name if pickup else None
         # Determine which tool to use
         if name == GRINDER:
             mount = GRINDERMOUNT
@@ -163,106 +226,123 @@ class CoffeeMachine(object):
         operation = ATTACH if pickup else DETACH
         # Create string function name and run command, logging output
         name = func + operation + " (" + location.capitalize() + ")"
-        self.log("Tool Mount Operation - Tool: {}, Operation:{}".format(name, operation))
-        self.RDK.RunProgram(name, True)
+        self.record(el.PROGRAM, name)
+        self.run_program(name)
         # Cup tool occasionally has issues with defining reference frame so redefine as TCP
         if func == CUPFUNC:
-            self.robot.setPoseTool(self.master_tool)
+            self.reset_tool()
 
     def cup_tool(self, operation):
         """ Operate cup tool
         operation: String describing whether to open or close tool
         """
         name = CUPFUNC + operation
-        self.log("Cup Tool Operation - Operation:{}".format(operation))
-        self.RDK.RunProgram(name, True)
+        self.record(el.PROGRAM, name)
+        self.run_program(name)
+
+    def run_program(self, name):
+        """ Run a station subprogram and wait for it to finish
+        name: name of program in RoboDK station
+        """
+        run_program(self.RDK, self.waiter, name)
+
+    def reset_tool(self):
+        """ Redefine the robot tool as the master tool """
+        self.robot.setPoseTool(self.master_tool)
+
+    def pause(self, seconds, label):
+        """ Wait with the robot stationary until the condition registered for label holds
+        GRIND and BREW are process times with no condition, only TAINSERT can finish early.
+        seconds: maximum time to wait, the full time is waited if no condition is registered
+        label: name of the wait, e.g. GRIND, TAINSERT or BREW
+        """
+        record = self.waiter.wait(label, seconds, self.conditions.get(label))
+        self.record(el.WAIT, label, record.elapsed)
+
+    def set_filter_entry(self):
+        """ Calculate transform matrix for filter in holder of grinder, used when inserting and removing it """
+        self.frames.set_edge(GLOBAL, FILTER + ENTRY, compose(
+            self.frames.get(GLOBAL, FILTER), self.frames.get(TCP, FILTER), roty(self.entry_pitch),
+            transl(self.entry_shift, 0, 0), self.frames.get(FILTER, TOOL), transl(0, 0, 4), self.frames.get(TOOL, TCP)))
 
     def insert_filter_grinder(self):
         """" Insert the portafilter into the grinder machine """
-        self.log("\n" + STRIP * "-" + " Insert filter in grinder " + "-" * STRIP)
+        self.log_stage("Insert filter in grinder")
         # Start in home position
-        self.MoveJ(self.frames[HOME], HOME)
+        self.MoveJ(self.home, HOME)
 
         # global2ball = self.frames[GLOBAL + GRINDER] * self.frames[GRINDER + BALL]
         # filter_over_ball = rdk.transl(0, 0, 60) * global2ball * rdk.roty(-0.1) * self.frames[FILTER + TOOL] \
         #     * self.frames[TOOL + TCP]
 
-        # Calculate transform matrix for filter in holder of grinder
-        self.frames[GLOBAL+FILTER+ENTRY] = self.frames[GLOBAL+FILTER] * self.frames[TCP + TOOL] * \
-            self.frames[TOOL + FILTER] * rdk.roty(-0.04) * rdk.transl(-2, 0, 0) \
-            * self.frames[FILTER + TOOL] * rdk.transl(0, 0, 4) * self.frames[TOOL + TCP]
+        self.set_filter_entry()
 
         # Mount filter tool and insert into machine
         self.tool_mount(FILTER, True)
-        self.MoveJ(rdk.rotz(HALFPI) * self.frames[GLOBAL + FILTERMOUNT], "Intermediate point")
+        self.MoveJ(compose(rotz(HALFPI), self.frames.get(GLOBAL, FILTERMOUNT)), "Intermediate point")
         self.MoveJ(self.joint_angles[FILTER + ENTRY], "Filter entry point")
         # self.MoveJ(filter_over_ball) # Used to determine joint angles, not needed
-        self.MoveL(self.frames[GLOBAL + FILTER + ENTRY], "Insert filter")
+        self.MoveL(self.frames.get(GLOBAL, FILTER + ENTRY), "Insert filter")
         # Detach tool in grinder and back away
         self.tool_mount(FILTER, False, GRINDER)
         self.MoveJ(self.joint_angles[FILTER + ENTRY], "Return to filter entry point")
 
     def turn_on_grinder(self):
         """ Turn on grinder """
-        self.log("\n" + STRIP * "-" + " Turn on grinder " + "-" * STRIP)
+        self.log_stage("Turn on grinder")
         # Attach grinder tool
         self.tool_mount(GRINDER, True)
 
-        # Calculate transform for grinder on button
-        global2on = self.frames[GLOBAL + GRINDER] * self.frames[GRINDER + GRINDERPOWERON] * rdk.rotz(PI)\
-            * self.frames[PUSHER + TOOL] * self.frames[TOOL + TCP]
-        release = global2on * rdk.transl(0, 0, -10)
-        push = global2on * rdk.transl(0, 0, 7)
-        intermediate_point = rdk.rotz(0.9) * self.frames[GLOBAL + GRINDERMOUNT]
+        # Calculate transforms for grinder on and off buttons in one batch
+        buttons = np.stack([self.frames.get(GLOBAL, GRINDERPOWERON), self.frames.get(GLOBAL, GRINDERPOWEROFF)])
+        global2on, global2off = compose(buttons, rotz(PI), self.frames.get(PUSHER, TCP))
+        # Release and push offsets for both buttons
+        release_on, push_on, release_off, push_off = compose(
+            np.stack([global2on, global2on, global2off, global2off]), transl(0, 0, [-10, 7, -10, 7]))
+        intermediate_point = compose(rotz(0.9), self.frames.get(GLOBAL, GRINDERMOUNT))
 
         self.MoveJ(intermediate_point, "Avoid silvia and cups")
         self.MoveJ(self.joint_angles[GRINDERPOWERON], "Move to on button and ensure lever arm on left")
-        self.MoveJ(release, "Move to on button")
-        self.MoveL(push, "Push on button")
-        self.MoveJ(release, "Release on button")
+        self.MoveJ(release_on, "Move to on button")
+        self.MoveL(push_on, "Push on button")
+        self.MoveJ(release_on, "Release on button")
         # Wait for grinder to grind beans
-        rdk.pause(3)
-
-        # Calculate transform for grinder off button
-        global2off = self.frames[GLOBAL + GRINDER] * self.frames[GRINDER + GRINDERPOWEROFF] * rdk.rotz(PI) \
-            * self.frames[PUSHER + TOOL] * self.frames[TOOL + TCP]
-        release = global2off * rdk.transl(0, 0, -10)
-        push = global2off * rdk.transl(0, 0, 7)
-        intermediate_point = rdk.transl(-50, -40, 30) * release
-
-        self.MoveJ(release, "Move to off button")
-        self.MoveL(push, "Push off button")
-        self.MoveJ(release, "Release off button")
+        self.pause(3, GRIND)
+
+        intermediate_point = compose(transl(-50, -40, 30), release_off)
+
+        self.MoveJ(release_off, "Move to off button")
+        self.MoveL(push_off, "Push off button")
+        self.MoveJ(release_off, "Release off button")
         self.MoveJ(intermediate_point, "Move away from grinder ready for lever movement")
 
     def pull_lever_multiple(self, n_pulls):
         """ Pull lever n_pulls times using grinder tool
         n_pulls: int describing number of times to pull lever
         """
-        self.log("\n" + STRIP * "-" + " Pull lever " + "-" * STRIP)
+        self.log_stage("Pull lever")
 
         # Calculate transform for start position of lever
-        global2start = self.frames[GLOBAL + GRINDER] * self.frames[GRINDER + LEVER] * rdk.transl(-5, -20, 0) \
-            * self.frames[PULLER + TOOL] * self.frames[TOOL + TCP]
+        global2lever = compose(self.frames.get(GLOBAL, LEVER), transl(-5, -20, 0))
+        global2start = compose(global2lever, self.frames.get(PULLER, TCP))
         # Determine mid point of bi-linear movement
-        mid_pull = global2start * rdk.transl(0, 0, -50)
+        mid_pull = compose(global2start, transl(0, 0, -50))
         # Adjust angle to allow rotation about the grinder
-        angle = self.frames[GLOBAL + GRINDER] * self.frames[GRINDER + LEVER] * rdk.transl(-5, -20, 0) \
-            * rdk.transl(0, 0, -50) * rdk.roty(0.436332) * self.frames[PULLER + TOOL]
-        # Complete bi-linear pull
-        end_pull = angle * rdk.transl(0, 0, -50) * self.frames[TOOL + TCP]
-        exit_pos = angle * rdk.transl(0, 0, -50) * rdk.transl(50, -50, 0) * self.frames[TOOL + TCP]
+        angle = compose(global2lever, transl(0, 0, -50), roty(0.436332), self.frames.get(PULLER, TOOL))
+        # Angled point, complete bi-linear pull and exit position in one batch
+        change_angle, end_pull, exit_pos = compose(
+            angle, np.stack([np.eye(4), transl(0, 0, -50), transl(50, -50, -50)]), self.frames.get(TOOL, TCP))
 
         # Function definition for bi-linear pull movement of lever
         def pull(machine):
             machine.MoveJ(global2start, "Move to lever")
             machine.MoveJ(mid_pull, "Pull grinder lever")
-            machine.MoveJ(angle * self.frames[TOOL + TCP], "Change angle")
+            machine.MoveJ(change_angle, "Change angle")
             machine.MoveJ(end_pull, "Pull grinder lever")
 
         # Reverse bi-linear pull in preparation for another pull
         def release(machine):
-            machine.MoveJ(angle * self.frames[TOOL + TCP], "Change angle")
+            machine.MoveJ(change_angle, "Change angle")
             machine.MoveJ(mid_pull, "Pull grinder lever")
             machine.MoveJ(global2start, "Move to lever")
 
@@ -282,25 +362,22 @@ class CoffeeMachine(object):
         """ Remove filter from grinder and scrape off excess grinds using scraper
         scraper_height: int allowing tuning of vertical position of filter w.r.t scraper
         """
-        self.log("\n" + STRIP * "-" + " Scrape coffee from filter " + "-" * STRIP)
+        self.log_stage("Scrape coffee from filter")
 
         self.MoveJ(self.joint_angles[FILTER + ENTRY], "Move to filter at grinder entry point")
         # Attach portafilter tool at grinder
         self.tool_mount(FILTER, True, GRINDER)
 
         # Calculate transforms for removing portafilter tool
-        lift_off_ball = self.frames[GLOBAL + FILTER + ENTRY]
-        pull_out = lift_off_ball * rdk.transl(0, 0, -70)
+        lift_off_ball = self.frames.get(GLOBAL, FILTER + ENTRY)
+        pull_out = compose(lift_off_ball, transl(0, 0, -70))
 
         self.MoveL(lift_off_ball, "Lift filter off ball")
         self.MoveL(pull_out, "Pull out filter tool")
 
         # Positions for start and end of scraper movement. Dependant on scraper_height
-        global2scraper = self.frames[GLOBAL + CROSS] * self.frames[CROSS + SCRAPER] * rdk.transl(scraper_height, 0, 0)
-        start = global2scraper * rdk.transl(0, 0, -60) * self.frames[SCRAPER + FILTER] \
-            * self.frames[FILTER + TOOL] * self.frames[TOOL + TCP]
-        end = global2scraper * rdk.transl(0, 0, 40) * self.frames[SCRAPER + FILTER] * self.frames[FILTER + TOOL] \
-            * self.frames[TOOL + TCP]
+        global2scraper = compose(self.frames.get(GLOBAL, SCRAPER, [CROSS]), transl(scraper_height, 0, 0))
+        start, end = compose(global2scraper, transl(0, 0, [-60, 40]), self.frames.get(SCRAPER, TCP))
 
         self.MoveJ(start, "Scraper start")
         self.MoveL(end, "Push through scraper")
@@ -310,17 +387,17 @@ class CoffeeMachine(object):
         """ Tamp coffee in filter using portafilter tool
         depth: how deep to push the tamper into the filter, int
         """
-        self.log("\n" + STRIP * "-" + " Tamp coffee filter " + "-" * STRIP)
+        self.log_stage("Tamp coffee filter")
 
         # Calculate transforms for positioning filter below tamper and tamping
-        global2tamper = self.frames[GLOBAL + CROSS] * self.frames[CROSS + TAMPER]
-        intermediate = global2tamper * rdk.transl(0, 0, -100) * self.frames[TAMPER + FILTER] * \
-            self.frames[FILTER + TOOL] * self.frames[TOOL + TCP]
-        start = global2tamper * self.frames[TAMPER + FILTER] * self.frames[FILTER + TOOL] \
-            * self.frames[TOOL + TCP]
-
-        end = global2tamper * self.frames[SCRAPER + FILTER] * rdk.transl(depth, 0, 0) * self.frames[FILTER + TOOL] \
-            * self.frames[TOOL + TCP]
+        global2tamper = self.frames.get(GLOBAL, TAMPER, [CROSS])
+        tamper2filter = self.frames.get(TAMPER, FILTER)
+        intermediate, start, end = compose(
+            global2tamper,
+            np.stack([compose(transl(0, 0, -100), tamper2filter),
+                      tamper2filter,
+                      compose(self.frames.get(SCRAPER, FILTER), transl(depth, 0, 0))]),
+            self.frames.get(FILTER, TCP))
 
         # self.MoveJ(intermediate, "Move to tamper") # Used to determine joint angles
         self.MoveJ(self.joint_angles[TAMPER + ENTRY], "Move to tamper")
@@ -331,49 +408,44 @@ class CoffeeMachine(object):
 
     def insert_filter_silvia(self):
         """ Move portafilter tool filled with grinds to coffee machine for TA to insert into coffee machine """
-        self.log("\n" + STRIP * "-" + " Move filter to silvia " + "-" * STRIP)
+        self.log_stage("Move filter to silvia")
 
         # Calculate position of filter next to coffee machine
-        intermediate = rdk.rotz(-1.5) * self.frames[GLOBAL + CROSS] * self.frames[CROSS + TAMPER] * \
-            rdk.transl(70, 0, -100) * self.frames[TAMPER + FILTER] * self.frames[FILTER + TOOL] \
-            * self.frames[TOOL + TCP]
-        entry = self.frames[GLOBAL+SILVIA] * rdk.transl(0, -100, -170) * self.frames[SILVIA+FILTER] \
-            * self.frames[FILTER + TOOL] * self.frames[TOOL + TCP]
+        filter2tcp = self.frames.get(FILTER, TCP)
+        intermediate = compose(rotz(-1.5), self.frames.get(GLOBAL, TAMPER, [CROSS]), transl(70, 0, -100),
+                               self.frames.get(TAMPER, FILTER), filter2tcp)
+        entry = compose(self.frames.get(GLOBAL, SILVIA), transl(0, -100, -170), self.frames.get(SILVIA, FILTER),
+                        filter2tcp)
 
         # Move filter to coffee machine and allow time for TA to insert into machine
         self.MoveJ(intermediate)
         self.MoveL(entry, "Filter to silvia")
-        rdk.pause(15)   # Time for TA to remove filter tool and insert into machine
-
-        # Used to calculate joint angles
-        # avoid_silvia = rdk.rotz(HALFPI) * self.frames[GLOBAL + CUPMOUNT]
-        # self.MoveJ(avoid_silvia, "Avoid silvia")
+        self.pause(15, TAINSERT)  # Time for TA to remove filter tool and insert into machine
+        self.mounted = None
 
         # Remove tool from coffee machine and move to tool mount in preparation for next step
-        avoid_silvia_joints = [-88.986265, -77.001952, -78.888716, -114.109332, 90.000000, -178.986265]
-        self.MoveJ(avoid_silvia_joints, "Avoid silvia")
+        # Joint angles of rotz(HALFPI) * global2cupmount, see generate_joint_angles.py
+        self.MoveJ(self.joint_angles[AVOIDSILVIA], "Avoid silvia")
         self.MoveJ(self.joint_angles[CUPMOUNT])
 
     def cup_from_stack(self):
         """ Function that picks up a cup from the cup from the stack
         """
-        self.log("\n" + STRIP * "-" + " Get cup from stack " + "-" * STRIP)
+        self.log_stage("Get cup from stack")
         # Attach cup tool
         self.tool_mount(CUP, True)
         # Position at the centre of the top cup
-        cup_pickup_matrix = self.frames[GLOBAL + CUPSTACK] * self.frames[CUPSTACK + CUP] \
-            * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
+        cup_pickup_matrix = self.frames.get(GLOBAL, TCP, [CUPSTACK, CUP])
         # Used to avoid other tools when coming from the tool mount
-        rotate_90 = rdk.rotz(HALFPI) * self.frames[GLOBAL+CUPMOUNT]
-        # Puts the robot in the correct orientation to pick up a cup
-        intermediate = rdk.transl(0, 0, 150) * self.frames[GLOBAL + CUPSTACK] * self.frames[CUPSTACK + CUP] \
-            * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
+        rotate_90 = compose(rotz(HALFPI), self.frames.get(GLOBAL, CUPMOUNT))
+        # Global offsets from the cup: correct orientation to pick up a cup, level with the top cup
+        # and clear of the stack once the cup is held
+        intermediate, before_cup, remove_cup = compose(transl([0, 0, 0], [0, 100, 0], [150, 0, 300]),
+                                                       cup_pickup_matrix)
         # Move operations
         self.MoveJ(rotate_90, "Move to stack")  # Avoid other tools
         self.MoveJ(self.joint_angles[CUPSTACK + ENTRY], "Move to correct orientation")  # get correct orientation
         self.MoveJ(intermediate)
-        # Point to move the cup tool up to the top cup
-        before_cup = rdk.transl(0, 100, 0) * cup_pickup_matrix
         # Move operation
         self.MoveL(before_cup, "Move to cup level")
         # Open cup tool
@@ -382,28 +454,29 @@ class CoffeeMachine(object):
         self.MoveL(cup_pickup_matrix, "Slide to cup edge")
         # Close cup tool
         self.cup_tool(CLOSE)
-        # Point that moves the cup away from the stack
-        remove_cup = rdk.transl(0, 0, 300) * cup_pickup_matrix
         # Move operations
         self.MoveL(remove_cup, "Remove cup")
         self.MoveJ(self.joint_angles["rotated" + CUP], "Rotate cup")
 
+    def silvia_cup_targets(self, height, offsets):
+        """ Calculate cup tool targets at the coffee machine drip tray in one batch
+        height: adjusts the height of the cup tool from the surface of the drip tray
+        offsets: list of (y, z) offsets from the cup position in the silvia cup frame
+        output: (N, 4, 4) array of TCP targets, one per offset
+        """
+        y, z = np.transpose(offsets)
+        return compose(self.frames.get(GLOBAL, CUP, [SILVIA]), transl(height, y, z), self.frames.get(CUP, TCP))
+
     def place_cup(self, height):
         """ Function to place the coffee cup under the coffee CoffeeMachine
         height: varibale used to adjust the height of the cup tool above tamp
         drip tray of the coffee machine
         """
-        self.log('\n' + STRIP * '-' + ' Cup to Silvia ' + '-' * STRIP)
-        # Point that defines pick up location of the cup
-        end_point = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP] \
-            * rdk.transl(height, 7, 0) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
-        # Stand off position to allow for the cup tool to be opened.
-        inter = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP] \
-            * rdk.transl(height, 15, -100) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
-        # Position further out from the stand off position to ensure that that
-        # the tool does not hit the porta filter.
-        out = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP] \
-            * rdk.transl(height, 50, -150) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
+        self.log_stage("Cup to Silvia")
+        # Point that defines pick up location of the cup, stand off position to allow for the cup tool to be
+        # opened and a position further out from the stand off position to ensure that that the tool does not
+        # hit the porta filter.
+        end_point, inter, out = self.silvia_cup_targets(height, [(7, 0), (15, -100), (50, -150)])
 
         # Move operations
         self.MoveJ(out, "Move inline with filter")
@@ -423,29 +496,43 @@ class CoffeeMachine(object):
         coffee into the cup
         time: the time that the coffee machine will be turned on for
         """
-        self.log("\n" + STRIP * "-" + " Turn on coffee machine " + "-" * STRIP)
-        # Attach the grinder tool
-        self.tool_mount(GRINDER, True)
+        self.log_stage("Turn on coffee machine")
+        self.start_brew()
+        # Pause for set time to allow coffee to be made
+        self.pause(time, BREW)
+        self.stop_brew()
 
-        # Move to button
-        # Position for the on button
-        on = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + SILVIAPOWERON] \
-            * self.frames[PUSHER + TOOL] * self.frames[TOOL + TCP]
-        # Position for the off button
-        off = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + SILVIAPOWEROFF] \
-            * self.frames[PUSHER + TOOL] * self.frames[TOOL + TCP]
-        # Intermidiate point that was used to avoid the other tools on the way to the coffee machin
-        intermediate_point = rdk.transl(120, 100, 0) * on
+    def silvia_buttons(self):
+        """ Calculate grinder tool targets for the coffee machine on and off buttons
+        output: tuple (on, off, push on, push off, intermediate point) of (4, 4) TCP targets
+        """
+        # Positions for the on and off buttons
+        buttons = np.stack([self.frames.get(GLOBAL, SILVIAPOWERON), self.frames.get(GLOBAL, SILVIAPOWEROFF)])
+        on, off = compose(buttons, self.frames.get(PUSHER, TCP))
         # Z translations to push the buttons
-        pushOn = on * rdk.transl(0, 0, 6)
-        pushOff = off * rdk.transl(0, 0, 6)
+        pushOn, pushOff = compose(np.stack([on, off]), transl(0, 0, 6))
+        # Intermidiate point that was used to avoid the other tools on the way to the coffee machin
+        intermediate_point = compose(transl(120, 100, 0), on)
+        return on, off, pushOn, pushOff, intermediate_point
+
+    def start_brew(self):
+        """ Attach the grinder tool and press the coffee machine on button, leaving the grinder tool attached """
+        # Attach the grinder tool
+        self.tool_mount(GRINDER, True)
+        on, off, pushOn, pushOff, intermediate_point = self.silvia_buttons()
         # Move operations
         self.MoveJ(intermediate_point, "Avoid tools")
         self.MoveJ(on, "Move to button")
         self.MoveL(pushOn, "Push button")
         self.MoveJ(on, "Release")
-        # Pause for set time to allow coffee to be made
-        rdk.pause(time)
+
+    def stop_brew(self, approach=False):
+        """ Press the coffee machine off button and detach the grinder tool
+        approach: True if the robot comes from the tool stand rather than the on button
+        """
+        on, off, pushOn, pushOff, intermediate_point = self.silvia_buttons()
+        if approach:
+            self.MoveJ(intermediate_point, "Avoid tools")
         # Move operations
         self.MoveJ(off, "Move to off")
         self.MoveL(pushOff, "Push button")
@@ -459,19 +546,13 @@ class CoffeeMachine(object):
         height: adjusts the height of the cup tool from the surface of the drip tray
         """
 
-        self.log('\n' + STRIP * '-' + ' Cup to Rodney ' + '-' * STRIP)
+        self.log_stage("Cup to Rodney")
         # Attach the cup tool
         self.tool_mount(CUP, True)
 
-        # Define the end position that picks up the coffee cup
-        end_point = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP] \
-            * rdk.transl(height, 7, 0) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
-        # Stand off point next to the coffee machine.
-        inter = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP] \
-            * rdk.transl(height, 15, -100) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
-        # Position further away from the coffee machine to avoid hitting the portafilter in simulation.
-        out = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP] \
-            * rdk.transl(height, 60, -180) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
+        # Define the end position that picks up the coffee cup, a stand off point next to the coffee machine
+        # and a position further away from the coffee machine to avoid hitting the portafilter in simulation.
+        end_point, inter, out = self.silvia_cup_targets(height, [(7, 0), (15, -100), (60, -180)])
         # Move operations
         self.MoveJ(out, "Cup entry point")
         self.MoveJ(inter, "Intermediate point")
@@ -482,13 +563,19 @@ class CoffeeMachine(object):
         self.cup_tool(CLOSE)
         self.MoveJ(inter, "Intermediate point")
         self.MoveJ(out, "Remove cup")
+        self.serve_cup(height)
+
+    def serve_cup(self, height):
+        """ Lift the held cup clear of the coffee machine and put it down on top of it
+        height: adjusts the height of the cup tool from the surface of the drip tray
+        """
+        out, = self.silvia_cup_targets(height, [(60, -180)])
         # Position to move the cup up to get above the coffee machine
-        up = rdk.transl(0, 0, 350) * out
+        up = compose(transl(0, 0, 350), out)
         # Position to lower the cup down onto the coffee machine
-        down = self.frames[GLOBAL + SILVIA] * self.frames[SILVIA + CUP+"place"] \
-            * rdk.transl(height-10, 0, 0) * self.frames[CUP + TOOL] * self.frames[TOOL + TCP]
+        down = compose(self.frames.get(GLOBAL, CUPPLACE), transl(height-10, 0, 0), self.frames.get(CUP, TCP))
         # Position to move the cup over to the centre of the coffee machine
-        over_silvia = rdk.transl(0, 0, 50) * down
+        over_silvia = compose(transl(0, 0, 50), down)
         # Move operations
         self.MoveL(up, "Lift cup up")
         self.MoveJ(over_silvia, "Position over silvia")
@@ -497,54 +584,64 @@ class CoffeeMachine(object):
         self.cup_tool(OPEN)
         # Finished!
 
+    def clear_arm(self, height):
+        """ Back the open cup tool away from the served cup, return the tool to the stand and move home
+        height: adjusts the height of the cup tool from the surface of the drip tray, as for serve_cup
+        """
+        self.log_stage("Clear arm")
+        if self.mounted == CUP:
+            back = compose(self.frames.get(GLOBAL, CUPPLACE), transl(height-10, 0, -100), self.frames.get(CUP, TCP))
+            self.MoveL(back, "Back away from cup")
+        self.ensure_tool(None)
+        self.MoveJ(self.home, HOME)
+
+
+def make_coffee(machine, parameters=PARAMETERS):
+    """ Run the full coffee making sequence
+    machine: CoffeeMachine used to run each stage
+    parameters: dictionary of stage parameters, see PARAMETERS
+    """
+    for stage, parameter in SEQUENCE:
+        args = () if parameter is None else (parameters[parameter],)
+        machine.run_stage(stage, *args)
 
-def main():
-    # Read transformation matrices and joint angles from CSV file
-    frame_filename = "reference_frames.csv"
-    joint_filename = "joint_angles.csv"
-    frames = read_frames(frame_filename)
-    joint_angles = read_joint_angles(joint_filename)
-    # Specify logfile name
-    logfile = "output.txt"
-
-    # Initialise robot programming environment and define reference frames
-    RDK = rl.Robolink()
+
+def connect_robot(RDK):
+    """ Select the UR5 of a station and set its reference frame and tool
+    RDK: Robolink, or the offline station from offline_robodk
+    output: tuple (robot, master tool) of station items
+    """
     robot = RDK.Item("UR5")
-    world_frame = RDK.Item("UR5 Base")
-    home = RDK.Item("Home")  # existing target in station
     master_tool = RDK.Item("Master Tool")
-    # Set reference frames for robot
-    robot.setPoseFrame(world_frame)
+    robot.setPoseFrame(RDK.Item("UR5 Base"))
     robot.setPoseTool(master_tool)
+    return robot, master_tool
+
 
-    # Initialise coffee machine and calculate inverses of required transform matrices
-    machine = CoffeeMachine(robot, master_tool, RDK, frames, joint_angles, logfile)
-    machine.frames[HOME] = home
-    machine.frames[TOOL + TCP] = frames[TCP + TOOL].inv()
-    machine.frames[BALL + TOOL] = machine.frames[TOOL + BALL].inv()
-    machine.frames[FILTER + TOOL] = machine.frames[TOOL + FILTER].inv()
-    machine.frames[PUSHER + TOOL] = machine.frames[TOOL + PUSHER].inv()
-    machine.frames[PULLER + TOOL] = machine.frames[TOOL + PULLER].inv()
-    machine.frames[CUP + TOOL] = machine.frames[TOOL + CUP].inv()
-
-    # Define constants for operation
-    N = 3  # amount of times leaver needs to be pulled
-    height = 98  # cup height above base of coffee machine
-    time = 12    # Duration to press coffee machine button for
-    scraper_height = 8  # distance from scraper to coffee filter
-    tamp_height = 15    # depth to push filter into tamper
+def station_machine(RDK, frame_filename="reference_frames.csv", joint_filename="joint_angles.csv",
+                    log_filename="output.jsonl"):
+    """ Read transformation matrices and joint angles from CSV files and set up a CoffeeMachine on a station
+    RDK: Robolink, or the offline station from offline_robodk
+    frame_filename, joint_filename: paths to the station CSV files
+    log_filename: event log filename, None to keep no log
+    output: CoffeeMachine moving to the station's home target
+    """
+    robot, master_tool = connect_robot(RDK)
+    # Inverse transforms are resolved by the frame graph as required
+    frames = FrameGraph.from_frames(read_frames(frame_filename), FRAMES)
+    machine = CoffeeMachine(robot, master_tool, RDK, frames, read_joint_angles(joint_filename), log_filename)
+    machine.home = RDK.Item(HOME)  # existing target in station
+    return machine
+
+
+def main():
+    # Initialise robot programming environment and coffee machine
+    machine = station_machine(rl.Robolink())
 
     # Run coffee making tasks
-    machine.insert_filter_grinder()
-    machine.turn_on_grinder()
-    machine.pull_lever_multiple(N)
-    machine.scrape_filter(scraper_height)
-    machine.tamp_filter(tamp_height)
-    machine.insert_filter_silvia()
-    machine.cup_from_stack()
-    machine.place_cup(height)
-    machine.turn_on_silvia(time)
-    machine.pickup_coffee(height)
-
-
-main()
+    make_coffee(machine)
+    machine.close_log()
+
+
+if __name__ == "__main__":
+    main()
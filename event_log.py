@@ -0,0 +1,166 @@
+# Structured event log written by a background thread
+import atexit
+import json
+import struct
+import threading
+import time
+import warnings
+from collections import deque, namedtuple
+
+import numpy as np
+
+# Record kinds
+MESSAGE = "Message"
+STAGE = "Stage"
+MOVEJ = "MoveJ"
+MOVEL = "MoveL"
+PROGRAM = "Program"
+WAIT = "Wait"
+KINDS = [MESSAGE, STAGE, MOVEJ, MOVEL, PROGRAM, WAIT]
+
+# timestamp: time.monotonic() when the record was made, stage: stage running at the time,
+# kind: one of KINDS, label: description, target: pose, joints, wait duration or None
+LogRecord = namedtuple("LogRecord", ["timestamp", "stage", "kind", "label", "target"])
+
+# Binary record header: timestamp, kind index, number of target values, stage length, label length
+HEADER = struct.Struct("<dBBHH")
+
+
+def target_values(target):
+    """ Flatten a record target for serialisation.
+    target: array, list, number, station item or None
+    output: list of floats, or a string for targets that are not numeric (e.g. station items)
+    """
+    if target is None:
+        return []
+    if isinstance(target, (int, float)):
+        return [float(target)]
+    try:
+        return np.asarray(target, dtype=np.float64).ravel().tolist()
+    except (TypeError, ValueError):
+        return str(target)
+
+
+def encode_json(record):
+    """ Serialise a record as one line of JSON """
+    return json.dumps({"timestamp": record.timestamp, "stage": record.stage, "kind": record.kind,
+                       "label": record.label, "target": target_values(record.target)}) + "\n"
+
+
+def encode_binary(record):
+    """ Serialise a record as a fixed header followed by target values, stage and label """
+    values = target_values(record.target)
+    label = record.label
+    if isinstance(values, str):
+        # Non-numeric targets are kept in the label
+        label = "{} [{}]".format(label, values)
+        values = []
+    stage = (record.stage or "").encode()
+    label = label.encode()
+    return HEADER.pack(record.timestamp, KINDS.index(record.kind), len(values), len(stage), len(label)) \
+        + struct.pack("<{}d".format(len(values)), *values) + stage + label
+
+
+def read_log(filename):
+    """ Read every record of a log written by EventLog.
+    filename: path of .jsonl or .bin log file
+    output: list of LogRecord, targets are lists of floats
+    """
+    records = []
+    if filename.endswith(".bin"):
+        with open(filename, "rb") as file:
+            data = file.read()
+        offset = 0
+        while offset < len(data):
+            timestamp, kind, n_values, n_stage, n_label = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            values = list(struct.unpack_from("<{}d".format(n_values), data, offset))
+            offset += 8 * n_values
+            stage = data[offset:offset + n_stage].decode() or None
+            offset += n_stage
+            label = data[offset:offset + n_label].decode()
+            offset += n_label
+            records.append(LogRecord(timestamp, stage, KINDS[kind], label, values))
+    else:
+        with open(filename, "r") as file:
+            for line in file:
+                item = json.loads(line)
+                records.append(LogRecord(item["timestamp"], item["stage"], item["kind"], item["label"],
+                                         item["target"]))
+    return records
+
+
+class EventLog(object):
+    """ Ring buffer of log records drained to disk by a background writer thread. """
+
+    def __init__(self, filename, capacity=4096, batch_size=256, flush_interval=0.5):
+        self.filename = filename
+        self.binary = filename.endswith(".bin")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=capacity)
+        self.appended = 0
+        self.written = 0
+        self.reported = 0       # Dropped records already reported
+        self.file = open(filename, "ab" if self.binary else "a")
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.writer = threading.Thread(target=self.run, name="EventLog writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    @property
+    def dropped(self):
+        """ Number of records overwritten in the ring buffer before they could be written """
+        return self.appended - self.written - len(self.buffer)
+
+    def record(self, kind, label="", target=None, stage=None):
+        """ Append a record without blocking on disk I/O.
+        kind: one of KINDS
+        label: description of the event
+        target: pose, joints or duration associated with the event
+        stage: stage running at the time
+        """
+        self.buffer.append(LogRecord(time.monotonic(), stage, kind, label, target))
+        self.appended += 1
+        if len(self.buffer) >= self.batch_size:
+            self.wake.set()
+
+    def flush(self):
+        """ Write every buffered record to disk """
+        with self.lock:
+            encode = encode_binary if self.binary else encode_json
+            while self.buffer:
+                batch = []
+                while self.buffer and len(batch) < self.batch_size:
+                    batch.append(encode(self.buffer.popleft()))
+                self.file.write((b"" if self.binary else "").join(batch))
+                self.written += len(batch)
+            dropped = self.dropped
+            if dropped > self.reported:
+                # The notice is not counted as written so dropped keeps counting only lost records
+                message = "{} records dropped, the ring buffer of {} was full".format(
+                    dropped - self.reported, self.buffer.maxlen)
+                self.file.write(encode(LogRecord(time.monotonic(), None, MESSAGE, message, None)))
+                warnings.warn("{}: {}".format(self.filename, message))
+                self.reported = dropped
+            self.file.flush()
+
+    def run(self):
+        """ Writer thread, flushes a batch whenever the buffer fills or the flush interval passes """
+        while not self.stopped.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        """ Stop the writer thread, write any remaining records and close the file """
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.wake.set()
+        self.writer.join()
+        self.flush()
+        self.file.close()
+        atexit.unregister(self.close)
@@ -0,0 +1,128 @@
+# Transform tree of reference frames with memoized path resolution
+from collections import deque
+
+import numpy as np
+from poses import IDENTITY, compose, inverse
+
+
+def split_name(name, nodes):
+    """ Split a concatenated frame name such as "globalsilvia" into its parent and child frames.
+    name: concatenated frame name from reference_frames.csv
+    nodes: collection of known frame names
+    output: tuple (parent, child)
+    """
+    splits = [(name[:i], name[i:]) for i in range(1, len(name)) if name[:i] in nodes and name[i:] in nodes]
+    if len(splits) != 1:
+        raise ValueError("Cannot split frame name {} into known frames, candidates: {}".format(name, splits))
+    return splits[0]
+
+
+class FrameGraph(object):
+    """ Graph of reference frames where each edge stores the pose of the child frame in the parent frame.
+    Composed lookups are cached and only the lookups passing through an updated edge are invalidated.
+    """
+
+    def __init__(self):
+        self.edges = {}         # (parent, child) -> pose of child in parent
+        self.adjacent = {}      # frame -> set of directly connected frames
+        self.cache = {}         # (start, via, end) -> composed pose
+        self.dependents = {}    # frozenset edge -> set of cache keys using that edge
+
+    @classmethod
+    def from_frames(cls, frames, nodes):
+        """ Build a frame graph from a dictionary of concatenated frame names, as returned by read_frames.
+        frames: dictionary of (4, 4) poses keyed by parent + child frame name
+        nodes: collection of known frame names used to split the keys
+        output: FrameGraph
+        """
+        graph = cls()
+        for name, transform in frames.items():
+            # Rows naming a single frame (e.g. global) are that frame relative to itself
+            if name in nodes:
+                continue
+            parent, child = split_name(name, nodes)
+            graph.set_edge(parent, child, transform)
+        return graph
+
+    def set_edge(self, parent, child, transform):
+        """ Add or update the pose of child in parent, invalidating cached lookups that depend on it.
+        parent, child: frame names
+        transform: (4, 4) pose of child in parent
+        """
+        key = frozenset((parent, child))
+        if (parent, child) in self.edges or (child, parent) in self.edges:
+            # Updating an existing edge only affects the lookups that pass through it
+            for cached in self.dependents.pop(key, ()):
+                self.cache.pop(cached, None)
+            self.edges.pop((child, parent), None)
+        else:
+            # A new edge may create shorter paths so every cached lookup is stale
+            self.cache.clear()
+            self.dependents.clear()
+        self.edges[(parent, child)] = transform
+        self.adjacent.setdefault(parent, set()).add(child)
+        self.adjacent.setdefault(child, set()).add(parent)
+
+    def edge(self, start, end):
+        """ Pose of end in start for directly connected frames, inverting the stored edge if required.
+        start, end: frame names
+        """
+        if (start, end) in self.edges:
+            return self.edges[(start, end)]
+        return inverse(self.edges[(end, start)])
+
+    def path(self, start, end):
+        """ Find the shortest chain of frames from start to end.
+        start, end: frame names
+        output: list of frame names beginning with start and ending with end
+        """
+        if start == end:
+            return [start]
+        # Breadth first search counting shortest paths so ambiguous lookups are reported rather than guessed
+        previous = {start: None}
+        count = {start: 1}
+        depth = {start: 0}
+        queue = deque([start])
+        while queue:
+            frame = queue.popleft()
+            for neighbour in self.adjacent.get(frame, ()):
+                if neighbour not in depth:
+                    depth[neighbour] = depth[frame] + 1
+                    previous[neighbour] = frame
+                    count[neighbour] = count[frame]
+                    queue.append(neighbour)
+                elif depth[neighbour] == depth[frame] + 1:
+                    count[neighbour] += count[frame]
+        if end not in depth:
+            raise KeyError("No path from frame {} to frame {}".format(start, end))
+        if count[end] > 1:
+            raise ValueError("Path from frame {} to frame {} is ambiguous, specify via frames".format(start, end))
+
+        chain = [end]
+        while chain[-1] != start:
+            chain.append(previous[chain[-1]])
+        return chain[::-1]
+
+    def get(self, start, end, via=()):
+        """ Pose of frame end relative to frame start, e.g. get(GLOBAL, CUP, [CUPSTACK]).
+        start, end: frame names
+        via: sequence of frames the chain must pass through, used where the shortest path is ambiguous
+        output: read-only (4, 4) pose
+        """
+        key = (start, tuple(via), end)
+        if key in self.cache:
+            return self.cache[key]
+
+        # Resolve each leg of the chain and compose the edges along it
+        chain = [start]
+        for waypoint in list(via) + [end]:
+            chain += self.path(chain[-1], waypoint)[1:]
+        transforms = [self.edge(a, b) for a, b in zip(chain[:-1], chain[1:])]
+        # Copy so the cached result never aliases a stored edge
+        result = np.array(compose(*transforms)) if transforms else IDENTITY.copy()
+        result.flags.writeable = False
+
+        self.cache[key] = result
+        for a, b in zip(chain[:-1], chain[1:]):
+            self.dependents.setdefault(frozenset((a, b)), set()).add(key)
+        return result
@@ -0,0 +1,97 @@
+# Regenerate joint_angles.csv from reference_frames.csv with the analytic UR5 inverse kinematics
+import numpy as np
+
+import coffee_machine as cm
+import station_store
+import ur5_kinematics as ur
+from coffee_machine import GLOBAL, GRINDER, CROSS, CUPSTACK, CUP, TCP, FILTER, TAMPER, BALL, LEVER, PULLER, \
+    PUSHER, GRINDERPOWERON, GRINDERMOUNT, FILTERMOUNT, CUPMOUNT, ENTRY, HALFPI, PI
+from frame_graph import FrameGraph
+from poses import compose, transl, roty, rotz
+
+# Largest joint change accepted without review, larger changes mean the frame and the captured row disagree
+MAX_CHANGE = 5.0
+
+
+def joint_targets(frames):
+    """ TCP targets each joint angle row was captured at, mirroring the stage methods of CoffeeMachine.
+    frames: FrameGraph of reference frames
+    output: dictionary of joint angle row name -> (4, 4) pose
+    """
+    cup_pickup = frames.get(GLOBAL, TCP, [CUPSTACK, CUP])
+    remove_cup = compose(transl(0, 0, 300), cup_pickup)
+    return {
+        # Tool stand positions
+        FILTERMOUNT: frames.get(GLOBAL, FILTERMOUNT),
+        GRINDERMOUNT: frames.get(GLOBAL, GRINDERMOUNT),
+        CUPMOUNT: frames.get(GLOBAL, CUPMOUNT),
+        # Filter above the grinder ball, see insert_filter_grinder
+        FILTER + ENTRY: compose(transl(0, 0, 60), frames.get(GLOBAL, BALL, [GRINDER]), roty(-0.1),
+                                frames.get(FILTER, TCP)),
+        # Cup lifted clear of the stack and the same pose rotated half a turn, see cup_from_stack
+        CUPSTACK + ENTRY: remove_cup,
+        "rotated" + CUP: compose(remove_cup, rotz(PI)),
+        # Release position of the grinder on button, see turn_on_grinder
+        GRINDERPOWERON: compose(frames.get(GLOBAL, GRINDERPOWERON), rotz(PI), frames.get(PUSHER, TCP),
+                                transl(0, 0, -10)),
+        # Start of the lever pull, see pull_lever_multiple
+        GRINDER + LEVER: compose(frames.get(GLOBAL, LEVER), transl(-5, -20, 0), frames.get(PULLER, TCP)),
+        # Filter below the tamper, see tamp_filter
+        TAMPER + ENTRY: compose(frames.get(GLOBAL, TAMPER, [CROSS]), transl(0, 0, -100),
+                                frames.get(TAMPER, FILTER), frames.get(FILTER, TCP)),
+        # Clear of silvia on the way back to the tool stand, see insert_filter_silvia
+        cm.AVOIDSILVIA: compose(rotz(HALFPI), frames.get(GLOBAL, CUPMOUNT)),
+    }
+
+
+def regenerate(frame_filename, joint_filename, tool=ur.MASTER_TOOL, max_change=MAX_CHANGE):
+    """ Solve every joint angle row with a known target on the branch closest to the existing row.
+    Rows that are unreachable or would change by more than max_change degrees are kept for review.
+    frame_filename, joint_filename: paths to the station CSV files
+    tool: pose of the TCP relative to the robot flange
+    max_change: largest joint change in degrees applied automatically, None to apply every solution
+    output: tuple (list of names, (N, 6) joint angles, dictionary of name -> largest joint change in degrees)
+    """
+    frames = FrameGraph.from_frames(cm.read_frames(frame_filename), cm.FRAMES)
+    existing = station_store.load_joint_angles(joint_filename)
+    # One row per name, in file order, the last duplicate wins as when the file is read
+    names = [name for i, name in enumerate(existing.names) if existing.index[name] == i]
+    joints = np.array([existing[name] for name in names])
+
+    targets = joint_targets(frames)
+    solved = [i for i, name in enumerate(names) if name in targets]
+    result, distance = ur.nearest(ur.inverse(np.array([targets[names[i]] for i in solved]), tool), joints[solved])
+
+    changes = {}
+    for row, i in enumerate(solved):
+        if np.isnan(result[row]).any():
+            changes[names[i]] = np.nan
+            continue
+        changes[names[i]] = float(np.max(np.abs(result[row] - joints[i])))
+        if max_change is None or changes[names[i]] <= max_change:
+            joints[i] = result[row]
+    return names, joints, changes
+
+
+def write_joint_angles(filename, names, joints):
+    """ Write joint angle rows in the format of joint_angles.csv """
+    with open(filename, "w") as file:
+        file.write("\n".join(name + ", " + ", ".join("{:.6f}".format(value) for value in row)
+                             for name, row in zip(names, joints)) + "\n")
+
+
+def main():
+    names, joints, changes = regenerate("reference_frames.csv", "joint_angles.csv")
+    for name, change in changes.items():
+        if np.isnan(change):
+            status = "unreachable, kept"
+        elif change > MAX_CHANGE:
+            status = "{:.3f} deg, kept for review".format(change)
+        else:
+            status = "{:.3f} deg".format(change)
+        print("{:<16} {}".format(name, status))
+    write_joint_angles("joint_angles.csv", names, joints)
+
+
+if __name__ == "__main__":
+    main()
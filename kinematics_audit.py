@@ -0,0 +1,74 @@
+# Consistency audit of joint_angles.csv against reference_frames.csv using the UR5 forward kinematics
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import coffee_machine as cm
+import station_store
+import ur5_kinematics as ur
+from coffee_machine import TCP, TOOL
+from frame_graph import FrameGraph
+from generate_joint_angles import joint_targets
+from poses import IDENTITY, compose
+
+POSITION_TOLERANCE = 2.0        # mm
+ORIENTATION_TOLERANCE = 1.0     # degrees
+
+# name: joint angle row, position: error in mm, orientation: error in degrees, ok: both within tolerance
+PoseError = namedtuple("PoseError", ["name", "position", "orientation", "ok"])
+
+
+def kinematic_poses(joints, frames, tool=ur.MASTER_TOOL):
+    """ Flange, TCP and tool changer poses for a batch of joint configurations.
+    joints: (N, 6) joint angles in degrees
+    frames: FrameGraph of reference frames, for the tcptool offset
+    tool: pose of the TCP relative to the flange
+    output: dictionary of "flange", TCP and TOOL -> (N, 4, 4) poses in the robot base frame
+    """
+    flange = ur.forward(joints, IDENTITY)
+    tcp = compose(flange, tool)
+    return {"flange": flange, TCP: tcp, TOOL: compose(tcp, frames.get(TCP, TOOL))}
+
+
+def pose_errors(poses, references):
+    """ Position and orientation difference between two batches of poses.
+    poses, references: (N, 4, 4) arrays
+    output: tuple ((N,) position errors, (N,) rotation angles in degrees)
+    """
+    position = np.linalg.norm(poses[:, :3, 3] - references[:, :3, 3], axis=1)
+    relative = np.einsum("nji,njk->nik", poses[:, :3, :3], references[:, :3, :3])
+    cosine = (np.trace(relative, axis1=1, axis2=2) - 1.0) / 2.0
+    return position, np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0)))
+
+
+def audit(frame_filename="reference_frames.csv", joint_filename="joint_angles.csv", tool=ur.MASTER_TOOL):
+    """ Compare every joint angle row with a known target against the reference frames.
+    frame_filename, joint_filename: paths to the station CSV files
+    tool: pose of the TCP relative to the flange
+    output: list of PoseErrors in file order
+    """
+    frames = FrameGraph.from_frames(cm.read_frames(frame_filename), cm.FRAMES)
+    table = station_store.load_joint_angles(joint_filename)
+    targets = joint_targets(frames)
+    # One row per name, the last duplicate wins as when the file is read
+    names = [name for i, name in enumerate(table.names) if table.index[name] == i and name in targets]
+    poses = kinematic_poses(np.array([table[name] for name in names]), frames, tool)[TCP]
+    position, orientation = pose_errors(poses, np.array([targets[name] for name in names]))
+    ok = (position <= POSITION_TOLERANCE) & (orientation <= ORIENTATION_TOLERANCE)
+    return [PoseError(*row) for row in zip(names, position.tolist(), orientation.tolist(), ok.tolist())]
+
+
+def main():
+    start = time.perf_counter()
+    errors = audit()
+    elapsed = time.perf_counter() - start
+    for error in errors:
+        print("{:<16}{:>10.2f} mm{:>10.2f} deg  {}".format(error.name, error.position, error.orientation,
+                                                          "" if error.ok else "CHECK"))
+    print("{} of {} rows within {} mm and {} deg, audited in {:.1f} ms".format(
+        sum(error.ok for error in errors), len(errors), POSITION_TOLERANCE, ORIENTATION_TOLERANCE, 1000 * elapsed))
+
+
+if __name__ == "__main__":
+    main()
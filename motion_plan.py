@@ -0,0 +1,351 @@
+# Precompiled motion plan for the coffee making sequence, cached in a binary file and streamed to RoboDK
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import coffee_machine as cm
+from frame_graph import FrameGraph
+from poses import robodk_target
+from waits import Waiter, run_program
+import event_log as el
+
+FORMAT_VERSION = 5
+
+# Step kinds
+MOVEJ = 0
+MOVEL = 1
+PROGRAM = 2     # Run a station subprogram (tool attach/detach, cup tool open/close)
+PAUSE = 3       # Wait with the robot stationary, target holds the maximum duration in seconds
+SETTOOL = 4     # Redefine the robot tool as the master tool
+KIND_NAMES = ["MoveJ", "MoveL", "Program", "Pause", "SetTool"]
+LOG_KINDS = [el.MOVEJ, el.MOVEL, el.PROGRAM, el.WAIT, el.PROGRAM]
+
+ROUNDING_OFF = -1     # RoboDK rounding value for moves that must reach their target exactly
+
+# Target encodings in the binary plan
+NO_TARGET = 0
+POSE = 1
+JOINTS = 2
+ITEM = 3        # Named station item such as the Home target
+SECONDS = 4
+
+# target: (4, 4) pose, (6,) joints, station item name, pause duration or None
+# label: description of the step, tool: program name for PROGRAM steps, stage: stage the step belongs to
+Step = namedtuple("Step", ["kind", "target", "label", "tool", "stage"])
+
+
+class MotionPlan(object):
+    """ Ordered list of steps for the coffee making sequence with the key of the inputs it was compiled from.
+    rounding: optional array of blend radii in mm, one per step, see blending.py
+    speeds: optional (N, 4) array of (linear speed, joint speed, linear acceleration, joint acceleration) per
+     step in mm/s, deg/s, mm/s^2 and deg/s^2, zero rows leave the robot speed unchanged, see speed_profiles.py
+    """
+
+    def __init__(self, steps=None, key="", rounding=None, speeds=None):
+        self.steps = steps if steps is not None else []
+        self.key = key
+        self.rounding = rounding
+        self.speeds = speeds
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def save(self, filename):
+        """ Write plan to a compact binary file.
+        filename: path of .npz file
+        """
+        kinds = np.array([step.kind for step in self.steps], dtype=np.uint8)
+        encodings = np.zeros(len(self.steps), dtype=np.uint8)
+        targets = np.zeros((len(self.steps), 16))
+        refs = []
+        for i, step in enumerate(self.steps):
+            ref = step.tool or ""
+            if isinstance(step.target, str):
+                encodings[i] = ITEM
+                ref = step.target
+            elif step.kind == PAUSE:
+                encodings[i] = SECONDS
+                targets[i, 0] = step.target
+            elif step.target is not None:
+                values = np.ravel(step.target)
+                encodings[i] = POSE if values.size == 16 else JOINTS
+                targets[i, :values.size] = values
+            refs.append(ref)
+        with open(filename, "wb") as file:
+            np.savez(file, version=FORMAT_VERSION, key=self.key, kinds=kinds, encodings=encodings, targets=targets,
+                     labels=np.array([step.label for step in self.steps], dtype=str),
+                     refs=np.array(refs, dtype=str),
+                     stages=np.array([step.stage or "" for step in self.steps], dtype=str),
+                     rounding=self.rounding if self.rounding is not None else np.zeros(0),
+                     speeds=self.speeds if self.speeds is not None else np.zeros((0, 4)))
+
+    @classmethod
+    def load(cls, filename):
+        """ Read plan from a binary file written by save.
+        filename: path of .npz file
+        output: MotionPlan, or None if the file was written by a different format version
+        """
+        with np.load(filename) as data:
+            if int(data["version"]) != FORMAT_VERSION:
+                return None
+            steps = []
+            for kind, encoding, values, label, ref, stage in zip(data["kinds"], data["encodings"], data["targets"],
+                                                                 data["labels"], data["refs"], data["stages"]):
+                target = None
+                if encoding == POSE:
+                    target = values.reshape(4, 4)
+                elif encoding == JOINTS:
+                    target = values[:6]
+                elif encoding == ITEM:
+                    target = str(ref)
+                elif encoding == SECONDS:
+                    target = float(values[0])
+                tool = str(ref) if kind == PROGRAM else None
+                steps.append(Step(int(kind), target, str(label), tool, str(stage) or None))
+            rounding = data["rounding"] if data["rounding"].size else None
+            speeds = data["speeds"] if data["speeds"].size else None
+            return cls(steps, str(data["key"]), rounding, speeds)
+
+
+def plan_target(matrix):
+    """ Copy a move target into the form stored in a plan.
+    matrix: pose, joint angles or station item name
+    output: float64 array, or the item name unchanged
+    """
+    return matrix if isinstance(matrix, str) else np.array(matrix, dtype=np.float64)
+
+
+class CoffeePlanner(cm.CoffeeMachine):
+    """ Coffee machine that records every robot command as a plan step instead of moving a robot. """
+
+    def __init__(self, frames, joint_angles):
+        super(CoffeePlanner, self).__init__(None, None, None, frames, joint_angles, log_filename=None)
+        self.plan = MotionPlan()
+
+    def add(self, kind, target=None, label="", tool=None):
+        """ Append a step to the plan for the current stage """
+        self.plan.steps.append(Step(kind, target, label, tool, self.stage))
+
+    def MoveJ(self, matrix, pos=""):
+        self.add(MOVEJ, plan_target(matrix), pos)
+
+    def MoveL(self, matrix, pos=""):
+        self.add(MOVEL, plan_target(matrix), pos)
+
+    def run_program(self, name):
+        self.add(PROGRAM, label=name, tool=name)
+
+    def reset_tool(self):
+        self.add(SETTOOL, label="Reset tool")
+
+    def pause(self, seconds, label):
+        self.add(PAUSE, float(seconds), label)
+
+
+def plan_key(frame_filename, joint_filename, parameters):
+    """ Hash of everything a plan depends on.
+    frame_filename, joint_filename: paths to the station CSV files
+    parameters: dictionary of stage parameters
+    output: hex digest string
+    """
+    digest = hashlib.sha1()
+    for filename in (frame_filename, joint_filename):
+        with open(filename, "rb") as file:
+            digest.update(file.read())
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    digest.update(str(FORMAT_VERSION).encode())
+    return digest.hexdigest()
+
+
+def compile_plan(frame_filename, joint_filename, parameters=cm.PARAMETERS):
+    """ Walk the whole coffee making sequence without a robot.
+    frame_filename, joint_filename: paths to the station CSV files
+    parameters: dictionary of stage parameters, see coffee_machine.PARAMETERS
+    output: MotionPlan
+    """
+    frames = FrameGraph.from_frames(cm.read_frames(frame_filename), cm.FRAMES)
+    planner = CoffeePlanner(frames, cm.read_joint_angles(joint_filename))
+    cm.make_coffee(planner, parameters)
+    planner.plan.key = plan_key(frame_filename, joint_filename, parameters)
+    return planner.plan
+
+
+def load_or_compile(plan_filename, frame_filename, joint_filename, parameters=cm.PARAMETERS):
+    """ Reuse a cached plan if it was compiled from the same inputs, otherwise compile and cache a new one.
+    plan_filename: path of cached .npz plan
+    frame_filename, joint_filename: paths to the station CSV files
+    parameters: dictionary of stage parameters
+    output: MotionPlan
+    """
+    key = plan_key(frame_filename, joint_filename, parameters)
+    if os.path.exists(plan_filename):
+        plan = MotionPlan.load(plan_filename)
+        if plan is not None and plan.key == key:
+            return plan
+    plan = compile_plan(frame_filename, joint_filename, parameters)
+    plan.save(plan_filename)
+    return plan
+
+
+class PlanExecutor(object):
+    """ Streams a compiled plan to a RoboDK robot.
+    Pauses finish early once the condition registered for their label holds, see CoffeeMachine.pause.
+    """
+
+    def __init__(self, robot, master_tool, RDK, waiter=None, conditions=None, event_log=None):
+        self.robot = robot
+        self.master_tool = master_tool
+        self.RDK = RDK
+        self.waiter = waiter if waiter is not None else Waiter()
+        self.conditions = conditions if conditions is not None else cm.station_conditions(RDK)
+        self.event_log = event_log
+
+    def pause(self, label, seconds):
+        """ Wait for a plan pause step """
+        self.waiter.wait(label, seconds, self.conditions.get(label))
+
+    def rounded(self, move, radius):
+        """ Move function that sets the robot rounding before moving.
+        move: robot MoveJ or MoveL
+        radius: blend radius in mm, 0 to stop at the target
+        """
+        rounding = radius if radius > 0 else ROUNDING_OFF
+
+        def call(*args, **kwargs):
+            self.robot.setRounding(rounding)
+            return move(*args, **kwargs)
+        return call
+
+    def with_speeds(self, move, speeds):
+        """ Move function that sets the robot speed and acceleration before moving.
+        move: robot MoveJ or MoveL, possibly already wrapped by rounded
+        speeds: (linear speed, joint speed, linear acceleration, joint acceleration)
+        """
+        def call(*args, **kwargs):
+            self.robot.setSpeed(*speeds)
+            return move(*args, **kwargs)
+        return call
+
+    def prepare(self, plan):
+        """ Convert every step of a plan to the RoboDK call that executes it.
+        The robot rounding and speed are only changed when a move's values differ from the ones before. The first
+        move sets both, the robot may still be blending with the values of a plan run before this one.
+        plan: MotionPlan
+        output: list of (step, function, arguments) tuples
+        """
+        calls = []
+        rounding = None
+        speeds = None
+        for i, step in enumerate(plan):
+            if step.kind == MOVEJ or step.kind == MOVEL:
+                target = self.RDK.Item(step.target) if isinstance(step.target, str) else robodk_target(step.target)
+                move = self.robot.MoveJ if step.kind == MOVEJ else self.robot.MoveL
+                radius = plan.rounding[i] if plan.rounding is not None else 0.0
+                if radius != rounding:
+                    move = self.rounded(move, radius)
+                    rounding = radius
+                if plan.speeds is not None and np.any(plan.speeds[i]) and tuple(plan.speeds[i]) != speeds:
+                    speeds = tuple(float(value) for value in plan.speeds[i])
+                    move = self.with_speeds(move, speeds)
+                calls.append((step, move, (target,)))
+            elif step.kind == PROGRAM:
+                calls.append((step, run_program, (self.RDK, self.waiter, step.tool)))
+            elif step.kind == SETTOOL:
+                calls.append((step, self.robot.setPoseTool, (self.master_tool,)))
+            elif step.kind == PAUSE:
+                calls.append((step, self.pause, (step.label, step.target)))
+        return calls
+
+    def record(self, step):
+        """ Add a step to the event log, if one is kept """
+        if self.event_log:
+            self.event_log.record(LOG_KINDS[step.kind], step.label, step.target, step.stage)
+
+    def run(self, plan):
+        """ Execute a plan, waiting for each move to finish before sending the next.
+        plan: MotionPlan, or list of calls already returned by prepare
+        """
+        calls = self.prepare(plan) if isinstance(plan, MotionPlan) else plan
+        for step, function, args in calls:
+            function(*args)
+            self.record(step)
+
+
+class PipelinedExecutor(PlanExecutor):
+    """ Streams a compiled plan to RoboDK without waiting for each move to finish.
+    Moves are queued with blocking=False and the executor only synchronises with the robot at real barriers
+    (tool programs, tool redefinition and pauses) or when the lookahead window is full. RoboDK does not
+    report how many moves are still queued, so a full window is drained completely with WaitMove.
+    Blend radii attached to the plan only take effect here, a blocking move always stops at its target.
+    """
+
+    def __init__(self, robot, master_tool, RDK, waiter=None, conditions=None, event_log=None, lookahead=8):
+        super(PipelinedExecutor, self).__init__(robot, master_tool, RDK, waiter, conditions, event_log)
+        self.lookahead = lookahead
+        self.outstanding = 0        # Moves submitted since the last synchronisation
+        self.moves = 0
+        self.barriers = 0
+        self.submit_time = 0.0      # Time spent sending moves to RoboDK
+        self.wait_time = 0.0        # Time spent waiting for queued moves to finish
+
+    def synchronise(self):
+        """ Wait for every queued move to finish """
+        if self.outstanding:
+            start = time.perf_counter()
+            self.robot.WaitMove()
+            self.wait_time += time.perf_counter() - start
+            self.outstanding = 0
+
+    def run(self, plan):
+        """ Execute a plan, keeping up to lookahead moves queued in RoboDK.
+        plan: MotionPlan, or list of calls already returned by prepare
+        """
+        calls = self.prepare(plan) if isinstance(plan, MotionPlan) else plan
+        for step, function, args in calls:
+            if step.kind == MOVEJ or step.kind == MOVEL:
+                if self.outstanding >= self.lookahead:
+                    self.synchronise()
+                start = time.perf_counter()
+                function(*args, blocking=False)
+                self.submit_time += time.perf_counter() - start
+                self.outstanding += 1
+                self.moves += 1
+            else:
+                # Tool programs and pauses must start from a stationary robot
+                self.synchronise()
+                self.barriers += 1
+                function(*args)
+            self.record(step)
+        self.synchronise()
+
+    def report(self):
+        """ Summary of command submission and synchronisation.
+        output: dictionary of counts and times in seconds
+        """
+        return {"moves": self.moves, "barriers": self.barriers, "submit_time": self.submit_time,
+                "wait_time": self.wait_time, "pause_time": self.waiter.total(),
+                "mean_submit_latency": self.submit_time / self.moves if self.moves else 0.0}
+
+
+def main():
+    plan = load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv")
+
+    RDK = cm.rl.Robolink()
+    robot, master_tool = cm.connect_robot(RDK)
+
+    event_log = el.EventLog("output.jsonl")
+    executor = PipelinedExecutor(robot, master_tool, RDK, event_log=event_log)
+    executor.run(plan)
+    event_log.close()
+    print(executor.report())
+
+
+if __name__ == "__main__":
+    main()
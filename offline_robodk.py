@@ -0,0 +1,329 @@
+# Offline stand-in for the RoboDK API used by this project
+# Nothing moves, each command advances a simulated clock by the time the move would take
+import math
+
+import numpy as np
+
+import coffee_machine as cm
+import ur5_kinematics as ur
+from motion_plan import PipelinedExecutor
+from poses import pose, from_mat
+from waits import Waiter, WaitRecord
+
+# Home target from the station, see Extras/RDK_code_example_adv.py
+HOME_POSE = pose([[0, 0, 1, 523.37],
+                  [-1, 0, 0, -109.0],
+                  [0, -1, 0, 607.85],
+                  [0, 0, 0, 1]])
+
+
+def trapezoid_time(distance, speed, acceleration):
+    """ Time to travel a distance from rest to rest under speed and acceleration limits.
+    distance: scalar or array of distances
+    speed, acceleration: limits in the same units, scalar or array
+    output: time in seconds, same shape as distance
+    """
+    distance = np.abs(distance)
+    # Distance needed to reach full speed and stop again
+    ramp = speed ** 2 / acceleration
+    return np.where(distance > ramp, distance / speed + speed / acceleration, 2 * np.sqrt(distance / acceleration))
+
+
+class MotionLimits(object):
+    """ Speed and acceleration limits used by the time model.
+    joint_speed: deg/s, joint_accel: deg/s^2, linear_speed: mm/s, linear_accel: mm/s^2,
+    angular_speed: deg/s, angular_accel: deg/s^2 for the tool orientation during linear moves
+    """
+
+    def __init__(self, joint_speed=60.0, joint_accel=80.0, linear_speed=250.0, linear_accel=500.0,
+                 angular_speed=60.0, angular_accel=80.0):
+        self.joint_speed = joint_speed
+        self.joint_accel = joint_accel
+        self.linear_speed = linear_speed
+        self.linear_accel = linear_accel
+        self.angular_speed = angular_speed
+        self.angular_accel = angular_accel
+
+    def joint_ramp(self):
+        """ Time lost to accelerating and braking in a joint move that reaches full speed """
+        return self.joint_speed / self.joint_accel
+
+    def linear_ramp(self):
+        """ Time lost to accelerating and braking in a linear move that reaches full speed """
+        return self.linear_speed / self.linear_accel
+
+    def joint_time(self, start, end):
+        """ Synchronised joint move time, limited by the joint with the furthest to travel """
+        return float(np.max(trapezoid_time(np.subtract(end, start), self.joint_speed, self.joint_accel)))
+
+    def linear_time(self, start, end):
+        """ Linear move time, limited by either the TCP translation or the tool rotation """
+        translation = np.linalg.norm(end[:3, 3] - start[:3, 3])
+        relative = np.dot(start[:3, :3].T, end[:3, :3])
+        angle = math.degrees(math.acos(max(-1.0, min(1.0, (np.trace(relative) - 1) / 2))))
+        return max(float(trapezoid_time(translation, self.linear_speed, self.linear_accel)),
+                   float(trapezoid_time(angle, self.angular_speed, self.angular_accel)))
+
+
+class OfflineItem(object):
+    """ Station item (frame, tool, target or program) identified by name. """
+
+    def __init__(self, link, name, joints=None, pose=None):
+        self.link = link
+        self.name = name
+        self.joints = joints
+        self.pose = pose
+
+    def Name(self):
+        return self.name
+
+    def Valid(self):
+        return True
+
+    def Busy(self):
+        return False
+
+    def Joints(self):
+        return list(self.joints) if self.joints is not None else []
+
+    def Pose(self):
+        return self.pose
+
+    def RunProgram(self):
+        self.link.RunProgram(self.name, True)
+
+
+class OfflineRobot(OfflineItem):
+    """ Robot item that tracks its joints and TCP pose and advances the simulated clock for every move. """
+
+    def __init__(self, link, name, limits, solver=None, joints=None):
+        super(OfflineRobot, self).__init__(link, name, joints, HOME_POSE.copy())
+        self.limits = limits
+        self.solver = solver    # Function (pose, seed joints) -> joints or None, used for pose targets
+        self.frame = None
+        self.tool = None
+        self.moves = 0
+        self.untimed = 0        # Moves that could not be timed because the start or end state was unknown
+        self.rounding = -1      # Blend radius in mm, -1 to stop at every target
+        self.carry = None       # Braking time of the previous move if the robot blends out of it instead
+        self.blended = 0
+
+    def setPoseFrame(self, frame):
+        self.frame = frame
+
+    def setPoseTool(self, tool):
+        self.tool = tool
+
+    def PoseTool(self):
+        return self.tool
+
+    def setRounding(self, rounding):
+        self.rounding = rounding
+
+    def setSpeed(self, speed_linear, speed_joints=-1, accel_linear=-1, accel_joints=-1):
+        # Values of -1 leave a limit unchanged, as in RoboDK. The limits are copied so other robots sharing
+        # them are not affected.
+        limits = self.limits
+        self.limits = MotionLimits(speed_joints if speed_joints > 0 else limits.joint_speed,
+                                   accel_joints if accel_joints > 0 else limits.joint_accel,
+                                   speed_linear if speed_linear > 0 else limits.linear_speed,
+                                   accel_linear if accel_linear > 0 else limits.linear_accel,
+                                   limits.angular_speed, limits.angular_accel)
+
+    def WaitMove(self, timeout=None):
+        # The robot comes to rest, nothing left to blend with
+        self.carry = None
+
+    def resolve(self, target):
+        """ Convert a move target to (joints or None, pose or None) """
+        if isinstance(target, OfflineItem):
+            if target.joints is None and target.pose is not None and self.solver is not None:
+                return self.solver(target.pose, self.joints), target.pose
+            if target.joints is not None and target.pose is None:
+                return target.joints, ur.forward(target.joints)[0]
+            return target.joints, target.pose
+        if hasattr(target, "rows"):
+            target = from_mat(target)
+        target = np.asarray(target, dtype=np.float64)
+        if target.shape == (4, 4):
+            joints = self.solver(target, self.joints) if self.solver is not None else None
+            return joints, target
+        # Joint targets are tracked in Cartesian space through the forward kinematics of the master tool
+        return target.ravel(), ur.forward(target)[0]
+
+    def MoveJ(self, target, blocking=True):
+        joints, target_pose = self.resolve(target)
+        if joints is not None and self.joints is not None:
+            duration = self.limits.joint_time(self.joints, joints)
+        elif target_pose is not None and self.pose is not None:
+            # No joint solution available, approximate with the Cartesian time model
+            duration = self.limits.linear_time(self.pose, target_pose)
+        else:
+            duration = None
+        self.finish_move(duration, joints, target_pose, self.limits.joint_ramp(), blocking)
+
+    def MoveL(self, target, blocking=True):
+        joints, target_pose = self.resolve(target)
+        if target_pose is not None and self.pose is not None:
+            duration = self.limits.linear_time(self.pose, target_pose)
+        elif joints is not None and self.joints is not None:
+            duration = self.limits.joint_time(self.joints, joints)
+        else:
+            duration = None
+        self.finish_move(duration, joints, target_pose, self.limits.linear_ramp(), blocking)
+
+    def finish_move(self, duration, joints, target_pose, ramp, blocking=True):
+        """ Advance the clock and update the robot state after a move.
+        A move queued with a rounding radius runs into the next one without stopping. Roughly half of the
+        braking and acceleration around the waypoint is saved, bounded by the duration of either move.
+        duration: move time in seconds, None if it could not be estimated
+        ramp: acceleration and braking time of the move type at full speed
+        blocking: False if the move was queued without waiting for it to finish
+        """
+        if duration is None:
+            self.untimed += 1
+            duration = 0.0
+        if self.carry is not None:
+            duration -= 0.5 * min(self.carry, duration, ramp)
+            self.blended += 1
+        self.carry = min(duration, ramp) if self.rounding > 0 and not blocking else None
+        self.link.advance(duration, "Move")
+        self.moves += 1
+        if joints is not None:
+            self.joints = np.array(joints, dtype=np.float64)
+        if target_pose is not None:
+            self.pose = target_pose
+        elif joints is not None:
+            self.pose = ur.forward(joints)[0]
+
+
+class OfflineRobolink(object):
+    """ Drop-in replacement for robolink.Robolink that simulates the station offline.
+    limits: MotionLimits for the time model
+    solver: optional function (pose, seed joints) -> joints used to time joint moves to pose targets
+    program_time: default duration of station programs in seconds
+    program_times: dictionary of durations for specific program names
+    """
+
+    def __init__(self, limits=None, solver=None, program_time=3.0, program_times=None, robot_name="UR5",
+                 home_joints=None):
+        self.limits = limits if limits is not None else MotionLimits()
+        self.program_time = program_time
+        self.program_times = program_times if program_times is not None else {}
+        self.clock = 0.0
+        self.history = []   # (command, duration) for every simulated command
+        self.items = {}
+        self.params = {}    # Station parameters, see waits.station_flag
+        self.robot = OfflineRobot(self, robot_name, self.limits, solver,
+                                  None if home_joints is None else np.array(home_joints, dtype=np.float64))
+        self.items[robot_name] = self.robot
+        self.items[cm.HOME] = OfflineItem(self, cm.HOME, self.robot.joints, HOME_POSE.copy())
+
+    def Item(self, name, itemtype=None):
+        if name not in self.items:
+            self.items[name] = OfflineItem(self, name)
+        return self.items[name]
+
+    def getParam(self, name):
+        return self.params.get(name)
+
+    def setParam(self, name, value):
+        self.params[name] = str(value)
+
+    def RunProgram(self, name, wait_for_finished=False):
+        self.advance(self.program_times.get(name, self.program_time), name)
+        return 0
+
+    def advance(self, duration, command):
+        """ Add the duration of a command to the simulated clock """
+        self.clock += duration
+        self.history.append((command, duration))
+
+
+class SimulatedWaiter(Waiter):
+    """ Waiter that advances the simulated clock instead of sleeping.
+    A condition is checked once: if it already holds the wait takes no time, otherwise the full timeout.
+    """
+
+    def __init__(self, link):
+        super(SimulatedWaiter, self).__init__()
+        self.link = link
+
+    def wait(self, label, timeout=None, condition=None):
+        satisfied = condition is not None and condition()
+        elapsed = 0.0 if satisfied or timeout is None else timeout
+        self.link.advance(elapsed, label)
+        record = WaitRecord(label, elapsed, timeout, satisfied)
+        self.records.append(record)
+        return record
+
+
+def offline_machine(frame_filename="reference_frames.csv", joint_filename="joint_angles.csv", log_filename=None,
+                    **options):
+    """ Create a CoffeeMachine connected to an offline station.
+    frame_filename, joint_filename: paths to the station CSV files
+    log_filename: optional event log filename
+    options: keyword arguments for OfflineRobolink, the solver defaults to the analytic UR5 inverse kinematics
+    output: tuple (CoffeeMachine, OfflineRobolink)
+    """
+    options.setdefault("solver", ur.make_solver())
+    RDK = OfflineRobolink(**options)
+    machine = cm.station_machine(RDK, frame_filename, joint_filename, log_filename)
+    machine.waiter = SimulatedWaiter(RDK)
+    return machine, RDK
+
+
+def simulate_plan(plan, executor_class=PipelinedExecutor, **options):
+    """ Execute a compiled plan on an offline station and time each stage.
+    The executor is run once per stage, so the robot comes to rest at every stage boundary.
+    plan: MotionPlan
+    executor_class: motion_plan executor used to stream the plan
+    options: keyword arguments for OfflineRobolink, the solver defaults to the analytic UR5 inverse kinematics
+    output: dictionary of simulated seconds per stage, including "total"
+    """
+    options.setdefault("solver", ur.make_solver())
+    RDK = OfflineRobolink(**options)
+    robot = RDK.Item("UR5")
+    executor = executor_class(robot, RDK.Item("Master Tool"), RDK, waiter=SimulatedWaiter(RDK))
+    calls = executor.prepare(plan)
+    times = {}
+    start = 0
+    while start < len(calls):
+        stage = calls[start][0].stage
+        end = start
+        while end < len(calls) and calls[end][0].stage == stage:
+            end += 1
+        before = RDK.clock
+        executor.run(calls[start:end])
+        times[stage] = times.get(stage, 0.0) + RDK.clock - before
+        start = end
+    times["total"] = RDK.clock
+    return times
+
+
+def simulate_cycle(machine, RDK, parameters=cm.PARAMETERS):
+    """ Run the coffee sequence on an offline station and time each stage.
+    machine, RDK: as returned by offline_machine
+    parameters: dictionary of stage parameters
+    output: dictionary of simulated seconds per stage, including "total"
+    """
+    times = {}
+    start = RDK.clock
+    for stage, parameter in cm.SEQUENCE:
+        before = RDK.clock
+        machine.run_stage(stage, *(() if parameter is None else (parameters[parameter],)))
+        times[stage] = RDK.clock - before
+    times["total"] = RDK.clock - start
+    return times
+
+
+def main():
+    machine, RDK = offline_machine()
+    times = simulate_cycle(machine, RDK)
+    for stage, seconds in times.items():
+        print("{:<24}{:>8.2f} s".format(stage, seconds))
+    print("{} moves simulated, {} could not be timed".format(RDK.robot.moves, RDK.robot.untimed))
+
+
+if __name__ == "__main__":
+    main()
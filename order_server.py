@@ -0,0 +1,207 @@
+# Order serving daemon for the coffee station, one JSON request per line on a local Unix socket
+import asyncio
+import json
+import math
+import os
+import socket
+import sys
+import time
+
+import coffee_machine as cm
+import offline_robodk as off
+
+SOCKET_PATH = "/tmp/coffee.sock"
+QUEUE_SIZE = 8          # Orders waiting to be made, further orders are refused until one starts
+# Accepted range of each stage parameter, values outside it are refused
+LIMITS = {"N": (1, 6),
+          "height": (80, 120),
+          "time": (5, 30),
+          "scraper_height": (0, 20),
+          "tamp_height": (5, 25)}
+
+# Order states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class OrderServer(object):
+    """ Serves coffee orders on one CoffeeMachine.
+    machine: connected CoffeeMachine
+    clock: function returning the current time in seconds, the simulated clock for an offline station
+    queue_size: number of orders that may wait
+    """
+
+    def __init__(self, machine, clock=time.monotonic, queue_size=QUEUE_SIZE):
+        self.machine = machine
+        self.clock = clock
+        self.queue_size = queue_size
+        self.queue = None       # asyncio.Queue of order numbers, created on the server's event loop
+        self.orders = []        # Dictionary per order with its number, parameters, status and stage seconds
+        self.halted = None      # Error of the order that stopped the station, None while orders are being made
+        self.resumed = None     # asyncio.Event set by the resume command, created on the server's event loop
+
+    def parse_parameters(self, requested):
+        """ Stage parameters of an order, missing values take the defaults.
+        requested: dictionary from the request
+        output: dictionary of stage parameters
+        """
+        unknown = set(requested) - set(cm.PARAMETERS)
+        if unknown:
+            raise ValueError("Unknown parameters: {}".format(", ".join(sorted(unknown))))
+        parameters = dict(cm.PARAMETERS)
+        for name, value in requested.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError("{} should be a number".format(name))
+            low, high = LIMITS[name]
+            # The comparison also refuses NaN, infinity and integers too large for a float
+            if not low <= value <= high or not math.isfinite(value):
+                raise ValueError("{} should be between {} and {}".format(name, low, high))
+            if isinstance(cm.PARAMETERS[name], int) and value != int(value):
+                raise ValueError("{} should be a whole number".format(name))
+            parameters[name] = type(cm.PARAMETERS[name])(value)
+        return parameters
+
+    def handle(self, request):
+        """ Answer one request.
+        Commands are order (with optional "parameters"), status (with an "order" number), list and resume.
+        request: decoded JSON request
+        output: dictionary to send back
+        """
+        command = request.get("command")
+        if command == "order":
+            parameters = self.parse_parameters(request.get("parameters", {}))
+            if self.halted:
+                raise ValueError("Station stopped after a failed order ({}), resume once it is clear".format(
+                    self.halted))
+            if self.queue.full():
+                raise ValueError("Queue is full, try again later")
+            order = {"order": len(self.orders), "parameters": parameters, "status": QUEUED, "seconds": {},
+                     "queued": self.clock()}
+            self.orders.append(order)
+            self.queue.put_nowait(order["order"])
+            return {"order": order["order"], "status": QUEUED, "position": self.queue.qsize()}
+        if command == "status":
+            number = request.get("order")
+            if not isinstance(number, int) or not 0 <= number < len(self.orders):
+                raise ValueError("Unknown order {}".format(number))
+            return self.orders[number]
+        if command == "list":
+            return {"orders": [dict((key, order[key]) for key in ("order", "status")) for order in self.orders],
+                    "halted": self.halted}
+        if command == "resume":
+            if not self.halted:
+                raise ValueError("Station is not stopped")
+            self.resume()
+            return {"status": "resumed"}
+        raise ValueError("Unknown command {}".format(command))
+
+    def make(self, order):
+        """ Make one coffee, runs in a worker thread.
+        order: order dictionary, its status and stage seconds are updated as the stages finish
+        """
+        self.machine.log("Order " + str(order["order"]))
+        start = self.clock()
+        # The arm is cleared after every order, so the next one starts from home without a tool
+        for stage, parameter in cm.SEQUENCE + [cm.CLEAR]:
+            before = self.clock()
+            self.machine.run_stage(stage, *(() if parameter is None else (order["parameters"][parameter],)))
+            order["seconds"][stage] = self.clock() - before
+        order["seconds"]["total"] = self.clock() - start
+
+    def resume(self):
+        """ Carry on making orders once an operator has put the tools back on the stand and the arm at home """
+        self.halted = None
+        self.machine.mounted = None
+        self.machine.stage = None
+        self.resumed.set()
+
+    async def serve_orders(self):
+        """ Make queued orders one after another, stopping after a failed order until resume is requested """
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.halted:
+                self.resumed.clear()
+                await self.resumed.wait()
+            order = self.orders[await self.queue.get()]
+            order["status"] = RUNNING
+            order["started"] = self.clock()
+            try:
+                await loop.run_in_executor(None, self.make, order)
+                order["status"] = DONE
+            except Exception as error:
+                order["status"] = FAILED
+                order["error"] = "{}: {}".format(type(error).__name__, error)
+                self.halted = "order {} failed in {}".format(order["order"], self.machine.stage)
+                self.machine.log("Stopped, " + self.halted)
+            order["finished"] = self.clock()
+            if self.machine.event_log:
+                self.machine.event_log.flush()
+
+    async def serve_client(self, reader, writer):
+        """ Answer requests from one connection until it closes """
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                reply = self.handle(json.loads(line))
+            except (ValueError, TypeError, OverflowError, AttributeError) as error:
+                reply = {"error": str(error)}
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    async def run(self, path=SOCKET_PATH):
+        """ Listen on a Unix socket until cancelled """
+        self.queue = asyncio.Queue(self.queue_size)
+        self.resumed = asyncio.Event()
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.serve_client, path)
+        worker = asyncio.ensure_future(self.serve_orders())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+            os.remove(path)
+
+
+def request(message, path=SOCKET_PATH):
+    """ Send one request to a running server.
+    message: dictionary to send
+    output: decoded reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall((json.dumps(message) + "\n").encode())
+        with connection.makefile("r") as replies:
+            return json.loads(replies.readline())
+
+
+def connect(offline=False, frame_filename="reference_frames.csv", joint_filename="joint_angles.csv",
+            log_filename="output.jsonl"):
+    """ Set up the station once.
+    offline: True to serve orders on the offline station
+    output: OrderServer
+    """
+    if offline:
+        machine, RDK = off.offline_machine(frame_filename, joint_filename, log_filename)
+        return OrderServer(machine, lambda: RDK.clock)
+    return OrderServer(cm.station_machine(cm.rl.Robolink(), frame_filename, joint_filename, log_filename))
+
+
+def main():
+    server = connect(offline="--offline" in sys.argv)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.machine.close_log()
+
+
+if __name__ == "__main__":
+    main()
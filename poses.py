@@ -0,0 +1,134 @@
+# NumPy pose algebra for homogeneous transforms, batched over a leading dimension
+import numpy as np
+
+IDENTITY = np.eye(4)
+IDENTITY.flags.writeable = False
+
+
+def pose(values):
+    """ Convert any 4x4 (or Nx4x4) nested sequence, or flat sequence of 16 values, to a pose array.
+    values: nested list, flat list of row-major values or numpy array
+    output: contiguous float64 array of shape (4, 4) or (N, 4, 4)
+    """
+    array = np.ascontiguousarray(values, dtype=np.float64)
+    if array.shape[-1] == 16:
+        array = array.reshape(array.shape[:-1] + (4, 4))
+    return array
+
+
+def _batch(*values):
+    """ Broadcast scalar or array arguments against each other.
+    output: tuple of float64 arrays sharing the same (possibly empty) batch shape
+    """
+    return np.broadcast_arrays(*[np.asarray(value, dtype=np.float64) for value in values])
+
+
+def transl(x, y, z):
+    """ Translation transform, equivalent to rdk.transl.
+    x, y, z: scalars or equal-length arrays in mm
+    output: pose of shape (4, 4), or (N, 4, 4) if any argument is an array
+    """
+    x, y, z = _batch(x, y, z)
+    result = np.zeros(x.shape + (4, 4))
+    result[..., 0, 0] = result[..., 1, 1] = result[..., 2, 2] = result[..., 3, 3] = 1.0
+    result[..., 0, 3] = x
+    result[..., 1, 3] = y
+    result[..., 2, 3] = z
+    return result
+
+
+def _rotation(angle, i, j):
+    """ Rotation about the axis orthogonal to rows/columns i and j.
+    angle: scalar or array in radians
+    output: pose of shape (4, 4) or (N, 4, 4)
+    """
+    angle, = _batch(angle)
+    c = np.cos(angle)
+    s = np.sin(angle)
+    result = np.zeros(angle.shape + (4, 4))
+    result[..., 0, 0] = result[..., 1, 1] = result[..., 2, 2] = result[..., 3, 3] = 1.0
+    result[..., i, i] = c
+    result[..., i, j] = -s
+    result[..., j, i] = s
+    result[..., j, j] = c
+    return result
+
+
+def rotx(angle):
+    """ Rotation about the x axis, equivalent to rdk.rotx.
+    angle: scalar or array in radians
+    """
+    return _rotation(angle, 1, 2)
+
+
+def roty(angle):
+    """ Rotation about the y axis, equivalent to rdk.roty.
+    angle: scalar or array in radians
+    """
+    return _rotation(angle, 2, 0)
+
+
+def rotz(angle):
+    """ Rotation about the z axis, equivalent to rdk.rotz.
+    angle: scalar or array in radians
+    """
+    return _rotation(angle, 0, 1)
+
+
+def compose(*poses):
+    """ Multiply a chain of poses left to right, broadcasting over any batch dimension.
+    poses: any mix of (4, 4) and (N, 4, 4) arrays
+    output: composed pose, (N, 4, 4) if any input is batched
+    """
+    result = poses[0]
+    for item in poses[1:]:
+        result = np.matmul(result, item)
+    return np.ascontiguousarray(result)
+
+
+def inverse(transform):
+    """ Closed-form inverse of a rigid transform, [R p; 0 1]^-1 = [R' -R'p; 0 1].
+    transform: pose of shape (4, 4) or (N, 4, 4), assumed to have an orthonormal rotation
+    output: inverse pose with the same shape
+    """
+    rotation_t = np.swapaxes(transform[..., :3, :3], -1, -2)
+    result = np.zeros_like(transform)
+    result[..., :3, :3] = rotation_t
+    result[..., :3, 3] = -np.einsum("...ij,...j->...i", rotation_t, transform[..., :3, 3])
+    result[..., 3, 3] = 1.0
+    return result
+
+
+def positions(transform):
+    """ Translation part of one or many poses.
+    transform: pose of shape (4, 4) or (N, 4, 4)
+    output: array of shape (3,) or (N, 3)
+    """
+    return transform[..., :3, 3]
+
+
+def from_mat(mat):
+    """ Convert a RoboDK matrix to a pose array.
+    mat: rdk.Mat
+    """
+    return pose(mat.rows)
+
+
+def to_mat(transform):
+    """ Convert a single (4, 4) pose array to a RoboDK matrix.
+    transform: pose of shape (4, 4)
+    """
+    import robodk as rdk
+    return rdk.Mat(transform.tolist())
+
+
+def robodk_target(target):
+    """ Convert a move target to the form RoboDK expects at the API boundary.
+    target: (4, 4) pose array, (6,) joint array, or anything RoboDK already accepts (Item, Mat, list)
+    output: rdk.Mat for poses, list of floats for joints, otherwise target unchanged
+    """
+    if isinstance(target, np.ndarray):
+        if target.shape == (4, 4):
+            return to_mat(target)
+        return target.tolist()
+    return target
@@ -0,0 +1,219 @@
+# Pre-flight workspace and clearance check for a compiled motion plan
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import coffee_machine as cm
+import ur5_kinematics as ur
+from blending import classify, neighbours, step_positions
+from motion_plan import MOVEJ, MOVEL, load_or_compile
+from poses import compose, inverse, transl, rotz
+
+KEY_POINTS = "Extras/key_points.csv"
+FLOOR = -20.0           # mm, bench height in the robot base frame, the cup stack stands on it
+SHOULDER = np.array([0.0, 0.0, ur.D[0]])
+REACH = 850.0 + 48.5    # mm, UR5 reach from the shoulder plus the master tool
+MARGIN = 10.0           # mm, clearance required around every box
+SPACING = 5.0           # mm, distance between samples along a linear move
+
+# name: station item, pose: (4, 4) box frame in the robot base frame, half: (3,) half sizes along the box axes
+Box = namedtuple("Box", ["name", "pose", "half"])
+# step: plan step index, stage, label: from the plan step, reason: what failed
+Violation = namedtuple("Violation", ["step", "stage", "label", "reason"])
+
+# Stages whose precise waypoints and linear moves may enter each box
+CONTACTS = {cm.GRINDER: ["insert_filter_grinder", "turn_on_grinder", "pull_lever_multiple", "scrape_filter"],
+            cm.SILVIA: ["insert_filter_silvia", "place_cup", "turn_on_silvia", "pickup_coffee"],
+            cm.CUPSTACK: ["cup_from_stack"],
+            cm.TAMPER: ["tamp_filter"],
+            cm.SCRAPER: ["scrape_filter"],
+            "tools": []}
+
+
+def read_key_points(filename=KEY_POINTS):
+    """ Read key_points.csv, where each row is a name followed by any number of values
+    filename: path to key points file
+    output: dictionary of name -> array of values
+    """
+    points = {}
+    with open(filename, "r") as file:
+        for line in file.read().splitlines():
+            if not line.strip():
+                continue
+            name, values = line.split(",", 1)
+            points[name.strip()] = np.array(values.split(","), dtype=np.float64)
+    return points
+
+
+def box(name, origin, yaw, low, high):
+    """ Box given by its extent in a frame at origin rotated by yaw about the vertical.
+    origin: (3,) frame origin in the robot base frame
+    yaw: rotation of the frame in radians
+    low, high: (3,) lower and upper corner in the frame
+    output: Box
+    """
+    low = np.asarray(low, dtype=np.float64)
+    high = np.asarray(high, dtype=np.float64)
+    pose = compose(transl(*origin), rotz(yaw), transl(*((low + high) / 2)))
+    return Box(name, pose, (high - low) / 2)
+
+
+def station_boxes(key_points):
+    """ Keep-out boxes around the station items.
+    Sizes are estimates of each item with some room to spare, not measurements; each box is placed from the
+    key points of its item.
+    key_points: dictionary from read_key_points
+    output: list of Boxes
+    """
+    silvia = key_points["silvia2robot"].reshape(2, 3)
+    grinder = key_points["globalgrinder"].reshape(4, 4)
+    cup = key_points["cup2robot"]
+    tools = key_points["tools2robot"]
+    edge = silvia[1] - silvia[0]
+    return [
+        # Coffee machine below its top edge, the edge runs along the box y axis and the body away from the robot
+        box(cm.SILVIA, silvia[0], np.arctan2(edge[1], edge[0]) - np.pi / 2, [-290, 0, FLOOR - silvia[0, 2]],
+            [0, np.linalg.norm(edge), 0]),
+        # Grinder body behind the portafilter holder, away from the robot, from the bench to the holder
+        box(cm.GRINDER, grinder[:3, 3], np.arctan2(grinder[1, 3], grinder[0, 3]), [0, -100, FLOOR - grinder[2, 3]],
+            [250, 100, 0]),
+        # Cup stack
+        box(cm.CUPSTACK, cup, 0.0, [-60, -60, 0], [60, 60, 250]),
+        # Tool stand post behind the hanging tools
+        box("tools", tools, 0.0, [-60, -220, FLOOR - tools[2]], [60, 240, 560 - tools[2]]),
+        # Tamper and scraper blocks on the cross
+        box(cm.TAMPER, key_points["tamper"], 0.0, [-40, -40, -40], [40, 40, 60]),
+        box(cm.SCRAPER, key_points["scraper2robot"][:3], 0.0, [-20, -20, -10], [20, 20, 30]),
+    ]
+
+
+def inside(points, boxes, margin=MARGIN):
+    """ Which points lie inside which boxes.
+    points: (..., 3) positions in the robot base frame
+    boxes: list of Boxes
+    margin: clearance added to every box in mm
+    output: (..., B) boolean array
+    """
+    frames = inverse(np.array([item.pose for item in boxes]))
+    half = np.array([item.half for item in boxes]) + margin
+    local = np.einsum("bij,...j->...bi", frames[:, :3, :3], points) + frames[:, :3, 3]
+    return np.all(np.abs(local) <= half, axis=-1)
+
+
+def distances(points, boxes):
+    """ Distance from points to the surface of each box, zero inside.
+    points: (..., 3) positions in the robot base frame
+    boxes: list of Boxes
+    output: (..., B) distances in mm
+    """
+    frames = inverse(np.array([item.pose for item in boxes]))
+    half = np.array([item.half for item in boxes])
+    local = np.einsum("bij,...j->...bi", frames[:, :3, :3], points) + frames[:, :3, 3]
+    return np.linalg.norm(np.maximum(np.abs(local) - half, 0.0), axis=-1)
+
+
+def out_of_reach(points):
+    """ Points beyond the reach of the arm or below the bench
+    points: (..., 3) positions
+    output: (...) boolean array
+    """
+    return (np.linalg.norm(points - SHOULDER, axis=-1) > REACH) | (points[..., 2] < FLOOR)
+
+
+def segment_samples(starts, ends, spacing=SPACING):
+    """ Evenly spaced points along straight segments.
+    starts, ends: (M, 3) segment end points
+    spacing: largest distance between samples in mm
+    output: (M, K, 3) samples, K is the same for every segment so the longest segment sets it
+    """
+    count = max(2, int(np.ceil(np.max(np.linalg.norm(ends - starts, axis=1), initial=0) / spacing)) + 1)
+    fractions = np.linspace(0.0, 1.0, count)
+    return starts[:, None, :] + fractions[None, :, None] * (ends - starts)[:, None, :]
+
+
+def check(plan, boxes, margin=MARGIN, spacing=SPACING, tool=ur.MASTER_TOOL, only=None, workspace=None):
+    """ Check every target and linear move of a plan.
+    plan: MotionPlan
+    boxes: list of Boxes from station_boxes
+    margin: clearance around every box in mm
+    spacing: distance between samples along linear moves in mm
+    tool: pose of the TCP relative to the flange, the flange is checked as well as the TCP
+    only: optional collection of step indices, the other steps are not checked
+    workspace: optional workspace_map.WorkspaceMap, targets evaluated exactly as near a singularity are violations
+    output: list of Violations, empty if the plan is clear
+    """
+    steps = plan.steps
+    positions = step_positions(plan, tool)
+    previous = neighbours(plan, positions)[0]
+    precise = ~classify(plan, positions)
+    moves = np.array([step.kind in (MOVEJ, MOVEL) and not np.isnan(positions[i]).any()
+                      for i, step in enumerate(steps)], dtype=bool)
+    # A box may be entered by the stages that work on its item, at precise waypoints only
+    allowed = np.array([[step.stage in CONTACTS.get(item.name, []) for item in boxes] for step in steps])
+    allowed &= precise[:, None]
+
+    if only is not None:
+        selected = np.zeros(len(steps), dtype=bool)
+        selected[list(only)] = True
+        moves &= selected
+
+    violations = []
+    rows = np.flatnonzero(moves)
+    pose_rows = [i for i in rows if np.size(steps[i].target) == 16]
+    joint_rows = [i for i in rows if np.size(steps[i].target) == 6]
+    flanges = np.full((len(steps), 3), np.nan)
+    if pose_rows:
+        poses = np.array([steps[i].target for i in pose_rows])
+        flanges[pose_rows] = compose(poses, inverse(tool))[:, :3, 3]
+        unreachable = np.all(np.isnan(ur.inverse(poses, tool)).any(axis=2), axis=1)
+        violations += [(pose_rows[i], "no inverse kinematics solution") for i in np.flatnonzero(unreachable)]
+    if joint_rows:
+        flanges[joint_rows] = ur.forward(np.array([steps[i].target for i in joint_rows]), np.eye(4))[:, :3, 3]
+
+    # Targets, both the TCP and the flange
+    for name, points in (("TCP", positions[rows]), ("flange", flanges[rows])):
+        hits = inside(points, boxes, margin) & ~allowed[rows]
+        for i, b in zip(*np.nonzero(hits)):
+            violations.append((rows[i], "{} inside {} box".format(name, boxes[b].name)))
+        for i in np.flatnonzero(out_of_reach(points)):
+            violations.append((rows[i], "{} out of reach".format(name)))
+
+    # Straight line paths of linear moves
+    linear = [i for i in rows if steps[i].kind == MOVEL and not np.isnan(previous[i]).any()]
+    if linear:
+        samples = segment_samples(previous[linear], positions[linear], spacing)
+        hits = np.any(inside(samples, boxes, margin), axis=1) \
+            & ~np.array([[steps[i].stage in CONTACTS.get(item.name, []) for item in boxes] for i in linear])
+        for i, b in zip(*np.nonzero(hits)):
+            violations.append((linear[i], "linear move passes through {} box".format(boxes[b].name)))
+        for i in np.flatnonzero(np.any(out_of_reach(samples), axis=1)):
+            violations.append((linear[i], "linear move leaves the reach of the arm"))
+
+    if workspace is not None:
+        for i, step, result in workspace.review(plan, only=set(rows)):
+            reason = "manipulability {:.4f} near a singularity".format(result.manipulability) \
+                if result.configurations else "no inverse kinematics solution"
+            if result.nudge is not None:
+                reason += ", try moving it by {} mm".format(np.round(result.nudge).astype(int).tolist())
+            violations.append((i, reason))
+
+    return [Violation(int(i), steps[i].stage, steps[i].label, reason) for i, reason in sorted(set(violations))]
+
+
+def main():
+    # Imported here, workspace_map builds on this module
+    from workspace_map import WorkspaceMap
+    plan = load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv")
+    boxes = station_boxes(read_key_points())
+    workspace = WorkspaceMap.load_or_build()
+    start = time.perf_counter()
+    violations = check(plan, boxes, workspace=workspace)
+    elapsed = time.perf_counter() - start
+    for violation in violations:
+        print("{:>4} {:<24}{:<48}{}".format(*violation))
+    print("{} steps checked in {:.1f} ms, {} problems".format(len(plan), 1000 * elapsed, len(violations)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Per-stage and per-move cycle time profiler for CoffeeMachine
+import csv
+import functools
+import json
+import time
+
+import coffee_machine as cm
+
+# Methods that hand control to RoboDK and the category their time is counted in
+ROBOT_METHODS = ["MoveJ", "MoveL", "run_program", "reset_tool"]
+WAIT_METHODS = ["pause"]
+# Composite tool operations, counted and timed but their time is made up of the calls above
+TOOL_METHODS = ["tool_mount", "cup_tool"]
+# Position of the label argument of each timed method
+LABEL_ARGUMENT = {"MoveJ": 1, "MoveL": 1, "run_program": 0, "pause": 1}
+STAGE_FIELDS = ["stage", "wall", "robot", "wait", "compute", "MoveJ", "MoveL", "tool_mount", "cup_tool",
+                "tool_time"]
+
+
+class CycleProfiler(object):
+    """ Collects timings for one or more coffee cycles of an instrumented CoffeeMachine. """
+
+    def __init__(self):
+        self.stages = {}    # stage name -> dictionary of STAGE_FIELDS
+        self.moves = []     # (stage, method, label, seconds) for every robot and wait call
+        self.current = None
+
+    def stage_stats(self, stage):
+        """ Statistics dictionary for a stage, created on first use """
+        if stage not in self.stages:
+            self.stages[stage] = dict((field, 0) for field in STAGE_FIELDS)
+            self.stages[stage]["stage"] = stage
+        return self.stages[stage]
+
+    def instrument(self, machine):
+        """ Wrap the methods of a machine instance so every call is timed.
+        machine: CoffeeMachine, the class itself is left untouched
+        """
+        for name in ROBOT_METHODS + WAIT_METHODS + TOOL_METHODS:
+            setattr(machine, name, self.wrap_call(name, getattr(machine, name)))
+        for stage, parameter in cm.SEQUENCE:
+            setattr(machine, stage, self.wrap_stage(stage, getattr(machine, stage)))
+
+    @staticmethod
+    def uninstrument(machine):
+        """ Remove the timing wrappers from a machine instance """
+        for name in ROBOT_METHODS + WAIT_METHODS + TOOL_METHODS + [stage for stage, parameter in cm.SEQUENCE]:
+            machine.__dict__.pop(name, None)
+
+    def wrap_call(self, name, method):
+        """ Time a robot, wait or tool method and add it to the current stage """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            stats = self.stage_stats(self.current)
+            if name in TOOL_METHODS:
+                stats[name] += 1
+                stats["tool_time"] += elapsed
+            else:
+                stats["wait" if name in WAIT_METHODS else "robot"] += elapsed
+                if name in ("MoveJ", "MoveL"):
+                    stats[name] += 1
+                index = LABEL_ARGUMENT.get(name)
+                label = args[index] if index is not None and len(args) > index else ""
+                self.moves.append((self.current, name, label, elapsed))
+            return result
+        return wrapper
+
+    def wrap_stage(self, stage, method):
+        """ Time a stage method, the remainder after robot and wait time is pose computation """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            previous = self.current
+            self.current = stage
+            stats = self.stage_stats(stage)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                stats["wall"] += time.perf_counter() - start
+                stats["compute"] = stats["wall"] - stats["robot"] - stats["wait"]
+                self.current = previous
+        return wrapper
+
+    def total(self):
+        """ Statistics summed over every stage """
+        totals = dict((field, 0) for field in STAGE_FIELDS)
+        totals["stage"] = "total"
+        for stats in self.stages.values():
+            for field in STAGE_FIELDS[1:]:
+                totals[field] += stats[field]
+        return totals
+
+    def rows(self):
+        """ Per-stage statistics in sequence order followed by the total """
+        return [self.stages[stage] for stage, parameter in cm.SEQUENCE if stage in self.stages] \
+            + [stats for stage, stats in self.stages.items() if stage not in dict(cm.SEQUENCE)] + [self.total()]
+
+    def to_csv(self, filename):
+        """ Write per-stage breakdown to a CSV file """
+        with open(filename, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=STAGE_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+    def to_json(self, filename):
+        """ Write per-stage breakdown and every timed move to a JSON file """
+        moves = [{"stage": stage, "method": method, "label": label, "seconds": seconds}
+                 for stage, method, label, seconds in self.moves]
+        with open(filename, "w") as file:
+            json.dump({"stages": self.rows(), "moves": moves}, file, indent=2)
+
+    def summary(self, slowest=5):
+        """ Text summary of the per-stage breakdown and the slowest individual calls.
+        slowest: number of slowest calls to list
+        """
+        total_wall = self.total()["wall"] or 1.0
+        lines = ["{:<24}{:>10}{:>7}{:>10}{:>10}{:>10}{:>7}{:>7}".format(
+            "Stage", "Wall (s)", "%", "Robot", "Wait", "Compute", "Moves", "Tools")]
+        for stats in self.rows():
+            lines.append("{:<24}{:>10.3f}{:>7.1f}{:>10.3f}{:>10.3f}{:>10.4f}{:>7}{:>7}".format(
+                stats["stage"], stats["wall"], 100 * stats["wall"] / total_wall, stats["robot"], stats["wait"],
+                stats["compute"], stats["MoveJ"] + stats["MoveL"], stats["tool_mount"] + stats["cup_tool"]))
+        lines.append("")
+        lines.append("Slowest calls:")
+        for stage, method, label, seconds in sorted(self.moves, key=lambda move: -move[3])[:slowest]:
+            lines.append("  {:.3f} s  {} {} ({})".format(seconds, method, label, stage))
+        return "\n".join(lines)
+
+
+def profile_cycle(machine, parameters=cm.PARAMETERS):
+    """ Run one full coffee cycle with instrumentation.
+    machine: CoffeeMachine
+    parameters: dictionary of stage parameters
+    output: CycleProfiler with the results
+    """
+    profiler = CycleProfiler()
+    profiler.instrument(machine)
+    try:
+        cm.make_coffee(machine, parameters)
+    finally:
+        profiler.uninstrument(machine)
+    return profiler
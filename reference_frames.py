@@ -1,4 +1,5 @@
 import robodk as rdk
+import station_store
 
 GLOBAL = "global"
 SILVIA = "silvia"
@@ -26,33 +27,10 @@ GRINDERPOWEROFF = "grinderpoweroff"
 
 
 def read_frames(filename):
-    file = open(filename, "r")
-    lines = file.readlines()
-    file.close()
-
-    frames = {}
-    for line in lines:
-        segments = line.rstrip().split(",")
-        name = segments[0]
-        values = [float(i) for i in segments[1:]]
-        transform = rdk.Mat([values[0:4],
-                             values[4:8],
-                             values[8:12],
-                             values[12:16]])
-        frames[name] = transform
-    return frames
+    return dict((name, rdk.Mat(frame.tolist()))
+                for name, frame in station_store.load_frames(filename).as_dict().items())
 
 
 def read_joint_angles(filename):
-    file = open(filename, "r")
-    lines = file.readlines()
-    file.close()
-
-    joint_angles = {}
-    for line in lines:
-        segments = line.rstrip().split(",")
-        name = segments[0]
-        values = [float(i) for i in segments[1:]]
-        angles = rdk.Mat(values)
-        joint_angles[name] = angles
-    return joint_angles
+    return dict((name, rdk.Mat(angles.tolist()))
+                for name, angles in station_store.load_joint_angles(filename).as_dict().items())
@@ -0,0 +1,370 @@
+# Incremental replanning when the station CSV files change
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import coffee_machine as cm
+import offline_robodk as off
+import preflight
+import ur5_kinematics as ur
+from blending import blend_plan
+from frame_graph import FrameGraph
+from motion_plan import MOVEJ, MOVEL, CoffeePlanner, MotionPlan, PipelinedExecutor, plan_key
+from speed_profiles import PROFILES, SPEEDS_PARAMETER, current_speeds, profile_plan, station_profiles
+from via_points import optimise_plan
+from workspace_map import WorkspaceMap
+
+POLL_INTERVAL = 0.2     # s between checks of the CSV modification times
+PLAN_FILENAME = "coffee_plan_replanned.npz"     # Active plan, kept apart from the plain compiled coffee_plan.npz
+STAGES = cm.SEQUENCE + [cm.CLEAR]    # Every cycle ends with the arm clear, ready for the next coffee
+# Dependency sources
+FRAME = "frame"
+JOINT = "joint"
+
+
+class TrackingFrameGraph(FrameGraph):
+    """ Frame graph that records the edges read by every lookup.
+    reads: set of (FRAME, edge name) the planner collects dependencies in, None while not planning
+    derived: dictionary of edge name -> (parent, child, dependencies) for edges set while planning
+    """
+
+    def __init__(self):
+        super(TrackingFrameGraph, self).__init__()
+        self.reads = None
+        self.derived = {}
+        self.chains = {}        # cache key -> names of the edges along its chain
+
+    def edge_name(self, edge):
+        """ Name of the row of reference_frames.csv an edge comes from, parent then child """
+        a, b = tuple(edge)
+        return a + b if (a, b) in self.edges else b + a
+
+    def set_edge(self, parent, child, transform):
+        if (parent, child) not in self.edges and (child, parent) not in self.edges:
+            self.chains.clear()
+        super(TrackingFrameGraph, self).set_edge(parent, child, transform)
+        if self.reads is not None:
+            self.derived[parent + child] = (parent, child, set(self.reads))
+
+    def get(self, start, end, via=()):
+        result = super(TrackingFrameGraph, self).get(start, end, via)
+        key = (start, tuple(via), end)
+        if key not in self.chains:
+            self.chains[key] = [self.edge_name(edge) for edge, keys in self.dependents.items() if key in keys]
+        if self.reads is not None:
+            for name in self.chains[key]:
+                self.reads.update(self.derived[name][2] if name in self.derived else [(FRAME, name)])
+        return result
+
+
+class TrackingJoints(dict):
+    """ Joint angle rows that record the names read.
+    reads: set of (JOINT, row name) shared with the planner
+    """
+
+    def __init__(self, rows, reads):
+        super(TrackingJoints, self).__init__(rows)
+        self.reads = reads
+
+    def __getitem__(self, name):
+        self.reads.add((JOINT, name))
+        return super(TrackingJoints, self).__getitem__(name)
+
+
+class TrackingPlanner(CoffeePlanner):
+    """ Planner that records the dependencies of every step.
+    dependencies: list of frozensets of (FRAME, edge name) and (JOINT, row name), one per step
+    starts: dictionary of stage -> tool mounted when the stage started
+    """
+
+    def __init__(self, frames, joint_angles):
+        self.reads = set()
+        frames.reads = self.reads
+        super(TrackingPlanner, self).__init__(frames, TrackingJoints(joint_angles, self.reads))
+        self.dependencies = []
+        self.starts = {}
+
+    def run_stage(self, stage, *args, **kwargs):
+        self.reads.clear()
+        self.starts[stage] = self.mounted
+        super(TrackingPlanner, self).run_stage(stage, *args, **kwargs)
+
+    def add(self, kind, target=None, label="", tool=None):
+        super(TrackingPlanner, self).add(kind, target, label, tool)
+        self.dependencies.append(frozenset(self.reads))
+
+
+def read_inputs(frame_filename, joint_filename):
+    """ Read both station CSV files into dictionaries of in-memory arrays.
+    The store memory maps its arrays and rewrites them when a file changes, so they are copied to keep the old
+    values for comparison.
+    output: tuple (frames, joint angles)
+    """
+    frames = dict((name, np.array(value)) for name, value in cm.read_frames(frame_filename).items())
+    joints = dict((name, np.array(value)) for name, value in cm.read_joint_angles(joint_filename).items())
+    return frames, joints
+
+
+def changed_rows(old, new, source):
+    """ Rows added, removed or with different values.
+    old, new: dictionaries of name -> array
+    source: FRAME or JOINT
+    output: set of (source, name)
+    """
+    names = set(old) ^ set(new)
+    names.update(name for name in set(old) & set(new) if not np.array_equal(old[name], new[name]))
+    return set((source, name) for name in names)
+
+
+def stamps(*filenames):
+    """ Modification time and size of each file """
+    return [(os.stat(filename).st_mtime_ns, os.stat(filename).st_size) for filename in filenames]
+
+
+class Replanner(object):
+    """ Keeps a plan up to date with the station CSV files.
+    plan: active MotionPlan, replaced as a whole so a reader always sees a complete plan
+    history: list of dictionaries, one per update, see update
+    profiles: speed profiles of the plan, see speed_profiles.station_profiles
+    optimise: False to keep the hand tuned detour waypoints
+    """
+
+    def __init__(self, frame_filename="reference_frames.csv", joint_filename="joint_angles.csv",
+                 parameters=cm.PARAMETERS, boxes=None, plan_filename=None, workspace=None, profiles=PROFILES,
+                 optimise=True):
+        self.frame_filename = frame_filename
+        self.joint_filename = joint_filename
+        self.parameters = dict(parameters)
+        self.boxes = preflight.station_boxes(preflight.read_key_points()) if boxes is None else boxes
+        self.plan_filename = plan_filename
+        self.workspace = workspace  # Optional WorkspaceMap, replanned targets near a singularity are rejected
+        self.profiles = profiles
+        self.optimise = optimise
+        self.history = []
+        self.lock = threading.Lock()
+        self.compile()
+
+    def planner(self):
+        """ Tracking planner on the current inputs, with the edges the active plan derived while planning """
+        frames = TrackingFrameGraph.from_frames(self.frames, cm.FRAMES)
+        for name, (parent, child, sources) in self.graph.derived.items():
+            frames.set_edge(parent, child, self.graph.edge(parent, child))
+            frames.derived[name] = (parent, child, sources)
+        return TrackingPlanner(frames, self.joints)
+
+    def compile(self):
+        """ Plan the whole sequence, ending with the arm clear, from the CSV files """
+        self.stamps = stamps(self.frame_filename, self.joint_filename)
+        self.frames, self.joints = read_inputs(self.frame_filename, self.joint_filename)
+        planner = TrackingPlanner(TrackingFrameGraph.from_frames(self.frames, cm.FRAMES), self.joints)
+        for stage, parameter in STAGES:
+            planner.run_stage(stage, *(() if parameter is None else (self.parameters[parameter],)))
+        planner.frames.reads = None
+        planner.plan.key = plan_key(self.frame_filename, self.joint_filename, self.parameters)
+        self.graph = planner.frames
+        self.dependencies = planner.dependencies
+        self.starts = planner.starts
+        self.swap(self.finish(planner.plan))
+
+    def finish(self, plan, only=None):
+        """ Optimise the detour waypoints of a plan, then attach blend radii and speed profiles.
+        plan: MotionPlan straight from the planner
+        only: optional collection of step indices, only detour waypoints among them are optimised
+        output: MotionPlan
+        """
+        if self.optimise:
+            plan = optimise_plan(plan, self.boxes, frame_filename=self.frame_filename, only=only)[0]
+        blend_plan(plan, boxes=self.boxes)
+        return profile_plan(plan, self.profiles, boxes=self.boxes)
+
+    def swap(self, plan):
+        """ Make a plan the active one, and the cached plan if a plan file was given """
+        with self.lock:
+            self.plan = plan
+        if self.plan_filename:
+            plan.save(self.plan_filename)
+
+    def changed(self):
+        """ Whether either CSV file was written since the last update """
+        return stamps(self.frame_filename, self.joint_filename) != self.stamps
+
+    def update(self):
+        """ Bring the plan up to date with the CSV files.
+        output: dictionary with the rows changed, the steps replanned, the preflight violations found among them,
+         whether the new steps were swapped in and the time taken in seconds
+        """
+        start = time.perf_counter()
+        self.stamps = stamps(self.frame_filename, self.joint_filename)
+        try:
+            frames, joints = read_inputs(self.frame_filename, self.joint_filename)
+        except ValueError as error:
+            # Half written file or a frame that is not a rotation, wait for the next write
+            return self.record({"changed": [], "steps": [], "violations": [], "swapped": False,
+                                "error": "{}: {}".format(type(error).__name__, error)}, start)
+        changed = changed_rows(self.frames, frames, FRAME) | changed_rows(self.joints, joints, JOINT)
+        affected = [i for i, dependencies in enumerate(self.dependencies) if dependencies & changed]
+        result = {"changed": sorted(name for source, name in changed), "steps": affected, "violations": [],
+                  "swapped": False}
+        if not affected:
+            # Nothing planned depends on the rows, e.g. a comment or a row no stage uses
+            self.frames, self.joints = frames, joints
+            return self.record(result, start)
+
+        old = (self.frames, self.joints)
+        self.frames, self.joints = frames, joints
+        try:
+            steps, dependencies, graph = self.replan(affected)
+        except (KeyError, ValueError) as error:
+            # A row a stage needs is missing or the frames no longer connect, keep the active plan
+            self.frames, self.joints = old
+            result["error"] = "{}: {}".format(type(error).__name__, error)
+            return self.record(result, start)
+
+        # A detour waypoint is optimised between the moves either side of it, so it is optimised again when
+        # either of them changed
+        moves = [i for i, step in enumerate(steps) if step.kind in (MOVEJ, MOVEL)]
+        nearby = set(affected)
+        for n, i in enumerate(moves):
+            if any(moves[m] in affected for m in (n - 1, n + 1) if 0 <= m < len(moves)):
+                nearby.add(i)
+        plan = self.finish(MotionPlan(steps, plan_key(self.frame_filename, self.joint_filename, self.parameters)),
+                           nearby)
+        # A linear move starts where the move before it ended, so the move after a changed step is checked too
+        checked = set(nearby)
+        for n, i in enumerate(moves[:-1]):
+            if i in nearby and steps[moves[n + 1]].kind == MOVEL:
+                checked.add(moves[n + 1])
+        result["violations"] = preflight.check(plan, self.boxes, only=sorted(checked), workspace=self.workspace)
+        if result["violations"]:
+            # Keep running the old targets until the calibration is fixed
+            self.frames, self.joints = old
+        else:
+            self.dependencies = dependencies
+            self.graph = graph
+            self.swap(plan)
+            result["swapped"] = True
+        return self.record(result, start)
+
+    def record(self, result, start):
+        """ Add the time taken to the result of an update and keep it in the history """
+        result["seconds"] = time.perf_counter() - start
+        self.history.append(result)
+        return result
+
+    def replan(self, affected):
+        """ Plan the stages holding affected steps again, each from the tool mounted when it started.
+        affected: indices of the steps depending on changed rows
+        output: tuple (steps with the affected ones replaced, dependencies of every step, frame graph)
+        """
+        steps = list(self.plan.steps)
+        dependencies = list(self.dependencies)
+        replace = set(affected)
+        stages = set(steps[i].stage for i in affected)
+        planner = self.planner()
+        for stage, parameter in STAGES:
+            if stage not in stages:
+                continue
+            rows = [i for i, step in enumerate(steps) if step.stage == stage]
+            planner.plan.steps = []
+            planner.dependencies = []
+            planner.mounted = self.starts[stage]
+            planner.run_stage(stage, *(() if parameter is None else (self.parameters[parameter],)))
+            if [(step.kind, step.label) for step in planner.plan.steps] != \
+                    [(steps[i].kind, steps[i].label) for i in rows]:
+                raise ValueError("Stage {} no longer plans the same steps".format(stage))
+            for i, step, step_dependencies in zip(rows, planner.plan.steps, planner.dependencies):
+                if i in replace:
+                    steps[i] = step
+                    dependencies[i] = step_dependencies
+        planner.frames.reads = None
+        return steps, dependencies, planner.frames
+
+    def watch(self, stop, interval=POLL_INTERVAL, report=None):
+        """ Poll the CSV files and update the plan whenever one is written, until stop is set.
+        stop: threading.Event
+        report: optional function called with the result of every update
+        """
+        while not stop.wait(interval):
+            if self.changed():
+                result = self.update()
+                if report is not None:
+                    report(result)
+
+    def stage_plan(self, stage):
+        """ Steps of one stage of the active plan.
+        output: MotionPlan with the stage's rounding and speeds
+        """
+        with self.lock:
+            plan = self.plan
+        rows = [i for i, step in enumerate(plan) if step.stage == stage]
+        if not rows:
+            return MotionPlan([], plan.key)
+        part = slice(rows[0], rows[-1] + 1)
+        return MotionPlan(plan.steps[part], plan.key, None if plan.rounding is None else plan.rounding[part],
+                          None if plan.speeds is None else plan.speeds[part])
+
+    def run_cycle(self, executor, speeds=None):
+        """ Make one coffee and clear the arm, taking each stage from the plan active when the stage starts.
+        executor: motion_plan executor
+        speeds: setSpeed arguments the robot is put back to afterwards, see speed_profiles.current_speeds
+        """
+        try:
+            for stage, parameter in STAGES:
+                executor.run(self.stage_plan(stage))
+        finally:
+            if speeds is not None:
+                executor.robot.setSpeed(*speeds)
+
+
+def describe(result):
+    """ One line summary of an update """
+    if "error" in result:
+        outcome = "kept the active plan, " + result["error"]
+    elif result["violations"]:
+        outcome = "kept the active plan, {} preflight problems: {}".format(
+            len(result["violations"]), "; ".join("{} {}".format(v.label, v.reason) for v in result["violations"]))
+    else:
+        outcome = "swapped in" if result["swapped"] else "nothing to replan"
+    return "{} changed, {} steps replanned in {:.1f} ms, {}".format(
+        ", ".join(result["changed"]) or "no rows", len(result["steps"]), 1000 * result["seconds"], outcome)
+
+
+def main():
+    if "--offline" in sys.argv:
+        RDK = off.OfflineRobolink(solver=ur.make_solver())
+        waiter = off.SimulatedWaiter(RDK)
+    else:
+        RDK = cm.rl.Robolink()
+        waiter = None
+    robot, master_tool = cm.connect_robot(RDK)
+    speeds = current_speeds(robot, RDK)
+    if speeds is None:
+        print("Set the {} station parameter to the robot speeds before running".format(SPEEDS_PARAMETER))
+        return
+
+    replanner = Replanner(plan_filename=PLAN_FILENAME, workspace=WorkspaceMap.load_or_build(),
+                          profiles=station_profiles(speeds))
+    stop = threading.Event()
+    watcher = threading.Thread(target=replanner.watch, args=(stop,), kwargs={"report": lambda r: print(describe(r))})
+    watcher.daemon = True
+    watcher.start()
+    print("Watching {} and {}".format(replanner.frame_filename, replanner.joint_filename))
+
+    executor = PipelinedExecutor(robot, master_tool, RDK, waiter=waiter)
+    try:
+        # One coffee per request, the robot waits at home without a tool in between
+        while True:
+            input("Press Enter to make a coffee, Ctrl+C to stop ")
+            replanner.run_cycle(executor, speeds)
+            print("Coffee made with plan {}".format(replanner.plan.key[:8]))
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
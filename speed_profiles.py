@@ -0,0 +1,171 @@
+# Per-move speed and acceleration profiles for compiled motion plans
+import time
+
+import numpy as np
+
+import coffee_machine as cm
+import offline_robodk as off
+import preflight
+from blending import PRECISE_LABELS, neighbours, step_positions
+from motion_plan import MOVEJ, MOVEL, PipelinedExecutor, load_or_compile
+
+TRANSIT = "transit"
+APPROACH = "approach"
+CONTACT = "contact"
+SPEEDS_PARAMETER = "RobotSpeeds"   # Station parameter with the robot speeds as comma separated setSpeed arguments
+
+
+def limit_speeds(limits):
+    """ setSpeed arguments matching offline_robodk.MotionLimits """
+    return (limits.linear_speed, limits.joint_speed, limits.linear_accel, limits.joint_accel)
+
+
+# (linear speed mm/s, joint speed deg/s, linear acceleration mm/s^2, joint acceleration deg/s^2), the order of
+# the RoboDK setSpeed arguments. Contact is the default speed of the offline station, station_profiles
+# replaces it with the speed the robot is actually set to.
+PROFILES = {TRANSIT: (500.0, 120.0, 1000.0, 180.0),
+            APPROACH: (350.0, 90.0, 700.0, 120.0),
+            CONTACT: limit_speeds(off.MotionLimits())}
+NEAR = 80.0     # mm, joint moves ending closer than this to a station item are approaches
+
+
+def current_speeds(robot, RDK):
+    """ Speed and acceleration the robot is set to.
+    RoboDK can set a robot's speed but not read it back, so the station keeps the speeds it sets the robot to
+    in the RobotSpeeds parameter. The offline robot reports its limits directly.
+    robot: robot item
+    RDK: Robolink or OfflineRobolink
+    output: tuple of setSpeed arguments, None if the station does not say
+    """
+    if isinstance(robot, off.OfflineRobot):
+        return limit_speeds(robot.limits)
+    value = RDK.getParam(SPEEDS_PARAMETER)
+    try:
+        speeds = tuple(float(part) for part in str(value).split(","))
+    except ValueError:
+        return None
+    return speeds if len(speeds) == 4 and all(speed > 0 for speed in speeds) else None
+
+
+def station_profiles(speeds, profiles=PROFILES):
+    """ Profiles with contact moves at the robot's own speed, no profile is slower than that.
+    speeds: setSpeed arguments the robot is set to, see current_speeds
+    profiles: dictionary of role -> setSpeed arguments
+    output: dictionary of role -> setSpeed arguments
+    """
+    result = dict((role, tuple(float(value) for value in np.maximum(values, speeds)))
+                  for role, values in profiles.items())
+    result[CONTACT] = tuple(float(value) for value in speeds)
+    return result
+
+
+def roles(plan, positions=None, boxes=None, near=NEAR):
+    """ Role of every move of a plan.
+    plan: MotionPlan
+    positions: (N, 3) TCP positions from blending.step_positions, computed if not given
+    boxes: station keep-out boxes from preflight.station_boxes, read from the key points if not given
+    near: distance to a station item in mm below which a joint move is an approach
+    output: list of TRANSIT, APPROACH, CONTACT or None for steps that are not moves
+    """
+    positions = step_positions(plan) if positions is None else positions
+    boxes = preflight.station_boxes(preflight.read_key_points()) if boxes is None else boxes
+    previous = neighbours(plan, positions)[0]
+    with np.errstate(invalid="ignore"):
+        clear = np.all(preflight.distances(positions, boxes) > near, axis=1)
+
+    moves = [i for i, step in enumerate(plan) if step.kind in (MOVEJ, MOVEL)]
+    precise = [plan.steps[i].label in PRECISE_LABELS for i in moves]
+    result = [None] * len(plan)
+    for n, i in enumerate(moves):
+        step = plan.steps[i]
+        following = plan.steps[i + 1] if i + 1 < len(plan) else None
+        if step.kind == MOVEL:
+            result[i] = CONTACT
+        elif np.isnan(positions[i]).any() or np.isnan(previous[i]).any():
+            # Unknown start or end, e.g. the Home target
+            result[i] = APPROACH
+        elif not clear[i] or precise[n] or (following is not None and following.kind != MOVEJ):
+            # Ends close to an item, at a precise waypoint, before a contact move or a tool program
+            result[i] = APPROACH
+        elif 0 < n < len(moves) - 1 and precise[n - 1] and precise[n + 1]:
+            # Between two precise waypoints, e.g. changing angle part way through the lever pull
+            result[i] = APPROACH
+        else:
+            result[i] = TRANSIT
+    return result
+
+
+def profile_plan(plan, profiles=PROFILES, **options):
+    """ Attach speed profiles to a plan, see roles.
+    profiles: dictionary of role -> setSpeed arguments
+    options: keyword arguments for roles
+    output: the plan, with plan.speeds set
+    """
+    speeds = np.zeros((len(plan), 4))
+    for i, role in enumerate(roles(plan, **options)):
+        if role is not None:
+            speeds[i] = profiles[role]
+    plan.speeds = speeds
+    return plan
+
+
+def compare(plan, **options):
+    """ Simulated cycle time of a plan at the single contact speed and with its speed profiles.
+    plan: MotionPlan with speeds set
+    options: keyword arguments for offline_robodk.OfflineRobolink
+    output: dictionary of stage -> (seconds at one speed, seconds with profiles), including "total"
+    """
+    speeds = plan.speeds
+    plan.speeds = None
+    try:
+        single = off.simulate_plan(plan, **options)
+    finally:
+        plan.speeds = speeds
+    profiled = off.simulate_plan(plan, **options)
+    return dict((stage, (single[stage], profiled[stage])) for stage in single)
+
+
+def run_profiled(executor, plan, speeds):
+    """ Run a plan with speed profiles, then set the robot back to its own speed even if the run fails.
+    executor: motion_plan executor
+    plan: MotionPlan with speeds set
+    speeds: setSpeed arguments to restore, see current_speeds
+    output: seconds the executor took to run the plan
+    """
+    start = time.monotonic()
+    try:
+        executor.run(plan)
+    finally:
+        executor.robot.setSpeed(*speeds)
+    return time.monotonic() - start
+
+
+def main():
+    RDK = cm.rl.Robolink()
+    robot, master_tool = cm.connect_robot(RDK)
+    speeds = current_speeds(robot, RDK)
+    if speeds is None:
+        print("Set the {} station parameter to the robot speeds before profiling".format(SPEEDS_PARAMETER))
+        return
+
+    plan = profile_plan(load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv"),
+                        station_profiles(speeds))
+    assigned = roles(plan)
+    for role in (TRANSIT, APPROACH, CONTACT):
+        print("{:<10}{:>4} moves".format(role, assigned.count(role)))
+    simulated = compare(plan)
+    for stage, (single, profiled) in simulated.items():
+        print("{:<24}{:>8.2f} s{:>8.2f} s{:>8.2f} s saved".format(stage, single, profiled, single - profiled))
+
+    executor = PipelinedExecutor(robot, master_tool, RDK)
+    measured = run_profiled(executor, plan, speeds)
+    print(executor.report())
+    # The run at the robot's own speed is not repeated, it is the simulated time scaled by how far the
+    # simulation was off for the profiled run
+    single, profiled = simulated["total"]
+    print("Cycle ran in {:.2f} s, about {:.2f} s less than at the robot's own speed".format(
+        measured, measured * single / profiled - measured))
+
+
+if __name__ == "__main__":
+    main()
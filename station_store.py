@@ -0,0 +1,211 @@
+# Shared loader for the station CSV files with a cached binary store
+import json
+import os
+import threading
+import warnings
+
+import numpy as np
+
+CACHE_DIR = ".station_cache"
+FRAME_WIDTH = 16
+JOINT_WIDTH = 6
+ORTHONORMAL_TOLERANCE = 1e-9    # Largest error in R^T R accepted without a correction
+REPAIR_LIMIT = 1e-2             # Largest error in R^T R that is corrected, frames further off are rejected
+
+# Tables already loaded in this process, keyed by absolute source path
+_loaded = {}
+# Repaired frame tables, keyed by absolute source path, with the loaded table they were repaired from
+_repaired = {}
+
+
+class StationTable(object):
+    """ Named rows of a station CSV file.
+    names: list of row names in file order
+    values: (N, 4, 4) array of frames or (N, 6) array of joint angles, one entry per row
+    index: dictionary of name -> row, the last row wins for duplicate names
+    duplicates: dictionary of duplicated name -> list of rows with that name
+    compiled: True if the binary store was compiled from the source file when the table was loaded
+    """
+
+    def __init__(self, names, values, duplicates=None, compiled=False):
+        self.names = names
+        self.values = values
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self.duplicates = duplicates if duplicates is not None else find_duplicates(names)
+        self.compiled = compiled
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        return self.values[self.index[name]]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def as_dict(self):
+        """ Dictionary of name -> row values, as returned by the original CSV readers """
+        return dict((name, self.values[i]) for name, i in self.index.items())
+
+
+def find_duplicates(names):
+    """ Find names used by more than one row.
+    names: list of row names
+    output: dictionary of name -> list of row numbers
+    """
+    rows = {}
+    for i, name in enumerate(names):
+        rows.setdefault(name, []).append(i)
+    return dict((name, found) for name, found in rows.items() if len(found) > 1)
+
+
+def parse_csv(filename, width):
+    """ Parse a station CSV file where each row is a name followed by width numbers.
+    filename: path to CSV file
+    width: number of values per row
+    output: tuple (names, (N, width) array)
+    """
+    with open(filename, "r") as file:
+        lines = [line for line in file.read().splitlines() if line.strip()]
+    names = []
+    fields = []
+    for line in lines:
+        name, values = line.split(",", 1)
+        names.append(name.strip())
+        fields.append(values)
+    # Convert every number in the file in one call rather than one float() per value
+    values = np.array(",".join(fields).split(","), dtype=np.float64)
+    if values.size != width * len(names):
+        raise ValueError("{} should have {} values on every row".format(filename, width))
+    return names, values.reshape(len(names), width)
+
+
+def cache_paths(filename, cache_dir=None):
+    """ Paths of the cached array and index for a source file """
+    directory = cache_dir if cache_dir is not None else os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                                                     CACHE_DIR)
+    base = os.path.join(directory, os.path.basename(filename))
+    return base + ".npy", base + ".json"
+
+
+def write_replacing(path, mode, write):
+    """ Write a cache file through a temporary file and rename it into place.
+    Processes compiling the same store at once each write their own temporary file, and a reader (or an
+    existing memory map) only ever sees a complete file.
+    path: path of the cache file
+    mode: file mode for open, "w" or "wb"
+    write: function writing the contents to an open file
+    """
+    temporary = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temporary, mode) as file:
+            write(file)
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def load_table(filename, width, cache_dir=None):
+    """ Load a station CSV file through the binary store, compiling it if the source has changed.
+    filename: path to CSV file
+    width: number of values per row
+    cache_dir: directory for the compiled store, defaults to .station_cache next to the source file
+    output: StationTable with memory mapped values
+    """
+    path = os.path.abspath(filename)
+    status = os.stat(path)
+    stamp = [status.st_mtime_ns, status.st_size]
+    if path in _loaded and _loaded[path][0] == stamp:
+        return _loaded[path][1]
+
+    array_path, index_path = cache_paths(filename, cache_dir)
+    table = None
+    if os.path.exists(array_path) and os.path.exists(index_path):
+        with open(index_path, "r") as file:
+            index = json.load(file)
+        if index["source"] == stamp and index["width"] == width:
+            table = StationTable(index["names"], np.load(array_path, mmap_mode="r"))
+
+    if table is None:
+        names, values = parse_csv(filename, width)
+        os.makedirs(os.path.dirname(array_path), exist_ok=True)
+        # The array is replaced before the index that validates it, so a reader never pairs a new index with an
+        # old array
+        write_replacing(array_path, "wb", lambda file: np.save(file, values))
+        write_replacing(index_path, "w", lambda file: json.dump({"source": stamp, "width": width, "names": names},
+                                                                file))
+        table = StationTable(names, np.load(array_path, mmap_mode="r"), compiled=True)
+
+    for name, rows in table.duplicates.items():
+        warnings.warn("{}: {} is defined on rows {}, using row {}".format(
+            filename, name, [row + 1 for row in rows], rows[-1] + 1))
+    _loaded[path] = (stamp, table)
+    return table
+
+
+def frame_errors(frames):
+    """ How far each frame is from a homogeneous transformation.
+    frames: (N, 4, 4) array
+    output: tuple ((N,) largest entry of |R^T R - I|, (N,) determinant of R, (N,) largest error in the last row)
+    """
+    rotations = frames[:, :3, :3]
+    orthonormal = np.abs(np.einsum("nji,njk->nik", rotations, rotations) - np.eye(3)).max(axis=(1, 2))
+    last_row = np.abs(frames[:, 3] - [0.0, 0.0, 0.0, 1.0]).max(axis=1)
+    return orthonormal, np.linalg.det(rotations), last_row
+
+
+def repair_frames(names, frames, tolerance=ORTHONORMAL_TOLERANCE, limit=REPAIR_LIMIT):
+    """ Project nearly orthonormal rotations onto the closest rotation matrix.
+    The closest rotation to R = U S V^T is U V^T, all frames needing it are done in one batched SVD.
+    names: list of frame names
+    frames: (N, 4, 4) array
+    tolerance: orthonormality error accepted without a correction
+    limit: orthonormality error above which a frame is rejected
+    output: tuple ((N, 4, 4) repaired frames, dictionary of corrected name -> largest change to a rotation entry)
+    """
+    orthonormal, determinant, last_row = frame_errors(frames)
+    invalid = (orthonormal > limit) | (determinant <= 0) | (last_row > tolerance)
+    if np.any(invalid):
+        raise ValueError("Frames are not valid transformations: {}".format(
+            ", ".join("{} (orthonormality error {:.3g}, determinant {:.3g}, last row error {:.3g})".format(
+                names[i], orthonormal[i], determinant[i], last_row[i]) for i in np.flatnonzero(invalid))))
+
+    rows = np.flatnonzero(orthonormal > tolerance)
+    if len(rows) == 0:
+        return frames, {}
+    repaired = np.array(frames)
+    u, s, vt = np.linalg.svd(frames[rows, :3, :3])
+    repaired[rows, :3, :3] = u @ vt
+    change = np.abs(repaired[rows] - frames[rows]).max(axis=(1, 2))
+    return repaired, dict((names[i], float(value)) for i, value in zip(rows, change))
+
+
+def load_frames(filename, cache_dir=None, repair=True):
+    """ Load reference frames as a StationTable of (4, 4) poses.
+    filename: path to reference_frames.csv
+    repair: True to validate the frames and correct nearly orthonormal rotations, see repair_frames. The
+     corrections are only reported when the binary store is compiled, not on every load of an unchanged file
+    """
+    table = load_table(filename, FRAME_WIDTH, cache_dir)
+    frames = table.values.reshape(-1, 4, 4)
+    if not repair:
+        return StationTable(table.names, frames, table.duplicates, table.compiled)
+    path = os.path.abspath(filename)
+    if path in _repaired and _repaired[path][0] is table:
+        return _repaired[path][1]
+    frames, corrections = repair_frames(table.names, frames)
+    if table.compiled:
+        for name, change in corrections.items():
+            warnings.warn("{}: rotation of {} is not orthonormal, corrected by up to {:.2g}".format(
+                filename, name, change))
+    repaired = StationTable(table.names, frames, table.duplicates, table.compiled)
+    _repaired[path] = (table, repaired)
+    return repaired
+
+
+def load_joint_angles(filename, cache_dir=None):
+    """ Load joint angle configurations as a StationTable of (6,) joint arrays.
+    filename: path to joint_angles.csv
+    """
+    return load_table(filename, JOINT_WIDTH, cache_dir)
@@ -0,0 +1,180 @@
+# Multi-station driver for running several coffee cells in parallel
+import multiprocessing
+import time
+from collections import namedtuple
+
+import coffee_machine as cm
+import offline_robodk as off
+import preflight
+from motion_plan import compile_plan
+
+BASE_PORT = 20500                   # RoboDK API port of the first station, station i listens on BASE_PORT + i
+LOG_FILENAME = "station_{}.jsonl"   # Event log of each station
+
+# Job kinds
+ORDER = "order"         # Make a coffee
+VALIDATE = "validate"   # Compile the plan for the parameters and run the pre-flight check, the robot does not move
+
+# number: position of the job in the queue, kind: ORDER or VALIDATE, parameters: stage parameter dictionary
+Job = namedtuple("Job", ["number", "kind", "parameters"])
+# station: station that ran the job or None if no station was left to run it, seconds: wall or simulated seconds
+# per stage including "total", problems: pre-flight violations for validation runs, error: message if the job failed
+Result = namedtuple("Result", ["job", "station", "seconds", "problems", "error"])
+
+# Connection of the current worker process, set up once by connect_station
+_station = {}
+
+
+def connect_station(number, offline, frame_filename, joint_filename, base_port=BASE_PORT,
+                    log_filename=LOG_FILENAME):
+    """ Connect the worker process to its station.
+    number: station number
+    offline: True to use the offline station instead of RoboDK
+    frame_filename, joint_filename: paths to the station CSV files
+    base_port: RoboDK API port of station 0
+    log_filename: event log filename pattern, formatted with the station number
+    """
+    log = log_filename.format(number) if log_filename else None
+    if offline:
+        machine, RDK = off.offline_machine(frame_filename, joint_filename, log)
+        clock = lambda: RDK.clock
+    else:
+        machine = cm.station_machine(cm.rl.Robolink(port=base_port + number), frame_filename, joint_filename, log)
+        clock = time.monotonic
+    _station.update(number=number, machine=machine, clock=clock, frame_filename=frame_filename,
+                    joint_filename=joint_filename, boxes=preflight.station_boxes(preflight.read_key_points()))
+
+
+def run_job(job):
+    """ Run one job on the station of this worker.
+    job: Job
+    output: Result
+    """
+    machine = _station["machine"]
+    # Validation runs do not move the robot, they are timed by the wall clock
+    clock = time.monotonic if job.kind == VALIDATE else _station["clock"]
+    seconds = {}
+    problems = []
+    start = clock()
+    try:
+        if job.kind == VALIDATE:
+            plan = compile_plan(_station["frame_filename"], _station["joint_filename"], job.parameters)
+            problems = preflight.check(plan, _station["boxes"])
+        else:
+            machine.log("Order " + str(job.number))
+            # The arm is cleared after every order, the station's next order starts from home without a tool
+            for stage, parameter in cm.SEQUENCE + [cm.CLEAR]:
+                before = clock()
+                machine.run_stage(stage, *(() if parameter is None else (job.parameters[parameter],)))
+                seconds[stage] = clock() - before
+        error = None
+    except Exception as failure:
+        error = "{}: {}".format(type(failure).__name__, failure)
+    seconds["total"] = clock() - start
+    # Worker processes are ended without running exit handlers, so the log is written out after every job
+    if machine.event_log:
+        machine.event_log.flush()
+    return Result(job, _station["number"], seconds, problems, error)
+
+
+def serve_station(number, jobs, results, offline, frame_filename, joint_filename, base_port, log_filename):
+    """ Worker process of one station, runs jobs from the shared queue until it is empty.
+    A failed order leaves the arm and the tools wherever the stage stopped, so the station takes no more jobs
+    and the other stations carry on with the queue.
+    number: station number
+    jobs: multiprocessing queue of Jobs, ended by one None per station
+    results: multiprocessing queue the Results are put on, followed by the station number once it stops
+    """
+    connect_station(number, offline, frame_filename, joint_filename, base_port, log_filename)
+    machine = _station["machine"]
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        result = run_job(job)
+        results.put(result)
+        if job.kind == ORDER and result.error is not None:
+            machine.log("Stopped after order {} failed, clear the station before using it again".format(job.number))
+            break
+    machine.close_log()
+    results.put(number)
+
+
+def run_jobs(jobs, stations, offline=True, frame_filename="reference_frames.csv",
+             joint_filename="joint_angles.csv", base_port=BASE_PORT, log_filename=LOG_FILENAME):
+    """ Distribute jobs over a pool of stations, each job goes to whichever station is free.
+    jobs: list of Jobs
+    stations: number of stations, one worker process each
+    offline: True to use offline stations instead of RoboDK instances
+    base_port, log_filename: see connect_station
+    output: tuple (list of Results in job order, wall seconds for the whole queue), jobs left over once every
+     station has stopped after a failed order are returned without a station
+    """
+    queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for job in jobs:
+        queue.put(job)
+    for number in range(stations):
+        queue.put(None)
+    start = time.monotonic()
+    workers = [multiprocessing.Process(target=serve_station, args=(number, queue, results, offline, frame_filename,
+                                                                   joint_filename, base_port, log_filename))
+               for number in range(stations)]
+    for worker in workers:
+        worker.start()
+    finished = {}
+    running = stations
+    while running:
+        result = results.get()
+        if isinstance(result, Result):
+            finished[result.job.number] = result
+        else:
+            running -= 1
+    for worker in workers:
+        worker.join()
+    return [finished.get(job.number) or Result(job, None, {"total": 0.0}, [], "Not run, every station stopped")
+            for job in jobs], time.monotonic() - start
+
+
+def summarise(results):
+    """ Totals per station.
+    results: list of Results
+    output: dictionary of station -> dictionary with the number of jobs, failed jobs and busy seconds
+    """
+    summary = {}
+    for result in results:
+        if result.station is None:
+            continue
+        station = summary.setdefault(result.station, {"jobs": 0, "failed": 0, "busy": 0.0})
+        station["jobs"] += 1
+        station["failed"] += result.error is not None
+        station["busy"] += result.seconds.get("total", 0.0)
+    return summary
+
+
+def main():
+    stations = 3
+    jobs = [Job(number, ORDER, cm.PARAMETERS) for number in range(6)]
+    jobs += [Job(len(jobs) + number, VALIDATE, dict(cm.PARAMETERS, height=height))
+             for number, height in enumerate([90, 98, 106])]
+    results, wall = run_jobs(jobs, stations)
+    for result in results:
+        print("{:>4} {:<9} station {:>2}  {:>8.2f} s  {}".format(
+            result.job.number, result.job.kind, "-" if result.station is None else result.station,
+            result.seconds["total"],
+            result.error or ("{} problems".format(len(result.problems)) if result.job.kind == VALIDATE else "")))
+    summary = summarise(results)
+    for station, totals in sorted(summary.items()):
+        print("Station {}: {} jobs, {} failed, {:.1f} s busy".format(station, totals["jobs"], totals["failed"],
+                                                                      totals["busy"]))
+    # Orders on separate stations run at the same time, the slowest station sets the time for the queue
+    served = sum(result.job.kind == ORDER and result.error is None for result in results)
+    longest = max([sum(result.seconds["total"] for result in results
+                       if result.station == station and result.job.kind == ORDER) for station in summary] or [0.0])
+    rate = 3600.0 * served / longest if longest > 0 else 0.0
+    print("{} orders on {} stations in {:.1f} s simulated ({:.1f} drinks/h), {:.1f} s wall".format(
+        served, stations, longest, rate, wall))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Parameter sweep for tuning the coffee making stages
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import coffee_machine as cm
+import offline_robodk as off
+import preflight
+import ur5_kinematics as ur
+from coffee_machine import GLOBAL, FILTER, TCP, TOOL, SCRAPER, TAMPER, CROSS, CUP, SILVIA, CUPPLACE
+from frame_graph import FrameGraph
+from motion_plan import CoffeePlanner
+from poses import compose, transl, roty
+
+# Tuning values are stage parameters or CoffeeMachine attributes
+OFFSETS = ["entry_pitch", "entry_shift"]
+DEFAULTS = dict(cm.PARAMETERS, entry_pitch=cm.ENTRY_PITCH, entry_shift=cm.ENTRY_SHIFT)
+GRID = {"N": [1, 2, 3, 4],
+        "height": [90, 94, 98, 102, 106],
+        "time": [10, 12, 14],
+        "scraper_height": [4, 6, 8, 10, 12],
+        "tamp_height": [10, 15, 20],
+        "entry_pitch": [-0.08, -0.04, 0.0],
+        "entry_shift": [-4, -2, 0]}
+# Cup tool offsets (y, z) at the drip tray used by place_cup and pickup_coffee
+CUP_OFFSETS = [(7, 0), (15, -100), (50, -150), (60, -180)]
+
+
+def entry_targets(frames, pitch, shift):
+    """ Portafilter entry into the grinder and pull out, as in insert_filter_grinder and scrape_filter """
+    entry = compose(frames.get(GLOBAL, FILTER), frames.get(TCP, FILTER), roty(pitch), transl(shift, 0, 0),
+                    frames.get(FILTER, TOOL), transl(0, 0, 4), frames.get(TOOL, TCP))
+    return np.stack([entry, compose(entry, transl(0, 0, -70))], axis=-3)
+
+
+def scraper_targets(frames, scraper_height):
+    """ Start and end of the push through the scraper, as in scrape_filter """
+    return compose(frames.get(GLOBAL, SCRAPER, [CROSS]), transl(scraper_height[..., None], 0, [-60, 40]),
+                   frames.get(SCRAPER, TCP))
+
+
+def tamp_targets(frames, depth):
+    """ End of the tamping move, as in tamp_filter """
+    return compose(frames.get(GLOBAL, TAMPER, [CROSS]), frames.get(SCRAPER, FILTER), transl(depth, 0, 0),
+                   frames.get(FILTER, TCP))[..., None, :, :]
+
+
+def cup_targets(frames, height):
+    """ Cup tool targets at the drip tray and where the cup is put down, as in place_cup and pickup_coffee """
+    y, z = np.transpose(CUP_OFFSETS)
+    tray = compose(frames.get(GLOBAL, CUP, [SILVIA]), transl(height[..., None], y, z), frames.get(CUP, TCP))
+    down = compose(frames.get(GLOBAL, CUPPLACE), transl(height - 10, 0, 0), frames.get(CUP, TCP))
+    return np.concatenate([tray, down[..., None, :, :]], axis=-3)
+
+
+# Groups of tuning values that are evaluated together and the targets that depend on them, None if the values
+# only change timing
+FAMILIES = [(["entry_pitch", "entry_shift"], entry_targets),
+            (["scraper_height"], scraper_targets),
+            (["tamp_height"], tamp_targets),
+            (["height"], cup_targets),
+            (["N"], None),
+            (["time"], None)]
+
+
+def reachable(frames, grid=GRID, tool=ur.MASTER_TOOL):
+    """ Whether every target of each family has an inverse kinematics solution, for every value in the grid.
+    frames: FrameGraph
+    grid: dictionary of tuning value name -> list of values
+    output: list of boolean arrays, one per family with one axis per value name in the family
+    """
+    masks = []
+    for names, targets in FAMILIES:
+        values = np.meshgrid(*[np.asarray(grid[name], dtype=np.float64) for name in names], indexing="ij")
+        if targets is None:
+            masks.append(np.ones(values[0].shape, dtype=bool))
+            continue
+        poses = targets(frames, *values)
+        solutions = ur.inverse(poses.reshape(-1, 4, 4), tool)
+        solved = ~np.all(np.isnan(solutions).any(axis=2), axis=1)
+        masks.append(np.all(solved.reshape(poses.shape[:-2]), axis=-1))
+    return masks
+
+
+def evaluate(overrides, frame_filename="reference_frames.csv", joint_filename="joint_angles.csv"):
+    """ Time one set of tuning values on the offline station and check its plan.
+    overrides: dictionary of tuning values that differ from DEFAULTS
+    output: tuple (dictionary of simulated seconds per stage including "total", number of pre-flight problems)
+    """
+    values = dict(DEFAULTS, **overrides)
+    parameters = dict((name, values[name]) for name in cm.PARAMETERS)
+    machine, RDK = off.offline_machine(frame_filename, joint_filename)
+    frames = FrameGraph.from_frames(cm.read_frames(frame_filename), cm.FRAMES)
+    planner = CoffeePlanner(frames, cm.read_joint_angles(joint_filename))
+    for name in OFFSETS:
+        setattr(machine, name, values[name])
+        setattr(planner, name, values[name])
+    times = off.simulate_cycle(machine, RDK, parameters)
+    cm.make_coffee(planner, parameters)
+    problems = preflight.check(planner.plan, preflight.station_boxes(preflight.read_key_points()))
+    return times, len(problems)
+
+
+def sweep(grid=GRID, workers=None, frame_filename="reference_frames.csv", joint_filename="joint_angles.csv"):
+    """ Estimate the cycle time and feasibility of every combination of tuning values.
+    grid: dictionary of tuning value name -> list of values, every name in DEFAULTS must be present
+    workers: number of processes for the offline runs, defaults to the number of CPUs
+    output: tuple ((...) array of estimated cycle seconds, (...) boolean feasibility array), one axis per
+     name in grid order
+    """
+    frames = FrameGraph.from_frames(cm.read_frames(frame_filename), cm.FRAMES)
+    masks = reachable(frames, grid)
+    runs = [{}]
+    for names, targets in FAMILIES:
+        runs += [dict(zip(names, combination)) for combination in itertools.product(*[grid[name] for name in names])]
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(evaluate, runs, [frame_filename] * len(runs), [joint_filename] * len(runs)))
+    base = results[0][0]["total"]
+    if results[0][1]:
+        raise RuntimeError("The default tuning values do not pass the pre-flight check")
+
+    order = list(grid)
+    total = np.full([len(grid[name]) for name in order], base)
+    feasible = np.ones(total.shape, dtype=bool)
+    run = 1
+    for (names, targets), mask in zip(FAMILIES, masks):
+        count = mask.size
+        delta = np.array([times["total"] - base for times, problems in results[run:run + count]]).reshape(mask.shape)
+        clear = np.array([problems == 0 for times, problems in results[run:run + count]]).reshape(mask.shape)
+        run += count
+        # Broadcast the family's axes into the full grid
+        axes = [order.index(name) for name in names]
+        shape = [len(grid[name]) if i in axes else 1 for i, name in enumerate(order)]
+        permutation = np.argsort(axes)
+        total = total + np.transpose(delta, permutation).reshape(shape)
+        feasible &= np.transpose(mask & clear, permutation).reshape(shape)
+    return total, feasible
+
+
+def ranking(total, feasible, grid=GRID, count=10):
+    """ Fastest feasible combinations.
+    output: list of (estimated seconds, dictionary of tuning values)
+    """
+    candidates = np.flatnonzero(feasible.ravel())
+    best = candidates[np.argsort(total.ravel()[candidates], kind="stable")[:count]]
+    names = list(grid)
+    return [(float(total.ravel()[i]), dict((name, grid[name][index]) for name, index in
+                                            zip(names, np.unravel_index(i, total.shape)))) for i in best]
+
+
+def main():
+    start = time.perf_counter()
+    total, feasible = sweep()
+    elapsed = time.perf_counter() - start
+    for seconds, values in ranking(total, feasible):
+        print("{:>8.1f} s  {}".format(seconds, "  ".join("{}={}".format(*item) for item in values.items())))
+    print("{} combinations, {} feasible, evaluated in {:.1f} s".format(total.size, np.count_nonzero(feasible),
+                                                                        elapsed))
+
+
+if __name__ == "__main__":
+    main()
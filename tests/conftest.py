@@ -0,0 +1,48 @@
+# Test configuration, the modules under test live in the repository root and the station files are copied out of
+# it so the compiled stores and maps the tests write stay out of the repository
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+STATION_FILES = ["reference_frames.csv", "joint_angles.csv", "Extras/key_points.csv"]
+
+
+@pytest.fixture(scope="session")
+def station_dir(tmp_path_factory):
+    """ Temporary copy of the station files """
+    directory = tmp_path_factory.mktemp("station")
+    for name in STATION_FILES:
+        os.makedirs(os.path.dirname(str(directory / name)), exist_ok=True)
+        shutil.copy(os.path.join(ROOT, name), str(directory / name))
+    return directory
+
+
+@pytest.fixture
+def station_files(station_dir):
+    """ Paths to the station reference frame and joint angle CSV files """
+    return str(station_dir / "reference_frames.csv"), str(station_dir / "joint_angles.csv")
+
+
+@pytest.fixture
+def key_points(station_dir):
+    """ Path to the station key points file """
+    import preflight
+    return str(station_dir / preflight.KEY_POINTS)
+
+
+@pytest.fixture
+def boxes(key_points):
+    """ Keep-out boxes around the station items """
+    import preflight
+    return preflight.station_boxes(preflight.read_key_points(key_points))
+
+
+@pytest.fixture
+def plan(station_files):
+    """ Coffee sequence compiled from the station files """
+    import motion_plan
+    return motion_plan.compile_plan(*station_files)
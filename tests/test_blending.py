@@ -0,0 +1,24 @@
+import numpy as np
+
+from blending import MAX_RADIUS, PRECISE_LABELS, blend_plan, obstacle_distances, step_positions
+from motion_plan import MOVEJ, MOVEL, PROGRAM
+
+
+def test_only_transit_waypoints_are_blended(plan, boxes):
+    radii = blend_plan(plan, boxes=boxes).rounding
+    assert radii.shape == (len(plan),) and np.count_nonzero(radii)
+    for i, (step, radius) in enumerate(zip(plan, radii)):
+        if radius == 0:
+            continue
+        assert step.kind == MOVEJ and step.label not in PRECISE_LABELS
+        # A blended waypoint is followed by another joint move, never by a contact move or a tool program
+        assert plan.steps[i + 1].kind == MOVEJ
+    following = [plan.steps[i + 1].kind for i in range(len(plan) - 1)]
+    assert all(radii[i] == 0 for i, kind in enumerate(following) if kind in (MOVEL, PROGRAM))
+
+
+def test_radii_stay_clear_of_station_items(plan, boxes):
+    radii = blend_plan(plan, boxes=boxes).rounding
+    free = obstacle_distances(plan, boxes, step_positions(plan))
+    blended = radii > 0
+    assert np.all(radii[blended] <= free[blended]) and np.all(radii <= MAX_RADIUS)
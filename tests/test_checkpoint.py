@@ -0,0 +1,74 @@
+import pytest
+
+import coffee_machine as cm
+import offline_robodk as off
+from checkpoint import ARM, SILVIA, SERVED, STACK, STAGES, Checkpoint, run_checkpointed
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def machine(station_files):
+    machine, RDK = off.offline_machine(*station_files)
+    return machine
+
+
+def record_moves(machine, fail_at=None):
+    """ Record the labels of the moves of a machine, raising Interrupted before the move labelled fail_at """
+    moves = []
+    for name in ("MoveJ", "MoveL"):
+        machine.__dict__.pop(name, None)
+        def move(matrix, pos="", original=getattr(machine, name)):
+            if (machine.stage, pos) == fail_at:
+                raise Interrupted(pos)
+            moves.append((machine.stage, pos))
+            original(matrix, pos)
+        setattr(machine, name, move)
+    return moves
+
+
+def test_state_follows_the_sequence(machine, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    run_checkpointed(machine, checkpoint)
+    state = Checkpoint.load(checkpoint.filename).state
+    assert state["completed"] == [stage for stage, parameter in STAGES]
+    assert state["running"] is None and state["mounted"] is None and machine.mounted is None
+    assert state["filter"] == SILVIA and state["cup"] == SERVED
+
+
+def test_next_coffee_starts_with_the_arm_clear(machine, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    run_checkpointed(machine, checkpoint)
+    attaches = []
+    change_tool = machine.change_tool
+
+    def tracked(name, pickup=True, location=cm.STAND):
+        if pickup:
+            attaches.append((name, machine.mounted))
+        change_tool(name, pickup, location)
+    machine.change_tool = tracked
+    run_checkpointed(machine, Checkpoint.load(checkpoint.filename))
+    assert len(attaches) == 6 and all(mounted is None for name, mounted in attaches)
+
+
+@pytest.mark.parametrize("stage, label, cup, retraced", [
+    ("pickup_coffee", "Remove cup", ARM, ["Intermediate point", "Remove cup"]),
+    ("place_cup", "Remove tool from machine", SILVIA, ["Intermediate point", "Remove tool from machine"]),
+    ("tamp_filter", "Lower filter", STACK, ["Compress coffee", "Lower filter", "Remove from tamper"]),
+    ("clear_arm", "cupmount", SERVED, ["Back away from cup"])])
+def test_interrupted_stage_backs_out_before_going_home(machine, tmp_path, stage, label, cup, retraced):
+    filename = str(tmp_path / "checkpoint.json")
+    record_moves(machine, (stage, label))
+    with pytest.raises(Interrupted):
+        run_checkpointed(machine, Checkpoint(filename))
+    state = Checkpoint.load(filename).state
+    assert state["running"] == stage and state["cup"] == cup
+
+    moves = record_moves(machine)
+    run_checkpointed(machine, Checkpoint.load(filename))
+    labels = [pos for moved, pos in moves]
+    assert labels[:len(retraced)] == ["Recover: " + name for name in retraced]
+    assert labels[len(retraced)] == ("Lift cup up" if stage == "pickup_coffee" else "Recover to home")
+    assert Checkpoint.load(filename).finished()
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from frame_graph import FrameGraph, split_name
+from poses import compose, inverse, rotx, rotz, transl
+
+NODES = ["global", "silvia", "cup", "tcp", "cupstack"]
+
+
+@pytest.fixture
+def graph():
+    return FrameGraph.from_frames({"global": np.eye(4),
+                                   "globalsilvia": compose(transl(100, 0, 0), rotz(0.5)),
+                                   "silviacup": compose(transl(0, 50, 20), rotx(0.2)),
+                                   "cuptcp": transl(0, 0, 30),
+                                   "globalcupstack": transl(0, -200, 0),
+                                   "cupstackcup": transl(0, 0, 100)}, NODES)
+
+
+def test_split_name():
+    assert split_name("globalsilvia", NODES) == ("global", "silvia")
+    with pytest.raises(ValueError):
+        split_name("globalnothing", NODES)
+
+
+def test_chain_and_inverse(graph):
+    expected = compose(graph.edge("global", "silvia"), graph.edge("silvia", "cup"), graph.edge("cup", "tcp"))
+    assert np.allclose(graph.get("global", "tcp", ["silvia"]), expected)
+    assert np.allclose(graph.get("tcp", "global", ["silvia"]), inverse(expected))
+
+
+def test_ambiguous_and_missing_paths(graph):
+    # The cup hangs off both the coffee machine and the cup stack
+    with pytest.raises(ValueError):
+        graph.get("global", "cup")
+    assert np.allclose(graph.get("global", "cup", ["cupstack"]), transl(0, -200, 100))
+    graph.adjacent["lonely"] = set()
+    with pytest.raises(KeyError):
+        graph.get("global", "lonely")
+
+
+def test_updating_an_edge_invalidates_cached_lookups(graph):
+    before = graph.get("global", "tcp", ["cupstack"])
+    assert not before.flags.writeable
+    graph.set_edge("cupstack", "cup", transl(0, 0, 150))
+    assert np.allclose(graph.get("global", "tcp", ["cupstack"])[:3, 3], before[:3, 3] + [0, 0, 50])
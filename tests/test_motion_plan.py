@@ -0,0 +1,52 @@
+import shutil
+
+import numpy as np
+
+import coffee_machine as cm
+from motion_plan import MOVEJ, PAUSE, PROGRAM, MotionPlan, compile_plan, load_or_compile, plan_key
+
+
+def same_steps(a, b):
+    for x, y in zip(a, b):
+        assert (x.kind, x.label, x.tool, x.stage) == (y.kind, y.label, y.tool, y.stage)
+        if isinstance(x.target, np.ndarray):
+            assert np.array_equal(np.asarray(x.target).reshape(np.shape(y.target)), y.target)
+        else:
+            assert x.target == y.target
+    assert len(a) == len(b)
+
+
+def test_plan_covers_every_stage(plan):
+    assert [stage for stage, parameter in cm.SEQUENCE] == list(dict.fromkeys(step.stage for step in plan))
+    kinds = set(step.kind for step in plan)
+    assert {MOVEJ, PROGRAM, PAUSE} <= kinds
+
+
+def test_save_and_load(plan, tmp_path):
+    plan.rounding = np.arange(len(plan), dtype=np.float64)
+    plan.speeds = np.ones((len(plan), 4))
+    filename = str(tmp_path / "plan.npz")
+    plan.save(filename)
+    loaded = MotionPlan.load(filename)
+    same_steps(plan.steps, loaded.steps)
+    assert loaded.key == plan.key
+    assert np.array_equal(loaded.rounding, plan.rounding) and np.array_equal(loaded.speeds, plan.speeds)
+
+
+def test_cached_plan_is_reused_until_the_inputs_change(station_files, tmp_path):
+    frames, joints = [str(tmp_path / name) for name in ("reference_frames.csv", "joint_angles.csv")]
+    shutil.copy(station_files[0], frames)
+    shutil.copy(station_files[1], joints)
+    filename = str(tmp_path / "plan.npz")
+    first = load_or_compile(filename, frames, joints)
+    assert first.key == plan_key(frames, joints, cm.PARAMETERS)
+    same_steps(load_or_compile(filename, frames, joints).steps, first.steps)
+    longer = load_or_compile(filename, frames, joints, dict(cm.PARAMETERS, N=4))
+    assert longer.key != first.key and len(longer) > len(first)
+    with open(joints, "a") as file:
+        file.write("extra, 0, 0, 0, 0, 0, 0\n")
+    assert load_or_compile(filename, frames, joints).key != first.key
+
+
+def test_compiled_plan_matches_station_files(station_files, plan):
+    same_steps(compile_plan(*station_files).steps, plan.steps)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+
+import coffee_machine as cm
+import offline_robodk as off
+from order_server import FAILED, DONE, QUEUED, OrderServer
+
+
+class Machine(object):
+    """ Stand-in for a CoffeeMachine whose stages can be made to fail """
+
+    def __init__(self, failing=None):
+        self.failing = failing
+        self.stage = None
+        self.mounted = None
+        self.event_log = None
+        self.stages = []
+
+    def log(self, message):
+        pass
+
+    def run_stage(self, stage, *args):
+        self.stage = stage
+        self.mounted = cm.CUP
+        if stage == self.failing:
+            raise RuntimeError("Stage {} failed".format(stage))
+        self.stages.append(stage)
+
+
+@pytest.fixture
+def server():
+    return OrderServer(Machine())
+
+
+def test_defaults_and_overrides(server):
+    assert server.parse_parameters({}) == cm.PARAMETERS
+    parameters = server.parse_parameters({"N": 2, "height": 100.0, "time": 12})
+    assert parameters["N"] == 2 and parameters["height"] == 100 and isinstance(parameters["height"], int)
+
+
+@pytest.mark.parametrize("requested", [{"N": 2.7}, {"N": "3"}, {"N": True}, {"time": float("inf")},
+                                       {"height": float("nan")}, {"N": 10 ** 400}, {"N": 0}, {"height": 500},
+                                       {"sugar": 1}])
+def test_bad_parameters_are_refused(server, requested):
+    with pytest.raises(ValueError):
+        server.parse_parameters(requested)
+
+
+def test_infinity_from_json_is_refused(server):
+    with pytest.raises(ValueError):
+        server.parse_parameters(json.loads('{"time": Infinity}'))
+
+
+def run_orders(server, count):
+    """ Queue orders and let the server work through them until it stops or finishes """
+    async def serve():
+        server.queue = asyncio.Queue(server.queue_size)
+        server.resumed = asyncio.Event()
+        for _ in range(count):
+            assert server.handle({"command": "order"})["status"] == QUEUED
+        worker = asyncio.ensure_future(server.serve_orders())
+        for _ in range(200):
+            await asyncio.sleep(0.01)
+            if server.halted or all(order["status"] == DONE for order in server.orders):
+                break
+        worker.cancel()
+    asyncio.run(serve())
+
+
+def test_failed_order_stops_the_queue():
+    server = OrderServer(Machine(failing="place_cup"))
+    run_orders(server, 2)
+    assert [order["status"] for order in server.orders] == [FAILED, QUEUED]
+    assert "place_cup" in server.halted
+    with pytest.raises(ValueError):
+        server.handle({"command": "order"})
+
+
+def test_resume_clears_the_station_state():
+    server = OrderServer(Machine(failing="place_cup"))
+    run_orders(server, 1)
+    server.resumed = asyncio.Event()
+    assert server.handle({"command": "resume"}) == {"status": "resumed"}
+    assert server.halted is None and server.machine.mounted is None
+    with pytest.raises(ValueError):
+        server.handle({"command": "resume"})
+
+
+def test_orders_start_with_the_arm_clear(station_files):
+    machine, RDK = off.offline_machine(*station_files)
+    attaches = []
+    change_tool = machine.change_tool
+
+    def tracked(name, pickup=True, location=cm.STAND):
+        if pickup:
+            attaches.append((name, machine.mounted))
+        change_tool(name, pickup, location)
+    machine.change_tool = tracked
+    server = OrderServer(machine, lambda: RDK.clock)
+    run_orders(server, 2)
+    assert [order["status"] for order in server.orders] == [DONE, DONE]
+    assert len(attaches) == 12 and all(mounted is None for name, mounted in attaches)
+    assert machine.mounted is None
@@ -0,0 +1,44 @@
+import numpy as np
+import robodk as rdk
+
+from poses import IDENTITY, compose, from_mat, inverse, pose, robodk_target, rotx, roty, rotz, to_mat, transl
+
+
+def random_poses(count, seed=0):
+    generator = np.random.default_rng(seed)
+    angles = generator.uniform(-np.pi, np.pi, (3, count))
+    offsets = generator.uniform(-500.0, 500.0, (3, count))
+    return compose(transl(*offsets), rotz(angles[0]), roty(angles[1]), rotx(angles[2]))
+
+
+def test_matches_robodk():
+    expected = rdk.transl(10, -20, 30) * rdk.rotz(0.3) * rdk.roty(-1.1) * rdk.rotx(2.0)
+    result = compose(transl(10, -20, 30), rotz(0.3), roty(-1.1), rotx(2.0))
+    assert np.allclose(result, from_mat(expected))
+    assert np.allclose(from_mat(to_mat(result)), result)
+
+
+def test_batches_broadcast_against_single_poses():
+    angles = np.linspace(-1.0, 1.0, 5)
+    batch = compose(transl(0, 0, 10), rotz(angles))
+    assert batch.shape == (5, 4, 4)
+    for i, angle in enumerate(angles):
+        assert np.allclose(batch[i], compose(transl(0, 0, 10), rotz(angle)))
+
+
+def test_inverse():
+    poses = random_poses(20)
+    assert np.allclose(compose(poses, inverse(poses)), np.broadcast_to(IDENTITY, poses.shape))
+    assert np.allclose(inverse(poses), np.linalg.inv(poses))
+
+
+def test_pose_accepts_flat_rows():
+    values = np.arange(16.0)
+    assert np.array_equal(pose(values), values.reshape(4, 4))
+    assert pose([values, values]).shape == (2, 4, 4)
+
+
+def test_robodk_target():
+    assert robodk_target(np.arange(6.0)) == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
+    assert isinstance(robodk_target(transl(1, 2, 3)), rdk.Mat)
+    assert robodk_target("Home") == "Home"
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+import preflight
+from motion_plan import MotionPlan
+from workspace_map import MIN_MANIPULABILITY
+
+
+def moved(plan, index, position):
+    """ Copy of a plan with the TCP of one pose target moved to position """
+    steps = list(plan.steps)
+    target = np.array(steps[index].target, dtype=np.float64)
+    target[:3, 3] = position
+    steps[index] = steps[index]._replace(target=target)
+    return MotionPlan(steps, plan.key, plan.rounding, plan.speeds)
+
+
+def transit(plan, stage, label):
+    return next(i for i, step in enumerate(plan) if step.stage == stage and step.label == label)
+
+
+def test_station_plan_is_clear(plan, boxes):
+    assert preflight.check(plan, boxes) == []
+
+
+def test_target_inside_box_is_flagged(plan, boxes):
+    index = transit(plan, "turn_on_grinder", "Avoid silvia and cups")
+    cupstack = next(item for item in boxes if item.name == "cupstack")
+    violations = preflight.check(moved(plan, index, cupstack.pose[:3, 3]), boxes)
+    assert any(v.step == index and "inside cupstack box" in v.reason for v in violations)
+
+
+def test_linear_move_through_box_is_flagged(plan, boxes):
+    # Start the push of the grinder off button on the far side of the coffee machine, the straight line to the
+    # button then runs through the machine box, which the grinder stages may not enter
+    index = transit(plan, "turn_on_grinder", "Push off button")
+    silvia = next(item for item in boxes if item.name == "silvia").pose[:3, 3]
+    start = 2 * silvia - np.asarray(plan.steps[index].target)[:3, 3]
+    violations = preflight.check(moved(plan, index - 1, start), boxes, only=[index])
+    assert any(v.step == index and "passes through silvia box" in v.reason for v in violations)
+
+
+def test_out_of_reach():
+    points = np.array([[300.0, 0.0, 300.0], [2000.0, 0.0, 300.0], [300.0, 0.0, -100.0]])
+    assert preflight.out_of_reach(points).tolist() == [False, True, True]
+
+
+@pytest.fixture(scope="session")
+def workspace(station_dir, tmp_path_factory):
+    from workspace_map import WorkspaceMap, MAP_FILENAME
+    return WorkspaceMap.load_or_build(str(tmp_path_factory.mktemp("map") / MAP_FILENAME),
+                                      str(station_dir / preflight.KEY_POINTS))
+
+
+def test_singular_joint_target_is_flagged(plan, boxes, workspace):
+    index = transit(plan, "pull_lever_multiple", "Move to lever with correct joint angles")
+    steps = list(plan.steps)
+    joints = np.array(steps[index].target, dtype=np.float64)
+    joints[4] = 0.0     # Wrist 2 straight, wrist 1 and 3 line up
+    steps[index] = steps[index]._replace(target=joints)
+    violations = preflight.check(MotionPlan(steps, plan.key), boxes, workspace=workspace)
+    assert any(v.step == index and "singularity" in v.reason for v in violations)
+    assert preflight.check(plan, boxes, workspace=workspace) == []
+
+
+def test_lookup_at_a_grid_point_matches_the_sample(workspace):
+    from workspace_map import tool_poses
+    # Interpolation needs a grid point on both sides, the last layer of the map is left out
+    inner = (slice(None, -1),) * 3
+    reachable = np.argwhere((workspace.configurations[inner] > 0) & (workspace.manipulability[inner] > 0))
+    for index in reachable[::len(reachable) // 50]:
+        index = tuple(index)
+        point = workspace.low + np.array(index[:3]) * workspace.spacing
+        pose = tool_poses(point[None], workspace.directions[index[3]][None])[0, 0]
+        result = workspace.lookup(pose)
+        # The count is the smallest around the pose, never more than the sample has
+        assert result.configurations <= workspace.configurations[index]
+        assert np.isclose(result.manipulability, workspace.manipulability[index], rtol=1e-6)
+
+
+def test_nudge_moves_to_a_better_sample(workspace):
+    poor = np.argwhere((workspace.configurations > 0) & (workspace.manipulability < MIN_MANIPULABILITY))
+    nudged = 0
+    for index in poor[::max(1, len(poor) // 50)]:
+        index = tuple(index)
+        nudge = workspace.nudge(index)
+        if nudge is None:
+            continue
+        nudged += 1
+        target = tuple(np.array(index[:3]) + np.round(nudge / workspace.spacing).astype(int)) + (index[3],)
+        assert np.max(np.abs(nudge)) <= workspace.spacing
+        assert workspace.manipulability[target] >= MIN_MANIPULABILITY
+    assert nudged > 0
@@ -0,0 +1,31 @@
+import coffee_machine as cm
+import offline_robodk as off
+from motion_plan import MOVEJ, MOVEL, PROGRAM, ROUNDING_OFF, PlanExecutor
+from replan import STAGES, Replanner
+
+
+def test_cycle_ends_with_the_arm_clear(station_files, boxes):
+    plan = Replanner(*station_files, boxes=boxes, optimise=False).plan
+    programs = [step.tool for step in plan if step.kind == PROGRAM]
+    assert programs[-1] == "Cup Tool Detach (Stand)"
+    assert plan.steps[-1].kind == MOVEJ and plan.steps[-1].target == cm.HOME
+
+
+def test_every_stage_sets_its_own_rounding(station_files, boxes):
+    replanner = Replanner(*station_files, boxes=boxes, optimise=False)
+    RDK = off.OfflineRobolink()
+    robot = RDK.Item("UR5")
+    used = []
+    robot.MoveJ = robot.MoveL = lambda target, blocking=True: used.append(robot.rounding)
+    executor = PlanExecutor(robot, RDK.Item("Master Tool"), RDK)
+    for stage, parameter in STAGES:
+        part = replanner.stage_plan(stage)
+        # Left blending by the stage before
+        robot.setRounding(50.0)
+        used.clear()
+        for step, function, args in executor.prepare(part):
+            if step.kind in (MOVEJ, MOVEL):
+                function(*args)
+        expected = [radius if radius > 0 else ROUNDING_OFF
+                    for step, radius in zip(part, part.rounding) if step.kind in (MOVEJ, MOVEL)]
+        assert used == expected
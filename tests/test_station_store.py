@@ -0,0 +1,42 @@
+import os
+import warnings
+
+import numpy as np
+
+import station_store
+from poses import compose, rotz, transl
+
+
+def write_frames(path, frames):
+    with open(path, "w") as file:
+        for name, frame in frames.items():
+            file.write(name + "," + ",".join(str(value) for value in np.ravel(frame).tolist()) + "\n")
+
+
+def loaded_warnings(path, cache_dir):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        frames = station_store.load_frames(str(path), cache_dir=str(cache_dir))
+    return frames, [str(warning.message) for warning in caught]
+
+
+def test_rounded_rotation_is_repaired_and_reported_once(tmp_path):
+    rounded = np.round(compose(transl(10, 20, 30), rotz(0.3)), 4)
+    path = tmp_path / "reference_frames.csv"
+    write_frames(path, {"globalcup": rounded, "globaltcp": np.eye(4)})
+    frames, caught = loaded_warnings(path, tmp_path / "cache")
+    assert len(caught) == 1 and "globalcup" in caught[0]
+    rotation = frames["globalcup"][:3, :3]
+    assert np.allclose(rotation.T @ rotation, np.eye(3), atol=1e-12)
+    assert np.array_equal(frames["globaltcp"], np.eye(4))
+
+    # Loading the unchanged file again, in this process or from the compiled store, does not repeat it
+    assert loaded_warnings(path, tmp_path / "cache")[1] == []
+    station_store._loaded.clear()
+    again, caught = loaded_warnings(path, tmp_path / "cache")
+    assert caught == [] and np.array_equal(again["globalcup"], frames["globalcup"])
+
+    # A new version of the file is reported again
+    write_frames(path, {"globalcup": rounded, "globaltcp": np.eye(4), "cuptcp": transl(0, 0, 5)})
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert len(loaded_warnings(path, tmp_path / "cache")[1]) == 1
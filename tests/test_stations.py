@@ -0,0 +1,52 @@
+import queue
+
+import pytest
+
+import coffee_machine as cm
+import stations
+from stations import ORDER, Job
+
+
+@pytest.fixture
+def station(station_files):
+    stations.connect_station(0, True, *station_files, log_filename=None)
+    yield stations._station
+    stations._station.clear()
+
+
+def watch_attaches(machine):
+    """ Record every tool attach with the tool that was on the arm when it was issued """
+    attaches = []
+    change_tool = machine.change_tool
+
+    def tracked(name, pickup=True, location=cm.STAND):
+        if pickup:
+            attaches.append((name, machine.mounted))
+        change_tool(name, pickup, location)
+    machine.change_tool = tracked
+    return attaches
+
+
+def test_orders_start_with_the_arm_clear(station):
+    attaches = watch_attaches(station["machine"])
+    for number in range(2):
+        assert stations.run_job(Job(number, ORDER, cm.PARAMETERS)).error is None
+    assert len(attaches) == 12
+    assert all(mounted is None for name, mounted in attaches)
+    assert station["machine"].mounted is None
+
+
+def test_failed_order_stops_the_station(station_files):
+    jobs = queue.Queue()
+    # The second order has no parameters and fails at the first stage that needs one
+    for job in [Job(0, ORDER, cm.PARAMETERS), Job(1, ORDER, {}), Job(2, ORDER, cm.PARAMETERS), None]:
+        jobs.put(job)
+    results = queue.Queue()
+    try:
+        stations.serve_station(0, jobs, results, True, *station_files, stations.BASE_PORT, None)
+    finally:
+        stations._station.clear()
+    done, failed, stopped = results.get_nowait(), results.get_nowait(), results.get_nowait()
+    assert done.error is None and failed.error.startswith("KeyError") and stopped == 0
+    # The rest of the queue is left for the other stations
+    assert jobs.get_nowait().number == 2
@@ -0,0 +1,38 @@
+import numpy as np
+
+import ur5_kinematics as ur
+
+
+def test_forward_inverse_round_trip():
+    generator = np.random.default_rng(1)
+    joints = generator.uniform(-170.0, 170.0, (200, 6))
+    # Keep away from the wrist singularity, where the solution is not unique
+    joints[:, 4] = np.where(np.abs(joints[:, 4]) < 10.0, 30.0, joints[:, 4])
+    poses = ur.forward(joints)
+    solutions = ur.inverse(poses)
+    assert solutions.shape == (200, 8, 6)
+    # Every solution reaches the pose, and one of them is the configuration the pose came from
+    reachable = ~np.isnan(solutions).any(axis=2)
+    assert reachable.any(axis=1).all()
+    reached = ur.forward(solutions[reachable])
+    assert np.allclose(reached, np.repeat(poses, reachable.sum(axis=1), axis=0), atol=1e-6)
+    assert np.allclose(ur.solve(poses, joints), joints, atol=1e-6)
+
+
+def test_station_joint_angles_match_their_poses(station_files):
+    import coffee_machine as cm
+    joint_angles = cm.read_joint_angles(station_files[1])
+    joints = np.array(list(joint_angles.values()))
+    poses = ur.forward(joints)
+    assert np.allclose(ur.solve(poses, joints), joints, atol=1e-6)
+
+
+def test_out_of_reach_pose_has_no_solution():
+    # A configuration with any NaN angle is not a solution
+    solutions = ur.inverse(np.array([[1.0, 0, 0, 2000.0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]))
+    assert np.isnan(solutions).any(axis=-1).all()
+
+
+def test_link_origins_end_at_the_flange():
+    joints = np.random.default_rng(2).uniform(-180.0, 180.0, (10, 6))
+    assert np.allclose(ur.link_origins(joints)[:, -1], ur.forward(joints, np.eye(4))[:, :3, 3])
@@ -0,0 +1,111 @@
+# Joint trajectory recorder and replay for compiled motion plans
+import os
+
+import numpy as np
+
+import coffee_machine as cm
+from motion_plan import MOVEJ, MOVEL, MotionPlan, PipelinedExecutor, PlanExecutor, load_or_compile
+
+TRAJECTORY_VERSION = 1
+
+
+class RecordingExecutor(PlanExecutor):
+    """ Executes a plan one blocking move at a time and reads the robot joints after each move.
+    joints: list of (6,) joint arrays, one per move step of the plans run so far
+    """
+
+    def __init__(self, robot, master_tool, RDK, waiter=None, conditions=None, event_log=None):
+        super(RecordingExecutor, self).__init__(robot, master_tool, RDK, waiter, conditions, event_log)
+        self.joints = []
+
+    def run(self, plan):
+        """ Execute a plan, recording the joints reached by every move.
+        plan: MotionPlan, or list of calls already returned by prepare
+        """
+        calls = self.prepare(plan) if isinstance(plan, MotionPlan) else plan
+        for step, function, args in calls:
+            function(*args)
+            if step.kind == MOVEJ or step.kind == MOVEL:
+                self.joints.append(np.array(list(self.robot.Joints()), dtype=np.float64).ravel()[:6])
+            self.record(step)
+
+
+def move_rows(plan):
+    """ Indices of the move steps of a plan """
+    return [i for i, step in enumerate(plan) if step.kind == MOVEJ or step.kind == MOVEL]
+
+
+def save_trajectory(filename, plan, joints):
+    """ Write the joints recorded for a plan.
+    filename: path of .npz file
+    plan: MotionPlan that was recorded
+    joints: (M, 6) array, one row per move step
+    """
+    rows = move_rows(plan)
+    with open(filename, "wb") as file:
+        np.savez_compressed(file, version=TRAJECTORY_VERSION, key=plan.key,
+                            joints=np.asarray(joints, dtype=np.float64).reshape(len(rows), 6),
+                            labels=np.array([plan.steps[i].label for i in rows], dtype=str),
+                            stages=np.array([plan.steps[i].stage or "" for i in rows], dtype=str))
+
+
+def load_trajectory(filename, plan):
+    """ Read the joints recorded for a plan.
+    filename: path of .npz file
+    plan: MotionPlan to replay
+    output: (M, 6) array, or None if there is no recording or it was made from different inputs
+    """
+    if not os.path.exists(filename):
+        return None
+    rows = move_rows(plan)
+    with np.load(filename) as data:
+        if int(data["version"]) != TRAJECTORY_VERSION or str(data["key"]) != plan.key:
+            return None
+        labels = [plan.steps[i].label for i in rows]
+        if len(data["labels"]) != len(rows) or list(data["labels"]) != labels:
+            return None
+        return data["joints"]
+
+
+def replay_plan(plan, joints):
+    """ Copy of a plan with every move target replaced by its recorded joints.
+    plan: MotionPlan
+    joints: (M, 6) array from load_trajectory
+    output: MotionPlan
+    """
+    steps = list(plan.steps)
+    for i, values in zip(move_rows(plan), joints):
+        steps[i] = steps[i]._replace(target=np.array(values, dtype=np.float64))
+    return MotionPlan(steps, plan.key, plan.rounding, plan.speeds)
+
+
+def run_recorded(plan, trajectory_filename, robot, master_tool, RDK, executor_class=PipelinedExecutor, **options):
+    """ Replay a plan from its recording, or record it if there is no valid recording.
+    plan: MotionPlan
+    trajectory_filename: path of .npz recording
+    robot, master_tool, RDK: station items as for the plan executors
+    executor_class: executor used for replays
+    options: keyword arguments for the executors
+    output: True if the plan was replayed, False if it was recorded
+    """
+    joints = load_trajectory(trajectory_filename, plan)
+    if joints is not None:
+        executor_class(robot, master_tool, RDK, **options).run(replay_plan(plan, joints))
+        return True
+    recorder = RecordingExecutor(robot, master_tool, RDK, **options)
+    recorder.run(plan)
+    save_trajectory(trajectory_filename, plan, recorder.joints)
+    return False
+
+
+def main():
+    plan = load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv")
+
+    RDK = cm.rl.Robolink()
+    robot, master_tool = cm.connect_robot(RDK)
+    replayed = run_recorded(plan, "coffee_trajectory.npz", robot, master_tool, RDK)
+    print("Replayed recorded joints" if replayed else "Recorded joints for the next run")
+
+
+if __name__ == "__main__":
+    main()
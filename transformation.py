@@ -1,5 +1,6 @@
 import matplotlib.pyplot as plt
 import robodk as rdk
+import station_store
 from reference_frames import *
 
 
@@ -48,16 +49,15 @@ def plot_scene(frames, test_points):
 
 def main():
     filename = 'reference_frames.csv'
+    table = station_store.load_frames(filename, repair=False)
+    orthonormal, determinant, last_row = station_store.frame_errors(table.values)
+    repaired, corrections = station_store.repair_frames(table.names, table.values)
+    print("{:<24}{:>14}{:>12}{:>12}{:>12}".format("frame", "orthonormal", "det", "last row", "corrected"))
+    for i, name in enumerate(table.names):
+        print("{:<24}{:>14.3g}{:>12.6f}{:>12.3g}{:>12.3g}".format(name, orthonormal[i], determinant[i], last_row[i],
+                                                                corrections.get(name, 0.0)))
     frames = read_frames(filename)
-
-    all_true = True
-    for name, frame in frames.items():
-        print(name)
-        print(frame)
-        print("{} is homogenous: {}".format(name, frame.isHomogeneous()))
-        if not frame.isHomogeneous():
-            all_true = False
-    print(all_true)
+    print("All frames homogeneous: {}".format(all(frame.isHomogeneous() for frame in frames.values())))
 
     silvia_frame_point = rdk.Mat([0, 218, 0, 1])
     silvia_robot_point = frames[GLOBAL + SILVIA] * silvia_frame_point
@@ -0,0 +1,196 @@
+# Closed-form UR5 inverse kinematics in NumPy
+# Reference: K. P. Andersen, "Kinematics of a UR robot" (2018)
+import numpy as np
+
+from poses import compose, inverse as pose_inverse, transl
+
+# UR5 standard DH parameters in mm and radians
+D = np.array([89.159, 0.0, 0.0, 109.15, 94.65, 82.3])
+A = np.array([0.0, -425.0, -392.25, 0.0, 0.0, 0.0])
+ALPHA = np.array([np.pi / 2, 0.0, 0.0, np.pi / 2, -np.pi / 2, 0.0])
+
+# Master Tool in the station relative to the flange, estimated from the captured tool stand joint angles
+MASTER_TOOL = transl(0, 0, 48.5)
+JOINT_LIMIT = 360.0
+SINGULAR = 1e-9
+
+
+def dh_transform(theta, joint):
+    """ DH link transform for one joint over a batch of angles.
+    theta: array of joint angles in radians
+    joint: joint number 0-5
+    output: array of shape theta.shape + (4, 4)
+    """
+    theta = np.asarray(theta, dtype=np.float64)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    ca = np.cos(ALPHA[joint])
+    sa = np.sin(ALPHA[joint])
+    result = np.zeros(theta.shape + (4, 4))
+    result[..., 0, 0] = c
+    result[..., 0, 1] = -s * ca
+    result[..., 0, 2] = s * sa
+    result[..., 0, 3] = A[joint] * c
+    result[..., 1, 0] = s
+    result[..., 1, 1] = c * ca
+    result[..., 1, 2] = -c * sa
+    result[..., 1, 3] = A[joint] * s
+    result[..., 2, 1] = sa
+    result[..., 2, 2] = ca
+    result[..., 2, 3] = D[joint]
+    result[..., 3, 3] = 1.0
+    return result
+
+
+def forward(joints, tool=MASTER_TOOL):
+    """ TCP poses for a batch of joint configurations.
+    joints: (6,) or (N, 6) joint angles in degrees
+    tool: pose of the TCP relative to the flange
+    output: (N, 4, 4) TCP poses in the robot base frame
+    """
+    radians = np.radians(np.asarray(joints, dtype=np.float64).reshape(-1, 6))
+    return compose(*[dh_transform(radians[:, joint], joint) for joint in range(6)] + [tool])
+
+
+def link_origins(joints):
+    """ Origins of the link frames for a batch of joint configurations.
+    joints: (6,) or (N, 6) joint angles in degrees
+    output: (N, 6, 3) positions in the robot base frame of the frames after each joint, the shoulder, elbow,
+     the three wrists and the flange
+    """
+    radians = np.radians(np.asarray(joints, dtype=np.float64).reshape(-1, 6))
+    frame = np.eye(4)
+    origins = []
+    for joint in range(6):
+        frame = compose(frame, dh_transform(radians[:, joint], joint))
+        origins.append(frame[:, :3, 3])
+    return np.stack(origins, axis=1)
+
+
+def inverse(poses, tool=MASTER_TOOL):
+    """ All eight inverse kinematics solutions for a batch of TCP poses.
+    poses: (4, 4) or (N, 4, 4) TCP poses in the robot base frame
+    tool: pose of the TCP relative to the flange
+    output: (N, 8, 6) joint angles in degrees wrapped to [-180, 180), NaN where a configuration is unreachable.
+     Configurations are ordered by shoulder, wrist then elbow branch.
+    """
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 4, 4)
+    flange = compose(poses, pose_inverse(tool))
+    n = flange.shape[0]
+    solutions = np.full((n, 2, 2, 2, 6), np.nan)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Shoulder: wrist centre p05 seen from above must be tangent to the d4 offset circle
+        p05 = flange[:, :3, 3] - D[5] * flange[:, :3, 2]
+        radius = np.hypot(p05[:, 0], p05[:, 1])
+        psi = np.arctan2(p05[:, 1], p05[:, 0])
+        phi = np.arccos(D[3] / radius)
+        theta1 = np.stack([psi + phi, psi - phi], axis=1) + np.pi / 2          # (N, 2)
+        s1 = np.sin(theta1)
+        c1 = np.cos(theta1)
+
+        # Wrist 2
+        p06 = flange[:, :3, 3]
+        cos5 = (p06[:, None, 0] * s1 - p06[:, None, 1] * c1 - D[3]) / D[5]
+        theta5 = np.arccos(cos5)
+        theta5 = np.stack([theta5, -theta5], axis=2)                          # (N, 2, 2)
+        s5 = np.sin(theta5)
+
+        # Wrist 3 from the base axes seen in the flange frame, arbitrary (zero) when the wrist is singular
+        rotation = flange[:, :3, :3]
+        x60 = rotation[:, 0, :]
+        y60 = rotation[:, 1, :]
+        numerator = (-x60[:, None, None, 1] * s1[:, :, None] + y60[:, None, None, 1] * c1[:, :, None])
+        denominator = (x60[:, None, None, 0] * s1[:, :, None] - y60[:, None, None, 0] * c1[:, :, None])
+        theta6 = np.where(np.abs(s5) < SINGULAR, 0.0, np.arctan2(numerator / s5, denominator / s5))
+
+        # Planar elbow problem for joints 2-4 in frame 1
+        t1 = np.broadcast_to(theta1[:, :, None], theta5.shape)
+        t01 = dh_transform(t1, 0)
+        t45 = dh_transform(theta5, 4)
+        t56 = dh_transform(theta6, 5)
+        t14 = compose(pose_inverse(t01), flange[:, None, None], pose_inverse(compose(t45, t56)))
+        p13 = compose(t14, transl(0, -D[3], 0))[..., :3, 3]
+        length = np.hypot(p13[..., 0], p13[..., 1])
+        cos3 = (length ** 2 - A[1] ** 2 - A[2] ** 2) / (2 * A[1] * A[2])
+        theta3 = np.arccos(cos3)
+        theta3 = np.stack([theta3, -theta3], axis=3)                          # (N, 2, 2, 2)
+        theta2 = np.arctan2(-p13[..., None, 1], -p13[..., None, 0]) \
+            - np.arcsin(-A[2] * np.sin(theta3) / length[..., None])
+        t12 = dh_transform(theta2, 1)
+        t23 = dh_transform(theta3, 2)
+        t34 = compose(pose_inverse(compose(t12, t23)), t14[..., None, :, :])
+        theta4 = np.arctan2(t34[..., 1, 0], t34[..., 0, 0])
+
+    solutions[..., 0] = t1[..., None]
+    solutions[..., 1] = theta2
+    solutions[..., 2] = theta3
+    solutions[..., 3] = theta4
+    solutions[..., 4] = theta5[..., None]
+    solutions[..., 5] = theta6[..., None]
+    degrees = np.degrees(solutions).reshape(n, 8, 6)
+    return (degrees + 180.0) % 360.0 - 180.0
+
+
+def nearest(solutions, seed, weights=None):
+    """ Pick the configuration closest to a seed for each pose.
+    Each joint may be shifted by a full turn within the +/-360 degree limits to get closer to the seed.
+    solutions: (N, 8, 6) joint angles from inverse
+    seed: (6,) or (N, 6) joint angles in degrees
+    weights: optional (6,) weighting of each joint in the distance
+    output: tuple ((N, 6) joint angles with NaN rows where no configuration exists, (N,) weighted distance)
+    """
+    seed = np.broadcast_to(np.asarray(seed, dtype=np.float64), (solutions.shape[0], 6))[:, None, :]
+    weights = np.ones(6) if weights is None else np.asarray(weights, dtype=np.float64)
+    # Closest equivalent angle to the seed, kept within the joint limits
+    turns = np.round((seed - solutions) / 360.0)
+    shifted = solutions + 360.0 * turns
+    shifted = np.where(np.abs(shifted) > JOINT_LIMIT, solutions, shifted)
+    distance = np.sum(weights * np.abs(shifted - seed), axis=2)
+    distance = np.where(np.isnan(distance), np.inf, distance)
+    best = np.argmin(distance, axis=1)
+    rows = np.arange(solutions.shape[0])
+    joints = shifted[rows, best]
+    best_distance = distance[rows, best]
+    joints[np.isinf(best_distance)] = np.nan
+    return joints, best_distance
+
+
+def solve(poses, seed, tool=MASTER_TOOL):
+    """ Joint angles for each pose on the branch closest to a seed.
+    poses: (4, 4) or (N, 4, 4) TCP poses
+    seed: (6,) or (N, 6) joint angles in degrees
+    output: (N, 6) joint angles, NaN rows for unreachable poses
+    """
+    joints, distance = nearest(inverse(poses, tool), seed)
+    return joints
+
+
+def solve_path(poses, seed, tool=MASTER_TOOL):
+    """ Joint angles for a sequence of waypoints, each on the branch closest to the previous waypoint.
+    All poses are solved in one batch, only the branch selection walks the sequence.
+    poses: (N, 4, 4) TCP poses in move order
+    seed: (6,) joint angles before the first waypoint
+    output: (N, 6) joint angles, NaN rows for unreachable poses (the previous waypoint is then kept as seed)
+    """
+    solutions = inverse(poses, tool)
+    joints = np.full((solutions.shape[0], 6), np.nan)
+    previous = np.asarray(seed, dtype=np.float64)
+    for i in range(solutions.shape[0]):
+        best, distance = nearest(solutions[i:i + 1], previous)
+        joints[i] = best[0]
+        if np.isfinite(distance[0]):
+            previous = joints[i]
+    return joints
+
+
+def make_solver(tool=MASTER_TOOL):
+    """ Single pose solver for the offline station, see offline_robodk.OfflineRobot.
+    output: function (pose, seed) -> (6,) joints or None if unreachable
+    """
+    def solver(pose, seed):
+        if seed is None:
+            seed = np.zeros(6)
+        joints = solve(pose, seed, tool)[0]
+        return None if np.isnan(joints).any() else joints
+    return solver
@@ -0,0 +1,228 @@
+# Via-point optimiser for the detour waypoints of the coffee sequence
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import coffee_machine as cm
+import offline_robodk as off
+import preflight
+import ur5_kinematics as ur
+from coffee_machine import GRINDER, FILTER, CUP, TCP, PUSHER, PULLER, GRINDERFUNC, FILTERFUNC, CUPFUNC, ATTACH, \
+    DETACH
+from frame_graph import FrameGraph
+from motion_plan import MOVEJ, PAUSE, PROGRAM, MotionPlan, PipelinedExecutor, load_or_compile
+from poses import IDENTITY, compose, rotz, transl
+from trajectory import RecordingExecutor, move_rows
+
+# (stage, label) of the detour waypoints, only joint moves with these labels are optimised
+VIA_POINTS = [("insert_filter_grinder", "Intermediate point"),
+              ("turn_on_grinder", "Avoid silvia and cups"),
+              ("turn_on_grinder", "Move away from grinder ready for lever movement"),
+              ("insert_filter_silvia", "Avoid silvia"),
+              ("cup_from_stack", "Move to stack"),
+              ("turn_on_silvia", "Avoid tools")]
+ROTATIONS = np.radians(np.arange(-40.0, 41.0, 5.0))    # Rotations of the waypoint about the robot base z axis
+SHIFTS = np.arange(-80.0, 81.0, 40.0)                  # mm, shifts of the waypoint along x and y
+LIFTS = np.arange(-40.0, 81.0, 40.0)                   # mm, shifts of the waypoint along z
+CLEARANCE = 40.0        # mm, clearance kept from every box unless the hand tuned path already came closer
+SAMPLES = 24            # Forward kinematics samples along each joint move
+MIN_SAVING = 0.05       # s, smaller improvements keep the hand tuned waypoint
+BODY_SAMPLES = 4        # Points along the tool body from the TCP to each end of the tool
+# Tool programs and the frames at the far ends of each tool, with what it carries
+TOOL_FUNCTIONS = {GRINDERFUNC: GRINDER, FILTERFUNC: FILTER, CUPFUNC: CUP}
+TOOL_ENDS = {GRINDER: [PUSHER, PULLER], FILTER: [FILTER], CUP: [CUP]}
+
+# step: plan index, old, new: joint move time in and out of the waypoint in seconds,
+# clearance: smallest distance to a box along the new path in mm, joints: chosen joint angles
+Via = namedtuple("Via", ["step", "stage", "label", "old", "new", "clearance", "joints"])
+
+
+def plan_joints(plan):
+    """ Joint angles at every move of a plan, from a run on the offline station.
+    plan: MotionPlan
+    output: (N, 6) joint angles, NaN for steps that are not moves
+    """
+    RDK = off.OfflineRobolink(solver=ur.make_solver())
+    recorder = RecordingExecutor(RDK.Item("UR5"), RDK.Item("Master Tool"), RDK, waiter=off.SimulatedWaiter(RDK))
+    recorder.run(plan)
+    joints = np.full((len(plan), 6), np.nan)
+    joints[move_rows(plan)] = recorder.joints
+    return joints
+
+
+def mounted_tools(plan):
+    """ Tool on the arm at every step of a plan, from its tool programs.
+    The portafilter leaves the arm when the TA takes it at the coffee machine.
+    plan: MotionPlan
+    output: list of tool names, None for the bare master tool
+    """
+    mounted = None
+    tools = []
+    for step in plan:
+        if step.kind == PROGRAM:
+            for function, tool in TOOL_FUNCTIONS.items():
+                if step.tool.startswith(function + ATTACH):
+                    mounted = tool
+                elif step.tool.startswith(function + DETACH) and mounted == tool:
+                    mounted = None
+        elif step.kind == PAUSE and step.label == cm.TAINSERT:
+            mounted = None
+        tools.append(mounted)
+    return tools
+
+
+def tool_bodies(frames, samples=BODY_SAMPLES):
+    """ Points along the body of each tool in the TCP frame.
+    frames: FrameGraph of the station reference frames
+    output: dictionary of tool -> (K, 3) points, None -> empty array for the bare master tool
+    """
+    fractions = np.linspace(0.0, 1.0, samples + 1)[1:, None]
+    bodies = {None: np.zeros((0, 3))}
+    for tool, ends in TOOL_ENDS.items():
+        bodies[tool] = np.concatenate([fractions * frames.get(TCP, end)[:3, 3] for end in ends])
+    return bodies
+
+
+def via_steps(plan, via_points=VIA_POINTS):
+    """ Indices of the joint moves of a plan that are detour waypoints """
+    return [i for i, step in enumerate(plan) if step.kind == MOVEJ and (step.stage, step.label) in via_points]
+
+
+def candidates(pose, rotations=ROTATIONS, shifts=SHIFTS, lifts=LIFTS):
+    """ Waypoints around a hand tuned one, the tool orientation turns with the base rotation.
+    pose: (4, 4) TCP pose of the waypoint in the robot base frame
+    output: (C, 4, 4) poses, the first is the waypoint itself
+    """
+    x, y, z = np.meshgrid(shifts, shifts, lifts, indexing="ij")
+    offsets = transl(x.ravel(), y.ravel(), z.ravel())
+    moved = compose(rotz(rotations)[:, None], offsets[None, :], pose).reshape(-1, 4, 4)
+    return np.concatenate([pose[None], moved])
+
+
+def move_times(start, end, limits):
+    """ Synchronised joint move times for a batch of moves.
+    start, end: (..., 6) joint angles
+    limits: offline_robodk.MotionLimits
+    output: (...) seconds
+    """
+    return np.max(off.trapezoid_time(end - start, limits.joint_speed, limits.joint_accel), axis=-1)
+
+
+def path_clearance(start, via, end, boxes, samples=SAMPLES, tool=ur.MASTER_TOOL, body=None):
+    """ Closest approach of the arm to each box along the joint moves in and out of waypoints.
+    The elbow, wrists and flange, the TCP and the body of the tool on the arm are checked.
+    start, end: (6,) joint angles before and after the waypoint
+    via: (C, 6) joint angles of the candidate waypoints
+    boxes: station keep-out boxes
+    body: (K, 3) points of the tool body in the TCP frame, see tool_bodies
+    output: tuple ((C, B) smallest distances in mm, (C,) whether any sample is out of reach or below the bench)
+    """
+    fractions = np.linspace(0.0, 1.0, samples)[None, :, None]
+    into = start + fractions * (via[:, None, :] - start)
+    out = via[:, None, :] + fractions * (end - via[:, None, :])
+    path = np.concatenate([into, out], axis=1).reshape(-1, 6)
+    # The shoulder does not move relative to the base, the elbow onwards can swing into an item
+    links = ur.link_origins(path)[:, 1:]
+    tcp = compose(ur.forward(path, IDENTITY), tool)
+    body = np.zeros((0, 3)) if body is None else body
+    carried = np.einsum("nij,kj->nki", tcp[:, :3, :3], body) + tcp[:, None, :3, 3]
+    points = np.concatenate([links, tcp[:, None, :3, 3], carried], axis=1).reshape(len(via), -1, 3)
+    return np.min(preflight.distances(points, boxes), axis=1), np.any(preflight.out_of_reach(points), axis=1)
+
+
+def optimise_via(start, current, end, boxes, limits, clearance=CLEARANCE, tool=ur.MASTER_TOOL, body=None):
+    """ Fastest safe replacement for one waypoint.
+    start, current, end: (6,) joint angles before, at and after the waypoint
+    boxes: station keep-out boxes
+    limits: offline_robodk.MotionLimits of the joint moves
+    clearance: distance in mm to keep from each box, or as close as the hand tuned path came if that was closer
+    body: (K, 3) points of the tool body in the TCP frame, see tool_bodies
+    output: tuple ((6,) joint angles, time in and out in seconds, smallest clearance in mm)
+    """
+    poses = candidates(ur.forward(current, tool)[0])
+    via, distance = ur.nearest(ur.inverse(poses, tool), start)
+    via[0] = current
+    solved = np.isfinite(distance)
+    solved[0] = True
+    via = via[solved]
+
+    gaps, unreachable = path_clearance(start, via, end, boxes, tool=tool, body=body)
+    # A box the hand tuned path came closer to than the clearance may be approached as close again, never closer
+    required = np.minimum(gaps[0], clearance)
+    safe = np.all(gaps >= required - 1e-6, axis=1) & ~unreachable
+    safe[0] = True
+    times = np.where(safe, move_times(start, via, limits) + move_times(via, end, limits), np.inf)
+    best = int(np.argmin(times))
+    return via[best], float(times[best]), float(np.min(gaps[best]))
+
+
+def optimise_plan(plan, boxes=None, limits=None, clearance=CLEARANCE, min_saving=MIN_SAVING,
+                  frame_filename="reference_frames.csv", only=None):
+    """ Replace the detour waypoints of a plan with faster ones.
+    Each waypoint is optimised between the joints the arm has before and after it in the original plan.
+    plan: MotionPlan
+    boxes: station keep-out boxes, read from the key points if not given
+    limits: joint limits of the time model, the offline station defaults if not given
+    frame_filename: station reference frames, for the size of the tools
+    only: optional collection of step indices, detour waypoints among the other steps are left as they are
+    output: tuple (MotionPlan with the improved waypoints as joint targets, list of Vias)
+    """
+    boxes = preflight.station_boxes(preflight.read_key_points()) if boxes is None else boxes
+    limits = off.MotionLimits() if limits is None else limits
+    bodies = tool_bodies(FrameGraph.from_frames(cm.read_frames(frame_filename), cm.FRAMES))
+    tools = mounted_tools(plan)
+    joints = plan_joints(plan)
+    rows = move_rows(plan)
+    steps = list(plan.steps)
+    report = []
+    for i in via_steps(plan):
+        if only is not None and i not in only:
+            continue
+        n = rows.index(i)
+        if n == 0 or n == len(rows) - 1:
+            continue
+        start, current, end = joints[rows[n - 1]], joints[i], joints[rows[n + 1]]
+        old = move_times(start, current, limits) + move_times(current, end, limits)
+        new_joints, new, gap = optimise_via(start, current, end, boxes, limits, clearance, body=bodies[tools[i]])
+        step = plan.steps[i]
+        if old - new < min_saving:
+            new_joints, new = current, old
+        else:
+            steps[i] = step._replace(target=new_joints)
+        report.append(Via(i, step.stage, step.label, float(old), float(new), gap, new_joints))
+    return MotionPlan(steps, plan.key, plan.rounding, plan.speeds), report
+
+
+def main():
+    plan = load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv")
+    start = time.perf_counter()
+    optimised, report = optimise_plan(plan)
+    elapsed = time.perf_counter() - start
+    for via in report:
+        print("{:>4} {:<22}{:<50}{:>7.2f} s{:>7.2f} s{:>8.1f} mm".format(
+            via.step, via.stage, via.label, via.old, via.new, via.clearance))
+    before = off.simulate_plan(plan)["total"]
+    after = off.simulate_plan(optimised)["total"]
+    problems = preflight.check(optimised, preflight.station_boxes(preflight.read_key_points()))
+    print("Optimised in {:.2f} s, cycle {:.2f} s -> {:.2f} s, {} preflight problems".format(
+        elapsed, before, after, len(problems)))
+    if problems:
+        print("Optimised plan not saved")
+        return
+    optimised.save("coffee_plan_via.npz")
+    # The plan has only been checked against the estimated keep-out boxes, try it in the station first
+    if "--run" not in sys.argv:
+        print("Saved coffee_plan_via.npz, run with --run to execute it on the robot")
+        return
+
+    RDK = cm.rl.Robolink()
+    robot, master_tool = cm.connect_robot(RDK)
+    executor = PipelinedExecutor(robot, master_tool, RDK)
+    executor.run(optimised)
+    print(executor.report())
+
+
+if __name__ == "__main__":
+    main()
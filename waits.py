@@ -0,0 +1,86 @@
+# Event driven waits for the robot, station programs and external processes
+import time
+from collections import namedtuple
+
+# label: what was waited for, elapsed: seconds actually waited, timeout: upper bound in seconds,
+# satisfied: True if the condition held before the timeout
+WaitRecord = namedtuple("WaitRecord", ["label", "elapsed", "timeout", "satisfied"])
+
+
+PROGRAM_TIMEOUT = 30.0  # s, longest a station program may run
+
+
+def program_finished(program):
+    """ Condition that holds once a station program has finished running.
+    program: RoboDK program item
+    """
+    return lambda: not program.Busy()
+
+
+def station_flag(RDK, name):
+    """ Condition that holds once a station parameter has been set to 1, the parameter is cleared when it does.
+    The operator sets the parameter from RoboDK (Tools > Station parameters) or an IO script sets it.
+    RDK: Robolink
+    name: station parameter name
+    """
+    def condition():
+        if str(RDK.getParam(name)).strip() == "1":
+            RDK.setParam(name, "0")
+            return True
+        return False
+    return condition
+
+
+def run_program(RDK, waiter, name, timeout=PROGRAM_TIMEOUT):
+    """ Run a station program and wait until it is no longer busy.
+    RDK: Robolink
+    waiter: Waiter recording the time the program took
+    name: name of the program in the station
+    timeout: seconds after which the program is considered stuck
+    """
+    program = RDK.Item(name)
+    program.RunProgram()
+    record = waiter.wait(name, timeout, program_finished(program))
+    if not record.satisfied:
+        raise TimeoutError("Station program {} did not finish within {} s".format(name, timeout))
+
+
+class Waiter(object):
+    """ Waits on pluggable conditions with a timeout and records how long each wait took. """
+
+    def __init__(self, poll_interval=0.05):
+        self.poll_interval = poll_interval
+        self.records = []
+
+    def wait(self, label, timeout=None, condition=None):
+        """ Block until condition holds or the timeout elapses.
+        label: description of the wait for the record
+        timeout: maximum time to wait in seconds, None to wait indefinitely for the condition
+        condition: function returning True once waiting can stop, None to wait for the full timeout
+        output: WaitRecord
+        """
+        if timeout is None and condition is None:
+            raise ValueError("Wait {} needs a condition or a timeout".format(label))
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        satisfied = False
+        while True:
+            if condition is not None and condition():
+                satisfied = True
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            # Without a condition there is nothing to poll so sleep out the remaining time in one go
+            if condition is None:
+                time.sleep(remaining)
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+
+        record = WaitRecord(label, time.monotonic() - start, timeout, satisfied)
+        self.records.append(record)
+        return record
+
+    def total(self):
+        """ Total time spent waiting in seconds """
+        return sum(record.elapsed for record in self.records)
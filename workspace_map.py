@@ -0,0 +1,302 @@
+# Reachability and singularity map of the station workspace. It is advisory: preflight evaluates every target
+# exactly and only asks the map where to nudge a flagged one, lookup is a quick estimate for exploring new positions
+import hashlib
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+import preflight
+import ur5_kinematics as ur
+from motion_plan import MOVEJ, MOVEL, load_or_compile
+from poses import compose, rotz
+
+MAP_FILENAME = "workspace_map.npz"
+MAP_VERSION = 1
+SPACING = 40.0          # mm between grid points
+PADDING = 100.0         # mm added around the key points
+HEIGHT = 300.0          # mm above the highest key point, the tool mounts are approached from above
+MIN_MANIPULABILITY = 0.005  # Targets below this are too close to a singularity
+BATCH = 8192            # Samples solved at once, bounds the memory of the Jacobians
+# Tool directions (TCP z axis) relative to the direction from the robot base to the sample: horizontal every
+# 45 degrees, tilted down 45 degrees every 90 degrees and straight down
+HORIZONTAL = np.radians(np.arange(0.0, 360.0, 45.0))
+TILTED = np.radians(np.arange(0.0, 360.0, 90.0))
+DIRECTIONS = np.concatenate([
+    np.stack([np.cos(HORIZONTAL), np.sin(HORIZONTAL), np.zeros_like(HORIZONTAL)], axis=1),
+    np.stack([np.cos(TILTED), np.sin(TILTED), -np.ones_like(TILTED)], axis=1) / np.sqrt(2.0),
+    [[0.0, 0.0, -1.0]]])
+
+# configurations: number of reachable configurations, manipulability: best over those configurations,
+# ok: reachable and not near a singularity, nudge: (3,) move in mm to the best neighbouring grid point or None
+Lookup = namedtuple("Lookup", ["configurations", "manipulability", "ok", "nudge"])
+
+
+def key_point_positions(key_points):
+    """ Every position given in key_points.csv.
+    key_points: dictionary from preflight.read_key_points
+    output: (N, 3) positions in the robot base frame
+    """
+    positions = []
+    for values in key_points.values():
+        if values.size == 16:
+            positions.append(values.reshape(4, 4)[:3, 3])
+        elif values.size % 3 == 0:
+            positions.extend(values.reshape(-1, 3))
+    return np.array(positions)
+
+
+def station_bounds(key_points, padding=PADDING, height=HEIGHT):
+    """ Lower and upper corner of the workspace around the key points, the bench is the lower limit """
+    positions = key_point_positions(key_points)
+    low = np.min(positions, axis=0) - padding
+    high = np.max(positions, axis=0) + padding
+    low[2] = max(low[2], preflight.FLOOR)
+    high[2] += height - padding
+    return low, high
+
+
+def tool_poses(points, directions):
+    """ TCP poses pointing each direction, turned with the bearing of each point from the robot base.
+    points: (N, 3) positions
+    directions: (D, 3) unit tool directions, x is away from the base
+    output: (N, D, 4, 4) poses
+    """
+    # A rotation taking the z axis to each direction, with the tool x axis kept in the vertical plane
+    z = directions
+    reference = np.where(np.abs(z[:, 2:3]) > 0.99, [[1.0, 0.0, 0.0]], [[0.0, 0.0, 1.0]])
+    y = np.cross(z, reference)
+    y /= np.linalg.norm(y, axis=1, keepdims=True)
+    x = np.cross(y, z)
+    local = np.zeros((len(directions), 4, 4))
+    local[:, :3, :3] = np.stack([x, y, z], axis=2)
+    local[:, 3, 3] = 1.0
+    poses = compose(rotz(np.arctan2(points[:, 1], points[:, 0]))[:, None], local[None])
+    poses[..., :3, 3] = points[:, None, :]
+    return poses
+
+
+def manipulability(joints, tool=ur.MASTER_TOOL):
+    """ Yoshikawa manipulability for a batch of joint configurations.
+    joints: (N, 6) joint angles in degrees
+    tool: pose of the TCP relative to the flange
+    output: (N,) |det J|, with the Jacobian position rows in metres
+    """
+    radians = np.radians(joints)
+    frames = [np.broadcast_to(np.eye(4), (len(joints), 4, 4))]
+    for joint in range(6):
+        frames.append(compose(frames[-1], ur.dh_transform(radians[:, joint], joint)))
+    tcp = compose(frames[-1], tool)[:, :3, 3]
+    axes = np.stack([frame[:, :3, 2] for frame in frames[:6]], axis=2)
+    origins = np.stack([frame[:, :3, 3] for frame in frames[:6]], axis=2)
+    jacobian = np.concatenate([np.cross(axes, tcp[:, :, None] - origins, axis=1) / 1000.0, axes], axis=1)
+    return np.abs(np.linalg.det(jacobian))
+
+
+def evaluate(poses, tool=ur.MASTER_TOOL, batch=BATCH):
+    """ Configuration count and best manipulability of a batch of TCP poses.
+    poses: (N, 4, 4) poses
+    output: tuple ((N,) configuration counts, (N,) manipulability, 0 where unreachable)
+    """
+    counts = np.zeros(len(poses), dtype=np.uint8)
+    best = np.zeros(len(poses), dtype=np.float32)
+    for start in range(0, len(poses), batch):
+        solutions = ur.inverse(poses[start:start + batch], tool)
+        reachable = ~np.isnan(solutions).any(axis=2)
+        counts[start:start + batch] = reachable.sum(axis=1)
+        values = np.zeros(reachable.shape)
+        values[reachable] = manipulability(solutions[reachable], tool)
+        best[start:start + batch] = values.max(axis=1)
+    return counts, best
+
+
+def map_key(key_points_filename, spacing, directions):
+    """ Hash of the key points and sampling a map was built from """
+    digest = hashlib.sha1()
+    with open(key_points_filename, "rb") as file:
+        digest.update(file.read())
+    digest.update(np.asarray([spacing, MAP_VERSION], dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(directions, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(ur.MASTER_TOOL).tobytes())
+    return digest.hexdigest()
+
+
+class WorkspaceMap(object):
+    """ Gridded reachability and manipulability of the station.
+    low: (3,) position of the first grid point, spacing: distance between grid points in mm
+    directions: (D, 3) sampled tool directions relative to the bearing from the robot base
+    configurations, manipulability: (X, Y, Z, D) arrays
+    """
+
+    def __init__(self, low, spacing, directions, configurations, manipulability, key=""):
+        self.low = np.asarray(low, dtype=np.float64)
+        self.spacing = float(spacing)
+        self.directions = np.asarray(directions, dtype=np.float64)
+        self.configurations = configurations
+        self.manipulability = manipulability
+        self.key = key
+
+    @classmethod
+    def build(cls, key_points_filename=preflight.KEY_POINTS, spacing=SPACING, directions=DIRECTIONS):
+        """ Sample the workspace around the key points """
+        low, high = station_bounds(preflight.read_key_points(key_points_filename))
+        axes = [np.arange(low[i], high[i] + spacing / 2, spacing) for i in range(3)]
+        grid = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1)
+        poses = tool_poses(grid.reshape(-1, 3), directions).reshape(-1, 4, 4)
+        counts, best = evaluate(poses)
+        shape = grid.shape[:3] + (len(directions),)
+        return cls(low, spacing, directions, counts.reshape(shape), best.reshape(shape),
+                   map_key(key_points_filename, spacing, directions))
+
+    def save(self, filename=MAP_FILENAME):
+        """ Write the map to a compressed .npz file """
+        with open(filename, "wb") as file:
+            np.savez_compressed(file, version=MAP_VERSION, key=self.key, low=self.low, spacing=self.spacing,
+                                directions=self.directions, configurations=self.configurations,
+                                manipulability=self.manipulability)
+
+    @classmethod
+    def load(cls, filename=MAP_FILENAME):
+        """ Read a map written by save.
+        output: WorkspaceMap, or None if the file was written by a different version
+        """
+        with np.load(filename) as data:
+            if int(data["version"]) != MAP_VERSION:
+                return None
+            return cls(data["low"], float(data["spacing"]), data["directions"], data["configurations"],
+                       data["manipulability"], str(data["key"]))
+
+    @classmethod
+    def load_or_build(cls, filename=MAP_FILENAME, key_points_filename=preflight.KEY_POINTS, spacing=SPACING,
+                      directions=DIRECTIONS):
+        """ Reuse a saved map if it was built from the same key points and sampling, otherwise build one """
+        if os.path.exists(filename):
+            workspace = cls.load(filename)
+            if workspace is not None and workspace.key == map_key(key_points_filename, spacing, directions):
+                return workspace
+        workspace = cls.build(key_points_filename, spacing, directions)
+        workspace.save(filename)
+        return workspace
+
+    def index(self, pose):
+        """ Grid index of the sample closest to a TCP pose.
+        pose: (4, 4) pose in the robot base frame
+        output: tuple (x, y, z, direction) index, or None outside the map
+        """
+        cell = np.round((pose[:3, 3] - self.low) / self.spacing).astype(int)
+        if np.any(cell < 0) or np.any(cell >= self.configurations.shape[:3]):
+            return None
+        return tuple(cell) + (self.direction(pose),)
+
+    def direction(self, pose):
+        """ Index of the sampled tool direction closest to the z axis of a TCP pose """
+        bearing = np.arctan2(pose[1, 3], pose[0, 3])
+        c, s = np.cos(bearing), np.sin(bearing)
+        x, y, z = pose[:3, 2]
+        return int(np.argmax(self.directions.dot([c * x + s * y, c * y - s * x, z])))
+
+    def interpolate(self, pose):
+        """ Configuration count and manipulability at a TCP pose, interpolated between grid points.
+        The count is the smallest of the eight grid points around the pose, the manipulability is trilinear.
+        pose: (4, 4) pose in the robot base frame
+        output: tuple (configurations, manipulability), or None outside the map
+        """
+        position = (pose[:3, 3] - self.low) / self.spacing
+        corner = np.floor(position).astype(int)
+        if np.any(corner < 0) or np.any(corner + 1 >= self.configurations.shape[:3]):
+            return None
+        fraction = position - corner
+        x, y, z = corner
+        direction = self.direction(pose)
+        counts = self.configurations[x:x + 2, y:y + 2, z:z + 2, direction]
+        values = self.manipulability[x:x + 2, y:y + 2, z:z + 2, direction].astype(np.float64)
+        for axis in range(3):
+            values = values[0] * (1.0 - fraction[axis]) + values[1] * fraction[axis]
+        return int(counts.min()), float(values)
+
+    def lookup(self, pose, threshold=MIN_MANIPULABILITY):
+        """ Estimated reachability of a TCP pose, with the move to a better neighbouring grid point if it is poor.
+    The estimate is interpolated from the grid, nothing is vetoed on it, review evaluates targets exactly.
+        pose: (4, 4) pose in the robot base frame
+        threshold: manipulability below which a target is near a singularity
+        output: Lookup, or None outside the map
+        """
+        index = self.index(pose)
+        interpolated = self.interpolate(pose)
+        if index is None or interpolated is None:
+            return None
+        configurations, value = interpolated
+        ok = configurations > 0 and value >= threshold
+        return Lookup(configurations, value, ok, None if ok else self.nudge(index, threshold))
+
+    def nudge(self, index, threshold=MIN_MANIPULABILITY):
+        """ Move to the best neighbouring grid point of a sample, None if no neighbour is above threshold """
+        cell = np.array(index[:3])
+        low = np.maximum(cell - 1, 0)
+        high = np.minimum(cell + 2, self.configurations.shape[:3])
+        around = self.manipulability[low[0]:high[0], low[1]:high[1], low[2]:high[2], index[3]]
+        best = np.unravel_index(np.argmax(around), around.shape)
+        return (low + best - cell) * self.spacing if around[best] >= threshold else None
+
+    def review(self, plan, threshold=MIN_MANIPULABILITY, only=None):
+        """ Targets of a plan that are unreachable or near a singularity.
+        Targets are evaluated exactly, pose targets over all their configurations and joint targets in the
+        configuration given, the map only suggests where to nudge a flagged pose target.
+        plan: MotionPlan
+        threshold: manipulability below which a target is near a singularity
+        only: optional collection of step indices, the other steps are not reviewed
+        output: list of (step index, step, Lookup)
+        """
+        rows = [i for i, step in enumerate(plan) if step.kind in (MOVEJ, MOVEL) and (only is None or i in only)]
+        poses = [i for i in rows if np.size(plan.steps[i].target) == 16]
+        joints = [i for i in rows if np.size(plan.steps[i].target) == 6]
+        results = {}
+        if poses:
+            counts, values = evaluate(np.array([plan.steps[i].target for i in poses], dtype=np.float64))
+            for i, count, value in zip(poses, counts, values):
+                results[i] = (int(count), float(value))
+        if joints:
+            values = manipulability(np.array([plan.steps[i].target for i in joints], dtype=np.float64))
+            for i, value in zip(joints, values):
+                results[i] = (1, float(value))
+
+        flagged = []
+        for i in sorted(results):
+            count, value = results[i]
+            if count > 0 and value >= threshold:
+                continue
+            nudge = None
+            if i in poses:
+                index = self.index(np.asarray(plan.steps[i].target))
+                nudge = None if index is None else self.nudge(index, threshold)
+            flagged.append((i, plan.steps[i], Lookup(count, value, False, nudge)))
+        return flagged
+
+
+def main():
+    start = time.perf_counter()
+    workspace = WorkspaceMap.build()
+    built = time.perf_counter() - start
+    workspace.save()
+    samples = workspace.configurations.size
+    print("{} samples ({} points x {} directions) built in {:.1f} s".format(
+        samples, samples // len(workspace.directions), len(workspace.directions), built))
+    print("{:.1f}% reachable, {:.1f}% near a singularity".format(
+        100.0 * np.mean(workspace.configurations > 0),
+        100.0 * np.mean((workspace.configurations > 0) & (workspace.manipulability < MIN_MANIPULABILITY))))
+
+    plan = load_or_compile("coffee_plan.npz", "reference_frames.csv", "joint_angles.csv")
+    start = time.perf_counter()
+    flagged = workspace.review(plan)
+    elapsed = time.perf_counter() - start
+    for i, step, result in flagged:
+        print("{:>4} {:<22}{:<40}{} configurations, manipulability {:.4f}, nudge {}".format(
+            i, step.stage, step.label, result.configurations, result.manipulability,
+            "none" if result.nudge is None else result.nudge))
+    print("{} targets reviewed in {:.2f} ms, {} flagged".format(
+        sum(np.size(step.target) == 16 for step in plan), 1000 * elapsed, len(flagged)))
+
+
+if __name__ == "__main__":
+    main()